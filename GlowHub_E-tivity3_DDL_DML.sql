@@ -70,6 +70,19 @@ CREATE TABLE PRODOTTO (
 
 CREATE INDEX idx_prodotto_categoria ON PRODOTTO(idCategoria);
 
+CREATE TABLE STORICO_PREZZO (
+  idStorico         INT AUTO_INCREMENT PRIMARY KEY,
+  sku               VARCHAR(32) NOT NULL,
+  prezzoPrecedente  DECIMAL(10,2) NOT NULL,
+  prezzoNuovo       DECIMAL(10,2) NOT NULL,
+  dataModifica      DATETIME NOT NULL,
+  CONSTRAINT fk_storicoprezzo_prodotto
+    FOREIGN KEY (sku) REFERENCES PRODOTTO(sku)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_storicoprezzo_sku_data ON STORICO_PREZZO(sku, dataModifica);
+
 -- =========================
 -- CARRELLO
 -- =========================
@@ -79,6 +92,7 @@ CREATE TABLE CARRELLO (
   idCliente           INT NOT NULL,
   dataCreazione       DATETIME NOT NULL,
   dataUltimaModifica  DATETIME NOT NULL,
+  versione            INT NOT NULL DEFAULT 1,
   CONSTRAINT uq_carrello_cliente UNIQUE (idCliente),
   CONSTRAINT fk_carrello_cliente
     FOREIGN KEY (idCliente) REFERENCES CLIENTE(idCliente)
@@ -106,6 +120,19 @@ CREATE TABLE VOCE_CARRELLO (
 CREATE INDEX idx_vocecarrello_carrello ON VOCE_CARRELLO(idCarrello);
 CREATE INDEX idx_vocecarrello_sku      ON VOCE_CARRELLO(sku);
 
+-- voci rimosse da sweep-carts --archivia (senza FK: il carrello può sparire)
+CREATE TABLE VOCE_CARRELLO_ARCHIVIO (
+  idVoceCarrello     INT PRIMARY KEY,
+  idCarrello         INT NOT NULL,
+  sku                VARCHAR(32) NOT NULL,
+  quantita           INT NOT NULL,
+  prezzoVisto        DECIMAL(10,2) NOT NULL,
+  dataAggiunta       DATETIME NOT NULL,
+  dataArchiviazione  DATETIME NOT NULL
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_vocecarrelloarchivio_carrello ON VOCE_CARRELLO_ARCHIVIO(idCarrello);
+
 -- =========================
 -- ORDINI
 -- =========================
@@ -119,6 +146,7 @@ CREATE TABLE ORDINE (
   totaleLordo            DECIMAL(10,2) NOT NULL,
   totaleSconti           DECIMAL(10,2) NOT NULL,
   totaleNetto            DECIMAL(10,2) NOT NULL,
+  versione               INT NOT NULL DEFAULT 1,
   CONSTRAINT fk_ordine_cliente
     FOREIGN KEY (idCliente) REFERENCES CLIENTE(idCliente)
     ON DELETE RESTRICT ON UPDATE CASCADE,
@@ -130,6 +158,7 @@ CREATE TABLE ORDINE (
 ) ENGINE=InnoDB;
 
 CREATE INDEX idx_ordine_cliente_data ON ORDINE(idCliente, dataCreazione);
+CREATE INDEX idx_ordine_stato_data   ON ORDINE(statoOrdine, dataCreazione);
 
 CREATE TABLE RIGA_ORDINE (
   idRigaOrdine             INT AUTO_INCREMENT PRIMARY KEY,
@@ -153,6 +182,20 @@ CREATE TABLE RIGA_ORDINE (
 CREATE INDEX idx_rigaordine_ordine ON RIGA_ORDINE(idOrdine);
 CREATE INDEX idx_rigaordine_sku    ON RIGA_ORDINE(sku);
 
+-- coda di evasione: un lease per ordine IN_PREPARAZIONE
+CREATE TABLE LEASE_PREPARAZIONE (
+  idOrdine           INT PRIMARY KEY,
+  worker             VARCHAR(60) NOT NULL,
+  dataPresaInCarico  DATETIME NOT NULL,
+  scadenza           DATETIME NOT NULL,
+  CONSTRAINT fk_lease_ordine
+    FOREIGN KEY (idOrdine) REFERENCES ORDINE(idOrdine)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_lease_scadenza ON LEASE_PREPARAZIONE(scadenza);
+CREATE INDEX idx_lease_worker   ON LEASE_PREPARAZIONE(worker);
+
 -- =========================
 -- PAGAMENTI
 -- =========================
@@ -160,7 +203,8 @@ CREATE INDEX idx_rigaordine_sku    ON RIGA_ORDINE(sku);
 CREATE TABLE METODO_PAGAMENTO (
   idMetodo     INT AUTO_INCREMENT PRIMARY KEY,
   nomeMetodo   VARCHAR(50) NOT NULL,
-  provider     VARCHAR(80)
+  provider     VARCHAR(80),
+  CONSTRAINT uq_metodopagamento_nome UNIQUE (nomeMetodo)
 ) ENGINE=InnoDB;
 
 CREATE TABLE PAGAMENTO (
@@ -171,6 +215,7 @@ CREATE TABLE PAGAMENTO (
   dataOra        DATETIME NOT NULL,
   esito          ENUM('OK','KO') NOT NULL,
   transactionId  VARCHAR(80),
+  tipo           ENUM('INCASSO','RIMBORSO') NOT NULL DEFAULT 'INCASSO',
   CONSTRAINT fk_pagamento_ordine
     FOREIGN KEY (idOrdine) REFERENCES ORDINE(idOrdine)
     ON DELETE CASCADE ON UPDATE CASCADE,
@@ -182,6 +227,43 @@ CREATE TABLE PAGAMENTO (
 ) ENGINE=InnoDB;
 
 CREATE INDEX idx_pagamento_ordine_data ON PAGAMENTO(idOrdine, dataOra);
+CREATE INDEX idx_pagamento_data        ON PAGAMENTO(dataOra);
+
+CREATE TABLE RICONCILIAZIONE (
+  idRiconciliazione  INT AUTO_INCREMENT PRIMARY KEY,
+  nomeFile           VARCHAR(255) NOT NULL,
+  dataEsecuzione     DATETIME NOT NULL,
+  righe              INT NOT NULL DEFAULT 0,
+  confermati         INT NOT NULL DEFAULT 0,
+  ordiniAggiornati   INT NOT NULL DEFAULT 0,
+  mancantiInDb       INT NOT NULL DEFAULT 0,
+  mancantiNelFile    INT NOT NULL DEFAULT 0,
+  duplicati          INT NOT NULL DEFAULT 0,
+  importoDiverso     INT NOT NULL DEFAULT 0,
+  esitoDiverso       INT NOT NULL DEFAULT 0,
+  nonValide          INT NOT NULL DEFAULT 0
+) ENGINE=InnoDB;
+
+CREATE TABLE STAGING_RICONCILIAZIONE (
+  idRiconciliazione  INT NOT NULL,
+  transactionId      VARCHAR(80) NOT NULL,
+  PRIMARY KEY (idRiconciliazione, transactionId)
+) ENGINE=InnoDB;
+
+CREATE TABLE ANOMALIA_RICONCILIAZIONE (
+  idAnomalia         INT AUTO_INCREMENT PRIMARY KEY,
+  idRiconciliazione  INT NOT NULL,
+  tipo               ENUM('MANCANTE_IN_DB','MANCANTE_NEL_FILE','DUPLICATO','IMPORTO_DIVERSO','ESITO_DIVERSO','NON_VALIDA') NOT NULL,
+  transactionId      VARCHAR(80),
+  riga               INT,
+  importoFile        DECIMAL(10,2),
+  importoDb          DECIMAL(10,2),
+  CONSTRAINT fk_anomalia_riconciliazione
+    FOREIGN KEY (idRiconciliazione) REFERENCES RICONCILIAZIONE(idRiconciliazione)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_anomalia_riconciliazione_tipo ON ANOMALIA_RICONCILIAZIONE(idRiconciliazione, tipo);
 
 -- =========================
 -- LOGISTICA
@@ -190,7 +272,8 @@ CREATE INDEX idx_pagamento_ordine_data ON PAGAMENTO(idOrdine, dataOra);
 CREATE TABLE CORRIERE (
   idCorriere    INT AUTO_INCREMENT PRIMARY KEY,
   nome          VARCHAR(80) NOT NULL,
-  customerCare  VARCHAR(120)
+  customerCare  VARCHAR(120),
+  CONSTRAINT uq_corriere_nome UNIQUE (nome)
 ) ENGINE=InnoDB;
 
 CREATE TABLE SPEDIZIONE (
@@ -201,6 +284,7 @@ CREATE TABLE SPEDIZIONE (
   statoSpedizione       ENUM('PREPARAZIONE','IN_TRANSITO','CONSEGNATA','PROBLEMA') NOT NULL,
   dataSpedizione        DATETIME NOT NULL,
   dataStimataConsegna   DATE,
+  dataUltimoAggiornamento DATETIME,
   CONSTRAINT fk_spedizione_ordine
     FOREIGN KEY (idOrdine) REFERENCES ORDINE(idOrdine)
     ON DELETE CASCADE ON UPDATE CASCADE,
@@ -213,6 +297,29 @@ CREATE TABLE SPEDIZIONE (
 CREATE INDEX idx_spedizione_ordine   ON SPEDIZIONE(idOrdine);
 CREATE INDEX idx_spedizione_corriere ON SPEDIZIONE(idCorriere);
 
+-- giorni di transito per corriere e provincia di destinazione; provincia '*' = tutte
+CREATE TABLE TEMPO_CONSEGNA (
+  idCorriere   INT NOT NULL,
+  provincia    VARCHAR(40) NOT NULL,
+  campioni     INT NOT NULL,
+  giorniP50    INT NOT NULL,
+  giorniP80    INT NOT NULL,
+  giorniP95    INT NOT NULL,
+  dataCalcolo  DATETIME NOT NULL,
+  PRIMARY KEY (idCorriere, provincia),
+  CONSTRAINT fk_tempoconsegna_corriere
+    FOREIGN KEY (idCorriere) REFERENCES CORRIERE(idCorriere)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE TABLE STAGING_TRACKING (
+  idLotto          VARCHAR(36) NOT NULL,
+  tracking         VARCHAR(80) NOT NULL,
+  statoSpedizione  ENUM('PREPARAZIONE','IN_TRANSITO','CONSEGNATA','PROBLEMA') NOT NULL,
+  dataEvento       DATETIME NOT NULL,
+  PRIMARY KEY (idLotto, tracking)
+) ENGINE=InnoDB;
+
 -- =========================
 -- INVENTARIO E FORNITORI
 -- =========================
@@ -268,6 +375,44 @@ CREATE TABLE FORNITURA_PRODOTTO (
 
 CREATE INDEX idx_fornitura_sku ON FORNITURA_PRODOTTO(sku);
 
+CREATE TABLE PROPOSTA_RIORDINO (
+  idProposta      INT AUTO_INCREMENT PRIMARY KEY,
+  idMagazzino     INT NOT NULL,
+  sku             VARCHAR(32) NOT NULL,
+  idFornitore     INT NOT NULL,
+  quantita        INT NOT NULL,
+  prezzoAcquisto  DECIMAL(10,2) NOT NULL,
+  costoTotale     DECIMAL(12,2) NOT NULL,
+  leadTimeGiorni  INT NOT NULL,
+  dataCreazione   DATETIME NOT NULL,
+  stato           ENUM('BOZZA','CONFERMATA','ANNULLATA') NOT NULL,
+  CONSTRAINT fk_propostariordino_magazzino
+    FOREIGN KEY (idMagazzino) REFERENCES MAGAZZINO(idMagazzino)
+    ON DELETE CASCADE ON UPDATE CASCADE,
+  CONSTRAINT fk_propostariordino_prodotto
+    FOREIGN KEY (sku) REFERENCES PRODOTTO(sku)
+    ON DELETE RESTRICT ON UPDATE CASCADE,
+  CONSTRAINT fk_propostariordino_fornitore
+    FOREIGN KEY (idFornitore) REFERENCES FORNITORE(idFornitore)
+    ON DELETE CASCADE ON UPDATE CASCADE,
+  CONSTRAINT ck_propostariordino_quantita_pos CHECK (quantita > 0)
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_propostariordino_stato         ON PROPOSTA_RIORDINO(stato);
+CREATE INDEX idx_propostariordino_magazzino_sku ON PROPOSTA_RIORDINO(idMagazzino, sku);
+
+CREATE TABLE DOMANDA_GIORNALIERA (
+  sku       VARCHAR(32) NOT NULL,
+  giorno    DATE NOT NULL,
+  quantita  INT NOT NULL,
+  PRIMARY KEY (sku, giorno),
+  CONSTRAINT fk_domandagiornaliera_prodotto
+    FOREIGN KEY (sku) REFERENCES PRODOTTO(sku)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_domandagiornaliera_giorno ON DOMANDA_GIORNALIERA(giorno);
+
 -- =========================
 -- COUPON, RECENSIONI, RESI
 -- =========================
@@ -335,6 +480,94 @@ CREATE TABLE RESO (
 
 CREATE INDEX idx_reso_stato ON RESO(statoReso);
 
+-- =========================
+-- ANALISI, JOB ED EVENTI (tabelle scritte dai comandi di app.py)
+-- =========================
+
+CREATE TABLE SEGMENTO_CLIENTE (
+  idCliente     INT PRIMARY KEY,
+  ultimoOrdine  DATETIME NOT NULL,
+  ordini        INT NOT NULL,
+  spesaTotale   DECIMAL(12,2) NOT NULL,
+  punteggioR    INT NOT NULL,
+  punteggioF    INT NOT NULL,
+  punteggioM    INT NOT NULL,
+  segmento      VARCHAR(20),
+  dataCalcolo   DATETIME NOT NULL,
+  CONSTRAINT fk_segmentocliente_cliente
+    FOREIGN KEY (idCliente) REFERENCES CLIENTE(idCliente)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_segmentocliente_segmento ON SEGMENTO_CLIENTE(segmento);
+
+CREATE TABLE COOCCORRENZA_PRODOTTO (
+  sku           VARCHAR(32) NOT NULL,
+  skuAssociato  VARCHAR(32) NOT NULL,
+  ordini        INT NOT NULL,
+  PRIMARY KEY (sku, skuAssociato),
+  CONSTRAINT fk_cooccorrenza_prodotto
+    FOREIGN KEY (sku) REFERENCES PRODOTTO(sku)
+    ON DELETE CASCADE ON UPDATE CASCADE,
+  CONSTRAINT fk_cooccorrenza_associato
+    FOREIGN KEY (skuAssociato) REFERENCES PRODOTTO(sku)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+CREATE TABLE CONSIGLIO_PRODOTTO (
+  sku             VARCHAR(32) NOT NULL,
+  posizione       INT NOT NULL,
+  skuConsigliato  VARCHAR(32) NOT NULL,
+  ordiniInsieme   INT NOT NULL,
+  confidenza      DECIMAL(5,4) NOT NULL,
+  PRIMARY KEY (sku, posizione),
+  CONSTRAINT fk_consiglio_prodotto
+    FOREIGN KEY (sku) REFERENCES PRODOTTO(sku)
+    ON DELETE CASCADE ON UPDATE CASCADE,
+  CONSTRAINT fk_consiglio_consigliato
+    FOREIGN KEY (skuConsigliato) REFERENCES PRODOTTO(sku)
+    ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+-- watermark dei job incrementali
+CREATE TABLE STATO_JOB (
+  nomeJob         VARCHAR(60) PRIMARY KEY,
+  ultimaData      DATETIME,
+  ultimoId        INT,
+  dataEsecuzione  DATETIME NOT NULL
+) ENGINE=InnoDB;
+
+-- contatori di versione per la cache dei report (incrementati dalle scritture)
+CREATE TABLE VERSIONE_TABELLA (
+  nomeTabella  VARCHAR(64) PRIMARY KEY,
+  versione     INT NOT NULL DEFAULT 0
+) ENGINE=InnoDB;
+
+-- outbox transazionale: eventi scritti nella stessa transazione della modifica
+CREATE TABLE EVENTO_OUTBOX (
+  idEvento    INT AUTO_INCREMENT PRIMARY KEY,
+  aggregato   VARCHAR(20) NOT NULL,
+  chiave      VARCHAR(80) NOT NULL,
+  tipoEvento  VARCHAR(40) NOT NULL,
+  payload     TEXT NOT NULL,
+  dataEvento  DATETIME NOT NULL
+) ENGINE=InnoDB;
+
+CREATE INDEX idx_outbox_aggregato_chiave ON EVENTO_OUTBOX(aggregato, chiave, idEvento);
+
+CREATE TABLE AUDIT_CANCELLAZIONE (
+  idAudit                INT AUTO_INCREMENT PRIMARY KEY,
+  dataEsecuzione         DATETIME NOT NULL,
+  richiesti              INT NOT NULL DEFAULT 0,
+  clientiCancellati      INT NOT NULL DEFAULT 0,
+  clientiAnonimizzati    INT NOT NULL DEFAULT 0,
+  indirizziCancellati    INT NOT NULL DEFAULT 0,
+  indirizziAnonimizzati  INT NOT NULL DEFAULT 0,
+  carrelli               INT NOT NULL DEFAULT 0,
+  vociCarrello           INT NOT NULL DEFAULT 0,
+  recensioni             INT NOT NULL DEFAULT 0
+) ENGINE=InnoDB;
+
 -- =========================
 -- DML: dati di esempio (minimi ma coerenti)
 -- =========================
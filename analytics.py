@@ -0,0 +1,383 @@
+from __future__ import annotations
+
+import enum
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Mapping, Sequence
+
+import numpy as np
+from sqlalchemy import Select, select
+from sqlalchemy.orm import Session
+
+from .models import (
+    Corriere, Ordine, OrdineCoupon, Recensione, RigaOrdine, Spedizione, StatoOrdine, StatoSpedizione
+)
+
+# tipi di colonna -> dtype su disco
+DTYPE = {
+    "int": np.dtype("<i8"),
+    "cents": np.dtype("<i8"),
+    "ts": np.dtype("<M8[s]"),
+    "date": np.dtype("<M8[D]"),
+    "dict": np.dtype("<i4"),
+}
+
+
+# ----------------------------
+# Definizione delle tabelle esportate
+# ----------------------------
+@dataclass(frozen=True)
+class _Spec:
+    nome: str
+    query: Select
+    pk: Any
+    colonne: tuple[tuple[str, str], ...]
+    # colonna di stato ancora modificabile finché non raggiunge uno stato finale
+    stato: tuple[str, Any] | None = None
+    terminali: tuple[str, ...] = ()
+
+TABELLE: tuple[_Spec, ...] = (
+    _Spec(
+        "ORDINE",
+        select(Ordine.idOrdine, Ordine.idCliente, Ordine.dataCreazione, Ordine.statoOrdine,
+               Ordine.totaleLordo, Ordine.totaleSconti, Ordine.totaleNetto),
+        Ordine.idOrdine,
+        (("idOrdine", "int"), ("idCliente", "int"), ("dataCreazione", "ts"), ("statoOrdine", "dict"),
+         ("totaleLordo", "cents"), ("totaleSconti", "cents"), ("totaleNetto", "cents")),
+        stato=("statoOrdine", Ordine.statoOrdine),
+        terminali=(StatoOrdine.CONSEGNATO.value, StatoOrdine.ANNULLATO.value),
+    ),
+    _Spec(
+        "RIGA_ORDINE",
+        select(RigaOrdine.idRigaOrdine, RigaOrdine.idOrdine, RigaOrdine.sku, RigaOrdine.quantita,
+               RigaOrdine.prezzoUnitarioApplicato, RigaOrdine.scontoRiga),
+        RigaOrdine.idRigaOrdine,
+        (("idRigaOrdine", "int"), ("idOrdine", "int"), ("sku", "dict"), ("quantita", "int"),
+         ("prezzoUnitarioApplicato", "cents"), ("scontoRiga", "cents")),
+    ),
+    _Spec(
+        "SPEDIZIONE",
+        # niente tracking: è univoco per spedizione, come dizionario crescerebbe quanto la tabella
+        select(Spedizione.idSpedizione, Spedizione.idOrdine, Corriere.nome,
+               Spedizione.statoSpedizione, Spedizione.dataSpedizione)
+        .join(Corriere, Corriere.idCorriere == Spedizione.idCorriere),
+        Spedizione.idSpedizione,
+        (("idSpedizione", "int"), ("idOrdine", "int"), ("corriere", "dict"),
+         ("statoSpedizione", "dict"), ("dataSpedizione", "ts")),
+        stato=("statoSpedizione", Spedizione.statoSpedizione),
+        terminali=(StatoSpedizione.CONSEGNATA.value,),
+    ),
+    _Spec(
+        "ORDINE_COUPON",
+        select(OrdineCoupon.idOrdine, OrdineCoupon.codiceCoupon, OrdineCoupon.dataApplicazione,
+               OrdineCoupon.importoScontoCalcolato),
+        OrdineCoupon.idOrdine,
+        (("idOrdine", "int"), ("codiceCoupon", "dict"), ("dataApplicazione", "ts"),
+         ("importoScontoCalcolato", "cents")),
+    ),
+    _Spec(
+        "RECENSIONE",
+        select(Recensione.idRecensione, Recensione.idCliente, Recensione.sku, Recensione.voto, Recensione.dataRecensione),
+        Recensione.idRecensione,
+        (("idRecensione", "int"), ("idCliente", "int"), ("sku", "dict"), ("voto", "int"), ("dataRecensione", "date")),
+    ),
+)
+
+
+def _valore(v: Any, tipo: str) -> Any:
+    if isinstance(v, enum.Enum):
+        v = v.value
+    if tipo == "cents":
+        return int((Decimal(str(v)) * 100).to_integral_value())
+    if tipo == "ts":
+        return np.datetime64(v, "s")
+    if tipo == "date":
+        return np.datetime64(v, "D")
+    return v
+
+
+# ----------------------------
+# Frame colonnare e API di interrogazione
+# ----------------------------
+@dataclass
+class Frame:
+    """Insieme di colonne NumPy di pari lunghezza; le colonne "dict" contengono codici."""
+    colonne: dict[str, np.ndarray]
+    tipi: dict[str, str]
+    dizionari: dict[str, list[str]] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.colonne.values()))) if self.colonne else 0
+
+    def __getitem__(self, nome: str) -> np.ndarray:
+        return self.colonne[nome]
+
+    def codice(self, colonna: str, valore: str) -> int:
+        # -1 se il valore non compare mai: nessuna riga corrisponde
+        try:
+            return self.dizionari[colonna].index(valore)
+        except ValueError:
+            return -1
+
+    def eq(self, colonna: str, valore: Any) -> np.ndarray:
+        if self.tipi[colonna] == "dict":
+            return self.colonne[colonna] == self.codice(colonna, valore)
+        return self.colonne[colonna] == _valore(valore, self.tipi[colonna])
+
+    def tra(self, colonna: str, dal: Any, al: Any) -> np.ndarray:
+        tipo = self.tipi[colonna]
+        c = self.colonne[colonna]
+        return (c >= _valore(dal, tipo)) & (c <= _valore(al, tipo))
+
+    def filtra(self, maschera: np.ndarray) -> Frame:
+        return Frame({k: np.asarray(v[maschera]) for k, v in self.colonne.items()}, self.tipi, self.dizionari)
+
+    def ordina(self, colonna: str, decrescente: bool = False) -> Frame:
+        idx = np.argsort(self.colonne[colonna], kind="stable")
+        return self.filtra(idx[::-1] if decrescente else idx)
+
+    def join(self, altro: Frame, chiave: str, chiave_altro: str | None = None, colonne: Sequence[str] | None = None) -> Frame:
+        """Inner join su chiave intera; la chiave di `altro` deve essere univoca."""
+        chiave_altro = chiave_altro or chiave
+        destra = altro.colonne[chiave_altro]
+        ordine = np.argsort(destra, kind="stable")
+        chiavi_ordinate = destra[ordine]
+        sinistra = self.colonne[chiave]
+        if len(chiavi_ordinate):
+            pos = np.minimum(np.searchsorted(chiavi_ordinate, sinistra), len(chiavi_ordinate) - 1)
+            trovato = chiavi_ordinate[pos] == sinistra
+        else:
+            pos = np.zeros(len(sinistra), dtype=np.int64)
+            trovato = np.zeros(len(sinistra), dtype=bool)
+        righe_altro = ordine[pos[trovato]]
+
+        out = {k: np.asarray(v[trovato]) for k, v in self.colonne.items()}
+        tipi, dizionari = dict(self.tipi), dict(self.dizionari)
+        for nome in colonne or [c for c in altro.colonne if c != chiave_altro]:
+            dest = nome if nome not in out else f"{nome}_{chiave_altro}"
+            out[dest] = np.asarray(altro.colonne[nome][righe_altro])
+            tipi[dest] = altro.tipi[nome]
+            if nome in altro.dizionari:
+                dizionari[dest] = altro.dizionari[nome]
+        return Frame(out, tipi, dizionari)
+
+    def group_by(self, chiavi: Sequence[str], aggregati: Mapping[str, tuple[str | None, str]]) -> Frame:
+        """aggregati: nome -> (colonna, funzione) con funzione in sum/count/mean/min/max."""
+        chiavi_int = np.stack([self.colonne[k].astype(np.int64) for k in chiavi], axis=1)
+        gruppi, inv = np.unique(chiavi_int.reshape(-1, len(chiavi)), axis=0, return_inverse=True)
+        inv = inv.reshape(-1)
+        g = len(gruppi)
+        out = {k: gruppi[:, i].astype(self.colonne[k].dtype) for i, k in enumerate(chiavi)}
+        tipi = {k: self.tipi[k] for k in chiavi}
+        conteggi = np.bincount(inv, minlength=g)
+        dizionari = {k: v for k, v in self.dizionari.items() if k in chiavi}
+        for nome, (col, fn) in aggregati.items():
+            if fn == "count":
+                out[nome], tipi[nome] = conteggi, "int"
+                continue
+            valori = self.colonne[col].astype(np.int64)
+            tipi[nome] = self.tipi[col] if fn != "mean" else "float"
+            if fn == "sum":
+                res = np.zeros(g, dtype=np.int64)
+                np.add.at(res, inv, valori)
+            elif fn == "mean":
+                res = np.bincount(inv, weights=valori, minlength=g) / conteggi
+                if self.tipi[col] == "cents":
+                    res = res / 100
+            elif fn == "min":
+                res = np.full(g, np.iinfo(np.int64).max)
+                np.minimum.at(res, inv, valori)
+            elif fn == "max":
+                res = np.full(g, np.iinfo(np.int64).min)
+                np.maximum.at(res, inv, valori)
+            else:
+                raise ValueError(f"Aggregato non supportato: {fn}")
+            if tipi[nome] in DTYPE:
+                res = res.astype(DTYPE[tipi[nome]])
+            if tipi[nome] == "dict":
+                dizionari[nome] = self.dizionari[col]
+            out[nome] = res
+        return Frame(out, tipi, dizionari)
+
+    def righe(self) -> list[dict[str, Any]]:
+        """Decodifica in dizionari Python (codici -> stringhe, centesimi -> Decimal)."""
+        decod: dict[str, list[Any]] = {}
+        for nome, col in self.colonne.items():
+            tipo = self.tipi[nome]
+            if tipo == "dict":
+                diz = self.dizionari[nome]
+                decod[nome] = [diz[int(c)] for c in col]
+            elif tipo == "cents":
+                decod[nome] = [Decimal(int(c)).scaleb(-2) for c in col]
+            elif tipo == "ts":
+                decod[nome] = [c.astype(datetime) for c in col]
+            elif tipo == "date":
+                decod[nome] = [c.astype(date) for c in col]
+            else:
+                decod[nome] = col.tolist()
+        return [dict(zip(decod, r)) for r in zip(*decod.values())]
+
+
+# ----------------------------
+# Snapshot su disco: una cartella per tabella, un file .bin per colonna
+# ----------------------------
+class Snapshot:
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        meta = self.path / "meta.json"
+        self.meta: dict[str, Any] = json.loads(meta.read_text(encoding="utf-8")) if meta.exists() else {"tabelle": {}}
+
+    def tabella(self, nome: str) -> Frame:
+        """Colonne memory-mapped in sola lettura."""
+        info = self.meta["tabelle"].get(nome)
+        if not info or info["righe"] == 0:
+            spec = next(s for s in TABELLE if s.nome == nome)
+            return Frame({c: np.zeros(0, DTYPE[t]) for c, t in spec.colonne}, dict(spec.colonne),
+                         {c: [] for c, t in spec.colonne if t == "dict"})
+        cols = {
+            c: np.memmap(self.path / nome / f"{c}.bin", dtype=DTYPE[t], mode="r", shape=(info["righe"],))
+            for c, t in info["tipi"].items()
+        }
+        return Frame(cols, dict(info["tipi"]), {c: list(d) for c, d in info["dizionari"].items()})
+
+    def _salva_meta(self) -> None:
+        tmp = self.path / "meta.json.tmp"
+        tmp.write_text(json.dumps(self.meta, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path / "meta.json")
+
+
+@dataclass
+class EsitoSnapshot:
+    nuove: dict[str, int]
+    aggiornate: dict[str, int]
+
+
+def _append(
+    snap: Snapshot, spec: _Spec, info: dict[str, Any], indici: dict[str, dict[Any, int]], righe: list[Sequence[Any]]
+) -> None:
+    """`indici`: valore -> codice per le colonne "dict", costruiti una volta per refresh."""
+    cartella = snap.path / spec.nome
+    for i, (nome, tipo) in enumerate(spec.colonne):
+        if tipo == "dict":
+            diz = info["dizionari"][nome]
+            indice = indici[nome]
+            valori = []
+            for r in righe:
+                v = _valore(r[i], tipo)
+                if v not in indice:
+                    indice[v] = len(diz)
+                    diz.append(v)
+                valori.append(indice[v])
+        else:
+            valori = [_valore(r[i], tipo) for r in righe]
+        with open(cartella / f"{nome}.bin", "ab") as f:
+            f.write(np.asarray(valori, dtype=DTYPE[tipo]).tobytes())
+    info["righe"] += len(righe)
+
+def _aggiorna_stati(session: Session, snap: Snapshot, spec: _Spec, info: dict[str, Any], chunk_size: int) -> int:
+    """Riallinea la colonna di stato delle righe non ancora in uno stato finale."""
+    nome_stato, col_stato = spec.stato
+    n = info["righe"]
+    if n == 0:
+        return 0
+    diz = info["dizionari"][nome_stato]
+    cartella = snap.path / spec.nome
+    pk_nome = spec.colonne[0][0]
+    ids = np.memmap(cartella / f"{pk_nome}.bin", dtype=DTYPE["int"], mode="r", shape=(n,))
+    stati = np.memmap(cartella / f"{nome_stato}.bin", dtype=DTYPE["dict"], mode="r+", shape=(n,))
+    finali = [diz.index(t) for t in spec.terminali if t in diz]
+    aperti = np.flatnonzero(~np.isin(stati, finali))
+
+    cambiati = 0
+    for start in range(0, len(aperti), chunk_size):
+        pos = aperti[start:start + chunk_size]
+        correnti = dict(session.execute(
+            select(spec.pk, col_stato).where(spec.pk.in_(ids[pos].tolist()))
+        ).all())
+        for p in pos:
+            v = correnti.get(int(ids[p]))
+            if v is None:
+                continue
+            v = _valore(v, "dict")
+            if v not in diz:
+                diz.append(v)
+            codice = diz.index(v)
+            if stati[p] != codice:
+                stati[p] = codice
+                cambiati += 1
+    stati.flush()
+    return cambiati
+
+def refresh(session: Session, path: str | Path, completo: bool = False, chunk_size: int = 10000) -> EsitoSnapshot:
+    """Aggiunge le righe con pk oltre l'ultimo watermark e aggiorna gli stati aperti.
+
+    Con `completo` la snapshot viene ricostruita da zero (utile dopo cancellazioni).
+    """
+    snap = Snapshot(path)
+    if completo:
+        snap.meta = {"tabelle": {}}
+    esito = EsitoSnapshot({}, {})
+
+    for spec in TABELLE:
+        cartella = snap.path / spec.nome
+        cartella.mkdir(parents=True, exist_ok=True)
+        info = snap.meta["tabelle"].get(spec.nome)
+        if info is not None and info["tipi"] != dict(spec.colonne):
+            # colonne cambiate rispetto alla snapshot su disco: la tabella si ricostruisce
+            for f in cartella.glob("*.bin"):
+                f.unlink()
+            info = None
+        if info is None:
+            info = {"righe": 0, "ultimoId": 0, "tipi": dict(spec.colonne),
+                    "dizionari": {c: [] for c, t in spec.colonne if t == "dict"}}
+            snap.meta["tabelle"][spec.nome] = info
+
+        # scarta code scritte da un refresh interrotto prima di aggiornare meta.json
+        for nome, tipo in spec.colonne:
+            with open(cartella / f"{nome}.bin", "ab") as f:
+                f.truncate(info["righe"] * DTYPE[tipo].itemsize)
+
+        esito.aggiornate[spec.nome] = (
+            _aggiorna_stati(session, snap, spec, info, chunk_size) if spec.stato else 0
+        )
+
+        indici = {c: {v: k for k, v in enumerate(d)} for c, d in info["dizionari"].items()}
+        q = spec.query.where(spec.pk > info["ultimoId"]).order_by(spec.pk).execution_options(yield_per=chunk_size)
+        nuove = 0
+        for righe in session.execute(q).partitions():
+            _append(snap, spec, info, indici, righe)
+            info["ultimoId"] = int(righe[-1][0])
+            nuove += len(righe)
+        esito.nuove[spec.nome] = nuove
+
+    snap._salva_meta()
+    return esito
+
+
+# ----------------------------
+# Aggregazioni analitiche (equivalenti in-process dei report)
+# ----------------------------
+def spedizioni_corriere_periodo(snap: Snapshot, nome_corriere: str, dal: datetime, al: datetime) -> Frame:
+    """Come q_spedizioni_corriere_periodo, con idCliente al posto dell'email."""
+    sped = snap.tabella("SPEDIZIONE")
+    sped = sped.filtra(sped.eq("corriere", nome_corriere) & sped.tra("dataSpedizione", dal, al))
+    return sped.join(snap.tabella("ORDINE"), "idOrdine", colonne=["idCliente"]).ordina("dataSpedizione", decrescente=True)
+
+def spedizioni_per_corriere(snap: Snapshot, dal: datetime, al: datetime) -> Frame:
+    sped = snap.tabella("SPEDIZIONE")
+    sped = sped.filtra(sped.tra("dataSpedizione", dal, al))
+    return sped.group_by(["corriere", "statoSpedizione"], {"spedizioni": (None, "count")})
+
+def clienti_che_hanno_usato_coupon(snap: Snapshot, codice: str) -> Frame:
+    """Come q_clienti_che_hanno_usato_coupon, con idCliente al posto dell'email."""
+    oc = snap.tabella("ORDINE_COUPON")
+    oc = oc.filtra(oc.eq("codiceCoupon", codice))
+    return oc.join(snap.tabella("ORDINE"), "idOrdine", colonne=["idCliente"]).ordina("dataApplicazione", decrescente=True)
+
+def utilizzo_coupon(snap: Snapshot) -> Frame:
+    oc = snap.tabella("ORDINE_COUPON")
+    return oc.group_by(["codiceCoupon"], {"ordini": (None, "count"), "sconto": ("importoScontoCalcolato", "sum")})
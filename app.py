@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 import argparse
+import csv
+import json
+from dataclasses import asdict
+from datetime import datetime
+from decimal import Decimal
 from pathlib import Path
 
 from glowhub.db import make_engine, get_session
 from glowhub.models import Base, IndirizzoTipo, EsitoPagamento, StatoSpedizione
-from glowhub import crud, queries
+from glowhub import crud, queries, tracking, reorder, demand, sweeper, repricing, erasure, loaders, pricing, loadtest, bootstrap, outbox, analytics, returns, reportcache, dashboard, metrics, fulfillment, recommend, segments, delivery, reconcile, schema
 from glowhub.seed import seed_all
 
 
@@ -14,6 +19,12 @@ def cmd_init_db(_args):
     Base.metadata.create_all(engine)
     print("✅ Tabelle create (ORM).")
 
+def cmd_upgrade_db(_args):
+    r = schema.upgrade(make_engine())
+    print(f"✅ Schema aggiornato: tabelle create={len(r.tabelle_create)} passi applicati={len(r.passi)}")
+    for passo in r.passi:
+        print(f"   - {passo}")
+
 def cmd_drop_db(_args):
     engine = make_engine()
     Base.metadata.drop_all(engine)
@@ -129,12 +140,333 @@ def cmd_remove_from_cart(args):
         crud.remove_from_cart(session, args.id_cliente, args.sku)
         print(f"✅ Rimosso dal carrello: idCliente={args.id_cliente}, sku={args.sku}")
 
+def cmd_ingest_tracking(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        tot_sped = tot_ord = 0
+        for r in tracking.ingest_file(session, args.file, args.chunk_size):
+            tot_sped += r.spedizioni_aggiornate
+            tot_ord += r.ordini_aggiornati
+            print(f"chunk {r.chunk}: lette={r.righe_lette} scartate={r.righe_scartate} "
+                  f"spedizioni={r.spedizioni_aggiornate} ordini={r.ordini_aggiornati}")
+        print(f"✅ Feed tracking importato: spedizioni aggiornate={tot_sped}, ordini aggiornati={tot_ord}")
+
+def cmd_plan_reorders(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        piano = reorder.plan_reorders(session, args.copertura)
+        print(f"✅ Piano riordini: proposte={piano.proposte} costo={piano.costo_totale} "
+              f"sotto_soglia={piano.sotto_soglia} senza_fornitore={piano.senza_fornitore}")
+
+def cmd_update_thresholds(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        r = demand.update_soglie(session, args.finestra, args.z, args.lead_default)
+        print(f"✅ Soglie di riordino aggiornate: scorte={r.scorte_aggiornate} "
+              f"(nuovi giorni={r.giorni_aggiunti}, righe domanda={r.righe_domanda})")
+
+def cmd_sweep_carts(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        rep = sweeper.sweep_carts(
+            session,
+            giorni_inattivita=args.giorni,
+            batch_size=args.batch_size,
+            archivia=args.archivia,
+            pausa=args.pausa,
+        )
+        azione = "archiviate" if args.archivia else "eliminate"
+        print(f"✅ Carrelli inattivi svuotati: carrelli={rep.carrelli} voci {azione}={rep.voci} "
+              f"batch={rep.batch} tempo={rep.secondi:.2f}s ({rep.voci_al_secondo:.0f} voci/s)")
+
+def cmd_bulk_reprice(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        if args.file:
+            with open(args.file, newline="", encoding="utf-8") as f:
+                prezzi = {r[0].strip(): r[1].strip() for r in csv.reader(f) if r and r[0].strip().lower() != "sku"}
+            rep = repricing.reprice_assoluto(session, prezzi, args.aggiorna_carrelli)
+        else:
+            rep = repricing.reprice_percentuale(
+                session, args.percentuale, args.brand, args.id_categoria, args.sku or None, args.aggiorna_carrelli
+            )
+        print(f"✅ Prezzi aggiornati: prodotti={rep.prodotti} voci carrello={rep.voci_carrello} chunk={rep.chunk}")
+
+def cmd_erase_clients(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        with open(args.file, encoding="utf-8") as f:
+            ids = erasure.resolve_ids(session, f)
+        tot = erasure.ErasureReport()
+        for rep in erasure.erase_clienti(session, ids, args.chunk_size):
+            tot.add(rep)
+        print(f"✅ Clienti trattati={tot.richiesti}: cancellati={tot.clientiCancellati} "
+              f"anonimizzati={tot.clientiAnonimizzati} indirizzi cancellati={tot.indirizziCancellati} "
+              f"indirizzi anonimizzati={tot.indirizziAnonimizzati} carrelli={tot.carrelli} "
+              f"voci carrello={tot.vociCarrello} recensioni={tot.recensioni}")
+
+def cmd_show_order(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        ordini = loaders.load_ordine_completo(session, args.id_ordine)
+        print(json.dumps([asdict(o) for o in ordini], default=str, indent=2, ensure_ascii=False))
+
+def cmd_show_client(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        clienti = loaders.load_cliente_completo(session, args.id_cliente)
+        print(json.dumps([asdict(c) for c in clienti], default=str, indent=2, ensure_ascii=False))
+
+def cmd_quote(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        articoli = []
+        for a in args.articolo:
+            sku, _, q = a.partition(":")
+            articoli.append((sku, int(q or 1)))
+        p = pricing.quote(session, articoli, args.coupon)
+        print(json.dumps(asdict(p), default=str, indent=2, ensure_ascii=False))
+
+def cmd_price_carts(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        n = 0
+        totale = iva = Decimal("0.00")
+        for p in pricing.price_open_carts(session, chunk_size=args.chunk_size):
+            n += 1
+            totale += p.totaleNetto
+            iva += p.iva
+        print(f"✅ Carrelli aperti ricalcolati: {n} totale={totale} di cui IVA={iva}")
+
+def cmd_load_test(args):
+    r = loadtest.run_load(args.processi, args.clienti, args.durata, misura=bool(args.metrics_file))
+    print(f"✅ Load test: processi={r.processi} durata={r.secondi:.1f}s ordini={r.ordini} "
+          f"({r.throughput:.1f} ordini/s) carrelli vuoti={r.carrelli_vuoti} errori={r.errori}")
+    print(f"   tentativi={r.tentativi} retry lock={r.retry_lock} conflitti versione={r.conflitti} "
+          f"falliti={r.falliti} tasso conflitti={r.tasso_conflitti:.1%}")
+
+
+def cmd_load_sql(args):
+    engine = make_engine()
+    r = bootstrap.load_sql(engine, args.file, args.batch_size)
+    print(f"✅ Script caricato: istruzioni={r.istruzioni} eseguite={r.eseguite} saltate={r.saltate}")
+    if args.create_all:
+        u = schema.upgrade(engine)
+        print(f"✅ Schema allineato al modello ORM: tabelle create={len(u.tabelle_create)} passi applicati={len(u.passi)}")
+    # uno script di una versione precedente lascerebbe un DB su cui i comandi falliscono a metà
+    schema.verifica(engine)
+    print("✅ Schema coerente con il modello ORM.")
+
+
+def cmd_snapshot(args):
+    bootstrap.snapshot(make_engine(), args.file)
+    print(f"✅ Snapshot salvato in {args.file}")
+
+
+def cmd_restore(args):
+    bootstrap.restore(make_engine(), args.file)
+    print(f"✅ Database ripristinato da {args.file}")
+
+
+def cmd_outbox_consume(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+
+    def stampa(eventi):
+        for e in eventi:
+            print(json.dumps(asdict(e), default=str, ensure_ascii=False))
+
+    with get_session(engine) as session:
+        n = sum(outbox.consuma(session, args.consumatore, stampa, args.limite, args.ritardo))
+    print(f"✅ Eventi consumati da {args.consumatore}: {n}")
+
+
+def cmd_outbox_compact(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        r = outbox.compatta(session, per_chiave=not args.solo_consegnati)
+    print(f"✅ Outbox compattata: consegnati={r.consegnati} superati={r.superati}")
+
+
+def cmd_snapshot_analytics(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        r = analytics.refresh(session, args.dir, completo=args.completo)
+    for nome, n in r.nuove.items():
+        print(f"✅ {nome}: nuove righe={n} stati aggiornati={r.aggiornate[nome]}")
+
+
+def cmd_process_returns(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    tot = returns.ReturnsReport()
+    with get_session(engine) as session:
+        for r in returns.process_returns(session, args.chunk_size):
+            tot.add(r)
+            print(f"   chunk: resi={r.resi} rimborsato={r.importoRimborsato} pezzi={r.pezziRientrati}")
+    print(f"✅ Resi rimborsati: {tot.resi} importo={tot.importoRimborsato} pezzi rientrati={tot.pezziRientrati} "
+          f"senza magazzino={tot.senzaMagazzino}")
+
+
+def _report_param(v: str):
+    if v.isdigit():
+        return int(v)
+    try:
+        return datetime.fromisoformat(v)
+    except ValueError:
+        return v
+
+
+def cmd_report(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    params = [_report_param(v) for v in args.param]
+    with get_session(engine) as session:
+        cache = reportcache.get_report_cache(session)
+        for _ in range(args.ripeti):
+            righe = cache.run(session, args.nome, *params)
+    for row in righe:
+        print(row)
+    st = cache.stats
+    print(f"✅ {args.nome}: righe={len(righe)} hit={st.hit} miss={st.miss} invalidate={st.invalidate} "
+          f"scadute={st.scadute} hit rate={st.hit_rate:.0%}")
+
+
+def cmd_dashboard(args):
+    engine = make_engine()
+    reports = None
+    if args.report:
+        reports = []
+        for r in args.report:
+            nome, _, params = r.partition(":")
+            reports.append((nome, tuple(_report_param(v) for v in params.split(",") if v)))
+    doc = dashboard.run_dashboard(engine, reports, args.workers)
+    print(json.dumps(doc, default=str, ensure_ascii=False, indent=2))
+
+
+def cmd_import_clients(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+
+    def leggi():
+        with open(args.file, newline="", encoding="utf-8") as f:
+            for r in csv.DictReader(f):
+                campi = {k: (v.strip() or None) for k, v in r.items() if k and v is not None}
+                if campi.get("email") and campi.get("nome") and campi.get("cognome"):
+                    yield crud.NuovoCliente(**{k: v for k, v in campi.items() if k in crud.NuovoCliente.__dataclass_fields__})
+
+    with get_session(engine) as session:
+        r = crud.create_clienti_bulk(session, leggi(), args.chunk_size)
+    print(f"✅ Clienti importati: {r.inseriti} indirizzi={r.indirizzi} chunk={r.chunk} duplicati={len(r.duplicati)}")
+    for email in r.duplicati[:20]:
+        print(f"   duplicato: {email}")
+
+
+def cmd_metrics(args):
+    dati = metrics.leggi_dump(args.file)
+    if args.formato == "prometheus":
+        print(metrics.prometheus(dati), end="")
+    else:
+        print(json.dumps(metrics.riepilogo(dati), indent=2))
+
+
+def cmd_fulfillment_claim(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        lotto = fulfillment.claim(session, args.worker, args.limite, args.lease)
+    print(f"✅ Ordini presi in carico da {lotto.worker}: {lotto.ordini} (lease fino a {lotto.scadenza}, "
+          f"rimessi in coda per lease scaduto={lotto.rimessiInCoda})")
+
+def cmd_fulfillment_complete(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        s = fulfillment.completa(session, args.worker, args.id_ordine, args.corriere, args.tracking)
+    print(f"✅ Ordine {args.id_ordine} evaso: tracking={s.tracking}")
+
+def cmd_fulfillment_release(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        if args.scaduti:
+            n = fulfillment.rilascia_scaduti(session)
+        else:
+            n = fulfillment.rilascia(session, args.worker, args.id_ordine)
+    print(f"✅ Ordini rimessi in coda: {n}")
+
+def cmd_picking_test(args):
+    r = loadtest.run_picking(args.processi, args.durata, args.lotto, misura=bool(args.metrics_file))
+    print(f"✅ Picking test: processi={r.processi} durata={r.secondi:.1f}s lotti={r.lotti} evasi={r.evasi} "
+          f"({r.throughput:.1f} ordini/s) persi={r.persi} doppi={r.doppi} ancora in coda={r.rimasti}")
+    print(f"   tentativi={r.tentativi} retry lock={r.retry_lock}")
+
+
+def cmd_build_recommendations(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        r = recommend.build_index(session, args.top_k, args.completo, args.ritardo, args.chunk_size)
+    print(f"✅ Indice co-acquisti aggiornato: ordini={r.ordini} coppie={r.coppie} "
+          f"sku aggiornati={r.skuAggiornati} ordini saltati (troppi sku)={r.ordiniSaltati}")
+
+def cmd_recommend(args):
+    engine = make_engine()
+    with get_session(engine) as session:
+        skus = list(args.sku)
+        if args.id_cliente is not None:
+            skus += [v.sku for v in crud.get_carrello_cliente(session, args.id_cliente).voci]
+        if len(skus) == 1:
+            consigli = recommend.consigli(session, skus[0], args.limite)
+        else:
+            consigli = recommend.consigli_carrello(session, skus, args.limite)
+    print(json.dumps([asdict(c) for c in consigli], default=str, indent=2, ensure_ascii=False))
+
+
+def cmd_segment_customers(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        r = segments.segment_clienti(session, args.completo, args.ritardo, args.chunk_size)
+    print(f"✅ Segmenti RFM: clienti={r.clientiTotali} aggregati ricalcolati={r.clientiRicalcolati} "
+          f"punteggi cambiati={r.punteggiCambiati}")
+    for nome, n in r.perSegmento.items():
+        print(f"   {nome}: {n}")
+
+
+def cmd_train_delivery(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    with get_session(engine) as session:
+        r = delivery.train_tempi(session, args.finestra, args.min_campioni)
+    print(f"✅ Tempi di consegna aggiornati: spedizioni={r.spedizioni} corriere/provincia={r.gruppi} corrieri={r.corrieri}")
+
+
+def cmd_reconcile_payments(args):
+    engine = make_engine()
+    Base.metadata.create_all(engine)
+    dal = datetime.fromisoformat(args.dal) if args.dal else None
+    al = datetime.fromisoformat(args.al) if args.al else None
+    with get_session(engine) as session:
+        id_run, r = reconcile.reconcile(session, reconcile.leggi_csv(args.file), args.file, args.chunk_size, dal, al)
+    print(f"✅ Riconciliazione {id_run}: righe={r.righe} confermati={r.confermati} ordini pagati={r.ordiniAggiornati}")
+    print(f"   anomalie: mancanti in db={r.mancantiInDb} mancanti nel file={r.mancantiNelFile} duplicati={r.duplicati} "
+          f"importo diverso={r.importoDiverso} esito diverso={r.esitoDiverso} non valide={r.nonValide}")
+
 
 def build_parser():
     p = argparse.ArgumentParser(prog="glowhub", description="GlowHub - SQLAlchemy ORM (E-tivity 4)")
+    p.add_argument("--metrics-file", dest="metrics_file", help="misura crud/report e scrive il dump delle metriche in questo file")
+    p.add_argument("--metrics-intervallo", type=float, default=0.0, dest="metrics_intervallo",
+                   help="secondi fra due dump (comandi lunghi); 0 = solo a fine comando")
     sub = p.add_subparsers(dest="cmd", required=True)
 
     sub.add_parser("init-db").set_defaults(func=cmd_init_db)
+    sub.add_parser("upgrade-db").set_defaults(func=cmd_upgrade_db)
     sub.add_parser("drop-db").set_defaults(func=cmd_drop_db)
     sub.add_parser("seed").set_defaults(func=cmd_seed)
     sub.add_parser("demo").set_defaults(func=cmd_demo)
@@ -218,12 +550,193 @@ def build_parser():
     sp.add_argument("--sku", required=True)
     sp.set_defaults(func=cmd_remove_from_cart)
 
+    sp = sub.add_parser("ingest-tracking")
+    sp.add_argument("--file", required=True)
+    sp.add_argument("--chunk-size", type=int, default=5000, dest="chunk_size")
+    sp.set_defaults(func=cmd_ingest_tracking)
+
+    sp = sub.add_parser("plan-reorders")
+    sp.add_argument("--copertura", type=float, default=2.0, help="livello obiettivo = soglia * copertura")
+    sp.set_defaults(func=cmd_plan_reorders)
+
+    sp = sub.add_parser("update-thresholds")
+    sp.add_argument("--finestra", type=int, default=28, help="giorni della media mobile")
+    sp.add_argument("--z", type=float, default=1.65, help="fattore di sicurezza")
+    sp.add_argument("--lead-default", type=int, default=7, dest="lead_default")
+    sp.set_defaults(func=cmd_update_thresholds)
+
+    sp = sub.add_parser("sweep-carts")
+    sp.add_argument("--giorni", type=int, default=30, help="giorni di inattività del carrello")
+    sp.add_argument("--batch-size", type=int, default=500, dest="batch_size")
+    sp.add_argument("--archivia", action="store_true", help="copia le voci in VOCE_CARRELLO_ARCHIVIO prima di eliminarle")
+    sp.add_argument("--pausa", type=float, default=0.0, help="secondi di attesa fra un batch e l'altro")
+    sp.set_defaults(func=cmd_sweep_carts)
+
+    sp = sub.add_parser("bulk-reprice")
+    g = sp.add_mutually_exclusive_group(required=True)
+    g.add_argument("--file", help="CSV sku,prezzo con prezzi assoluti")
+    g.add_argument("--percentuale", type=float, help="variazione percentuale, es. -20")
+    sp.add_argument("--brand")
+    sp.add_argument("--id-categoria", type=int, dest="id_categoria", help="include le sottocategorie")
+    sp.add_argument("--sku", action="append")
+    sp.add_argument("--aggiorna-carrelli", action="store_true", dest="aggiorna_carrelli")
+    sp.set_defaults(func=cmd_bulk_reprice)
+
+    sp = sub.add_parser("erase-clients")
+    sp.add_argument("--file", required=True, help="un idCliente o una email per riga")
+    sp.add_argument("--chunk-size", type=int, default=500, dest="chunk_size")
+    sp.set_defaults(func=cmd_erase_clients)
+
+    sp = sub.add_parser("show-order")
+    sp.add_argument("--id-ordine", type=int, nargs="+", required=True, dest="id_ordine")
+    sp.set_defaults(func=cmd_show_order)
+
+    sp = sub.add_parser("show-client")
+    sp.add_argument("--id-cliente", type=int, nargs="+", required=True, dest="id_cliente")
+    sp.set_defaults(func=cmd_show_client)
+
+    sp = sub.add_parser("quote")
+    sp.add_argument("--articolo", action="append", required=True, help="sku:quantita (ripetibile)")
+    sp.add_argument("--coupon")
+    sp.set_defaults(func=cmd_quote)
+
+    sp = sub.add_parser("price-carts")
+    sp.add_argument("--chunk-size", type=int, default=2000, dest="chunk_size")
+    sp.set_defaults(func=cmd_price_carts)
+
+    sp = sub.add_parser("load-test")
+    sp.add_argument("--processi", type=int, default=4)
+    sp.add_argument("--clienti", type=int, default=20, help="clienti condivisi fra i processi")
+    sp.add_argument("--durata", type=float, default=10.0, help="secondi")
+    sp.set_defaults(func=cmd_load_test)
+
+    sp = sub.add_parser("load-sql")
+    sp.add_argument("--file", required=True, help="script DDL/DML (es. GlowHub_E-tivity3_DDL_DML.sql)")
+    sp.add_argument("--batch-size", type=int, default=500, dest="batch_size", help="righe per INSERT multiriga")
+    sp.add_argument("--create-all", action="store_true", dest="create_all", help="aggiorna poi lo schema al modello ORM (come upgrade-db)")
+    sp.set_defaults(func=cmd_load_sql)
+
+    sp = sub.add_parser("snapshot")
+    sp.add_argument("--file", required=True)
+    sp.set_defaults(func=cmd_snapshot)
+
+    sp = sub.add_parser("restore")
+    sp.add_argument("--file", required=True)
+    sp.set_defaults(func=cmd_restore)
+
+    sp = sub.add_parser("outbox-consume")
+    sp.add_argument("--consumatore", required=True)
+    sp.add_argument("--limite", type=int, default=500, help="eventi per lotto")
+    sp.add_argument("--ritardo", type=float, default=0.0, help="secondi di margine (MySQL)")
+    sp.set_defaults(func=cmd_outbox_consume)
+
+    sp = sub.add_parser("outbox-compact")
+    sp.add_argument("--solo-consegnati", action="store_true", dest="solo_consegnati")
+    sp.set_defaults(func=cmd_outbox_compact)
+
+    sp = sub.add_parser("snapshot-analytics")
+    sp.add_argument("--dir", default="snapshot_analytics")
+    sp.add_argument("--completo", action="store_true", help="ricostruisce da zero invece dell'aggiornamento incrementale")
+    sp.set_defaults(func=cmd_snapshot_analytics)
+
+    sp = sub.add_parser("process-returns")
+    sp.add_argument("--chunk-size", type=int, default=500, dest="chunk_size")
+    sp.set_defaults(func=cmd_process_returns)
+
+    sp = sub.add_parser("report")
+    sp.add_argument("nome", choices=sorted(reportcache.REPORTS))
+    sp.add_argument("param", nargs="*", help="parametri del report (interi e date ISO convertiti)")
+    sp.add_argument("--ripeti", type=int, default=1)
+    sp.set_defaults(func=cmd_report)
+
+    sp = sub.add_parser("dashboard")
+    sp.add_argument("--report", action="append", help="nome[:param1,param2]; ripetibile (default: i sei report)")
+    sp.add_argument("--workers", type=int, default=8)
+    sp.set_defaults(func=cmd_dashboard)
+
+    sp = sub.add_parser("import-clients")
+    sp.add_argument("--file", required=True, help="CSV con intestazione email,nome,cognome[,via,civico,citta,cap,provincia,paese]")
+    sp.add_argument("--chunk-size", type=int, default=1000, dest="chunk_size")
+    sp.set_defaults(func=cmd_import_clients)
+
+    sp = sub.add_parser("metrics")
+    sp.add_argument("--file", required=True, help="dump scritto con --metrics-file")
+    sp.add_argument("--formato", choices=["json", "prometheus"], default="json")
+    sp.set_defaults(func=cmd_metrics)
+
+    sp = sub.add_parser("fulfillment-claim")
+    sp.add_argument("--worker", required=True)
+    sp.add_argument("--limite", type=int, default=10)
+    sp.add_argument("--lease", type=int, default=300, help="secondi di validità della presa in carico")
+    sp.set_defaults(func=cmd_fulfillment_claim)
+
+    sp = sub.add_parser("fulfillment-complete")
+    sp.add_argument("--worker", required=True)
+    sp.add_argument("--id-ordine", type=int, required=True, dest="id_ordine")
+    sp.add_argument("--corriere", required=True)
+    sp.add_argument("--tracking", required=True)
+    sp.set_defaults(func=cmd_fulfillment_complete)
+
+    sp = sub.add_parser("fulfillment-release")
+    g = sp.add_mutually_exclusive_group(required=True)
+    g.add_argument("--worker")
+    g.add_argument("--scaduti", action="store_true", help="rimette in coda tutti i lease scaduti")
+    sp.add_argument("--id-ordine", type=int, action="append", default=[], dest="id_ordine")
+    sp.set_defaults(func=cmd_fulfillment_release)
+
+    sp = sub.add_parser("picking-test")
+    sp.add_argument("--processi", type=int, default=4)
+    sp.add_argument("--durata", type=float, default=10.0, help="secondi massimi (si ferma a coda vuota)")
+    sp.add_argument("--lotto", type=int, default=10)
+    sp.set_defaults(func=cmd_picking_test)
+
+    sp = sub.add_parser("build-recommendations")
+    sp.add_argument("--top-k", type=int, default=10, dest="top_k")
+    sp.add_argument("--completo", action="store_true", help="ricostruisce l'indice da zero")
+    sp.add_argument("--ritardo", type=float, default=60.0, help="secondi: esclude gli ordini più recenti")
+    sp.add_argument("--chunk-size", type=int, default=5000, dest="chunk_size", help="ordini per transazione")
+    sp.set_defaults(func=cmd_build_recommendations)
+
+    sp = sub.add_parser("recommend")
+    sp.add_argument("--sku", action="append", default=[], help="ripetibile: con più sku consigli per il carrello")
+    sp.add_argument("--id-cliente", type=int, dest="id_cliente", help="usa gli sku del carrello del cliente")
+    sp.add_argument("--limite", type=int, default=5)
+    sp.set_defaults(func=cmd_recommend)
+
+    sp = sub.add_parser("segment-customers")
+    sp.add_argument("--completo", action="store_true", help="ricalcola gli aggregati di tutti i clienti")
+    sp.add_argument("--ritardo", type=float, default=60.0, help="secondi: esclude gli ordini più recenti")
+    sp.add_argument("--chunk-size", type=int, default=10000, dest="chunk_size")
+    sp.set_defaults(func=cmd_segment_customers)
+
+    sp = sub.add_parser("train-delivery")
+    sp.add_argument("--finestra", type=int, default=180, help="giorni di consegne concluse da considerare")
+    sp.add_argument("--min-campioni", type=int, default=20, dest="min_campioni",
+                    help="sotto questa soglia la provincia usa la stima del corriere su tutte le province")
+    sp.set_defaults(func=cmd_train_delivery)
+
+    sp = sub.add_parser("reconcile-payments")
+    sp.add_argument("--file", required=True, help="CSV di settlement: transactionId,importo[,esito]")
+    sp.add_argument("--chunk-size", type=int, default=5000, dest="chunk_size")
+    sp.add_argument("--dal", help="inizio periodo (ISO) per i pagamenti assenti dal file; default: dal file")
+    sp.add_argument("--al", help="fine periodo (ISO) per i pagamenti assenti dal file; default: dal file")
+    sp.set_defaults(func=cmd_reconcile_payments)
+
     return p
 
 
 def main():
     parser = build_parser()
     args = parser.parse_args()
+    if args.metrics_file and args.func is not cmd_metrics:
+        metrics.instrument()
+        if args.metrics_intervallo > 0:
+            metrics.avvia_dump_periodico(args.metrics_file, args.metrics_intervallo)
+        try:
+            args.func(args)
+        finally:
+            metrics.dump(args.metrics_file)
+        return
     args.func(args)
 
 
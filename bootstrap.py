@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import re
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from sqlalchemy.engine import Engine
+
+
+@dataclass
+class LoadReport:
+    istruzioni: int = 0
+    eseguite: int = 0
+    saltate: int = 0
+
+
+# ----------------------------
+# Splitter di istruzioni SQL in streaming
+# ----------------------------
+def split_statements(lines: Iterable[str]) -> Iterator[str]:
+    """Divide uno script SQL in istruzioni leggendo riga per riga.
+
+    Gestisce stringhe con apici singoli/doppi/backtick (con escape '' e \\),
+    commenti `--`, `#` e `/* */` e la direttiva DELIMITER del client MySQL.
+    """
+    delim = ";"
+    buf: list[str] = []
+    quote: str | None = None
+    block_comment = False
+
+    for line in lines:
+        if quote is None and not block_comment and not "".join(buf).strip():
+            m = re.match(r"\s*DELIMITER\s+(\S+)\s*$", line, re.IGNORECASE)
+            if m:
+                delim = m.group(1)
+                continue
+
+        i, n = 0, len(line)
+        while i < n:
+            ch = line[i]
+            if block_comment:
+                if line.startswith("*/", i):
+                    block_comment = False
+                    i += 2
+                else:
+                    i += 1
+                continue
+            if quote:
+                buf.append(ch)
+                if ch == "\\" and quote != "`" and i + 1 < n:
+                    buf.append(line[i + 1])
+                    i += 2
+                    continue
+                if ch == quote:
+                    if i + 1 < n and line[i + 1] == quote:
+                        buf.append(line[i + 1])
+                        i += 2
+                        continue
+                    quote = None
+                i += 1
+                continue
+            if ch in ("'", '"', "`"):
+                quote = ch
+                buf.append(ch)
+                i += 1
+                continue
+            if line.startswith("--", i) or ch == "#":
+                break
+            if line.startswith("/*", i):
+                block_comment = True
+                i += 2
+                continue
+            if line.startswith(delim, i):
+                stmt = "".join(buf).strip()
+                if stmt:
+                    yield stmt
+                buf = []
+                i += len(delim)
+                continue
+            buf.append(ch)
+            i += 1
+        if buf and (quote or buf[-1] != "\n"):
+            buf.append("\n")
+
+    stmt = "".join(buf).strip()
+    if stmt:
+        yield stmt
+
+
+# ----------------------------
+# Adattamento minimo del DDL MySQL per SQLite
+# ----------------------------
+_SKIP_SQLITE = re.compile(r"^\s*(CREATE\s+DATABASE|DROP\s+DATABASE|USE\s)", re.IGNORECASE)
+_ENUM = re.compile(r"\bENUM\s*\((?:[^()']|'(?:[^']|'')*')*\)", re.IGNORECASE)
+_ENGINE = re.compile(r"\)\s*ENGINE\s*=\s*\w+[^;]*$", re.IGNORECASE)
+_AUTO_PK = re.compile(r"\bINT\s+AUTO_INCREMENT\s+PRIMARY\s+KEY\b", re.IGNORECASE)
+# DECIMAL ha affinità REAL in SQLite: l'uguaglianza esatta fra totali fallisce
+_CHECK_DIFF = re.compile(r"CHECK\s*\(\s*(\w+)\s*=\s*(\w+)\s*-\s*(\w+)\s*\)", re.IGNORECASE)
+
+def sqlite_compat(stmt: str) -> str | None:
+    """Riscrive i costrutti solo-MySQL dello script E-tivity 3; None = da saltare."""
+    if _SKIP_SQLITE.match(stmt):
+        return None
+    stmt = _AUTO_PK.sub("INTEGER PRIMARY KEY AUTOINCREMENT", stmt)
+    stmt = _ENUM.sub("VARCHAR(40)", stmt)
+    stmt = _CHECK_DIFF.sub(r"CHECK (ABS(\1 - (\2 - \3)) < 0.01)", stmt)
+    return _ENGINE.sub(")", stmt)
+
+
+# ----------------------------
+# Raggruppamento degli INSERT monoriga in INSERT multiriga
+# ----------------------------
+_INSERT = re.compile(r"^(INSERT\s+INTO\s+\S+\s*(?:\([^)]*\))?\s*VALUES)\s*(.*)$", re.IGNORECASE | re.DOTALL)
+
+def batch_inserts(statements: Iterable[str], batch_size: int = 500) -> Iterator[tuple[str, int]]:
+    """Unisce INSERT consecutivi con la stessa intestazione (tabella e colonne).
+
+    Restituisce coppie (istruzione, numero di istruzioni originali).
+    """
+    prefix: str | None = None
+    values: list[str] = []
+    count = 0
+    for stmt in statements:
+        m = _INSERT.match(stmt)
+        if m and m.group(1) == prefix and count < batch_size:
+            values.append(m.group(2))
+            count += 1
+            continue
+        if prefix is not None:
+            yield f"{prefix} {', '.join(values)}", count
+            prefix, values, count = None, [], 0
+        if m:
+            prefix, values, count = m.group(1), [m.group(2)], 1
+        else:
+            yield stmt, 1
+    if prefix is not None:
+        yield f"{prefix} {', '.join(values)}", count
+
+def load_sql(engine: Engine, path: str, batch_size: int = 500) -> LoadReport:
+    """Esegue uno script DDL/DML in un'unica transazione sul cursore DBAPI.
+
+    Su MySQL le istruzioni DDL causano comunque un commit implicito; il DML
+    resta atomico.
+    """
+    rep = LoadReport()
+    is_sqlite = engine.dialect.name == "sqlite"
+
+    def statements():
+        with open(path, encoding="utf-8") as f:
+            for stmt in split_statements(f):
+                rep.istruzioni += 1
+                if is_sqlite:
+                    stmt = sqlite_compat(stmt)
+                    if stmt is None:
+                        rep.saltate += 1
+                        continue
+                yield stmt
+
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            for stmt, n in batch_inserts(statements(), batch_size):
+                cursor.execute(stmt)
+                rep.eseguite += n
+        finally:
+            cursor.close()
+    return rep
+
+
+# ----------------------------
+# Snapshot / restore di database SQLite (backup API)
+# ----------------------------
+def _require_sqlite(engine: Engine) -> None:
+    if engine.dialect.name != "sqlite":
+        raise ValueError("snapshot/restore disponibili solo per SQLite")
+
+def snapshot(engine: Engine, path: str) -> None:
+    _require_sqlite(engine)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    dest = sqlite3.connect(path)
+    try:
+        with engine.connect() as conn:
+            conn.connection.driver_connection.backup(dest)
+    finally:
+        dest.close()
+
+def restore(engine: Engine, path: str) -> None:
+    _require_sqlite(engine)
+    if not Path(path).exists():
+        raise ValueError(f"Snapshot {path} non trovato")
+    # le connessioni in pool vedrebbero ancora lo schema precedente
+    engine.dispose()
+    src = sqlite3.connect(path)
+    try:
+        with engine.connect() as conn:
+            src.backup(conn.connection.driver_connection)
+    finally:
+        src.close()
+    engine.dispose()
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import functools
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+
+# codici MySQL: 1205 lock wait timeout, 1213 deadlock
+MYSQL_TRANSIENT = {1205, 1213}
+SQLITE_TRANSIENT = ("database is locked", "database table is locked", "database is busy")
+
+
+@dataclass
+class RetryStats:
+    chiamate: int = 0
+    tentativi: int = 0
+    retry_lock: int = 0
+    conflitti: int = 0
+    falliti: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def incr(self, **delta: int) -> None:
+        with self._lock:
+            for k, v in delta.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "chiamate": self.chiamate, "tentativi": self.tentativi, "retry_lock": self.retry_lock,
+                "conflitti": self.conflitti, "falliti": self.falliti,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.chiamate = self.tentativi = self.retry_lock = self.conflitti = self.falliti = 0
+
+
+STATS = RetryStats()
+
+
+class ConcurrencyError(RuntimeError):
+    """Tentativi esauriti per lock o conflitti di versione."""
+
+
+def is_transient(exc: BaseException) -> bool:
+    if not isinstance(exc, DBAPIError):
+        return False
+    orig = exc.orig
+    code = orig.args[0] if orig is not None and orig.args else None
+    if isinstance(code, int) and code in MYSQL_TRANSIENT:
+        return True
+    msg = str(orig).lower()
+    return any(m in msg for m in SQLITE_TRANSIENT)
+
+
+# ----------------------------
+# Retry con backoff esponenziale e jitter
+# ----------------------------
+def run_with_retry(fn, session, *args, max_tentativi: int = 6, base_delay: float = 0.02, max_delay: float = 1.0, **kwargs):
+    """Esegue fn(session, ...) ripetendola da capo dopo rollback su lock transitori
+    (SQLite "database is locked", deadlock/lock timeout MySQL) o su conflitto di
+    versione ottimistica (StaleDataError su CARRELLO/ORDINE)."""
+    STATS.incr(chiamate=1)
+    for tentativo in range(1, max_tentativi + 1):
+        STATS.incr(tentativi=1)
+        try:
+            # ogni tentativo legge stato fresco (la Session usa expire_on_commit=False)
+            session.flush()
+            session.expire_all()
+            return fn(session, *args, **kwargs)
+        except StaleDataError as exc:
+            session.rollback()
+            STATS.incr(conflitti=1)
+            errore = exc
+        except DBAPIError as exc:
+            if not is_transient(exc):
+                raise
+            session.rollback()
+            STATS.incr(retry_lock=1)
+            errore = exc
+        if tentativo < max_tentativi:
+            delay = min(max_delay, base_delay * (2 ** (tentativo - 1)))
+            time.sleep(random.uniform(0, delay))
+    STATS.incr(falliti=1)
+    raise ConcurrencyError(f"{fn.__name__}: tentativi esauriti ({max_tentativi})") from errore
+
+def retrying(fn=None, *, max_tentativi: int = 6, base_delay: float = 0.02):
+    """Decoratore per funzioni CRUD con firma fn(session, ...)."""
+    def wrap(f):
+        @functools.wraps(f)
+        def wrapper(session, *args, **kwargs):
+            return run_with_retry(f, session, *args, max_tentativi=max_tentativi, base_delay=base_delay, **kwargs)
+        return wrapper
+    return wrap(fn) if fn is not None else wrap
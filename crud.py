@@ -1,17 +1,26 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from datetime import date, datetime
 from decimal import Decimal
+from typing import Iterable
 
-from sqlalchemy import select
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-
+from sqlalchemy.orm.attributes import flag_modified
+
+from .concurrency import retrying
+from .delivery import stima_consegna
+from .outbox import emit_many, emit_ordine, emit_pagamento, emit_spedizione, evento_scorta
+from .pricing import price_carrelli
+from .refdata import get_refdata
+from .reportcache import bump
 from .models import (
     Cliente, Indirizzo, Categoria, Prodotto, Carrello, VoceCarrello,
     Ordine, RigaOrdine, MetodoPagamento, Pagamento, Corriere, Spedizione,
-    Magazzino, Scorta, Coupon, OrdineCoupon, Recensione, Reso,
-    IndirizzoTipo, StatoOrdine, EsitoPagamento, StatoSpedizione, CouponTipo, StatoReso
+    Magazzino, Scorta, Coupon, OrdineCoupon, Recensione, Reso, StoricoPrezzo,
+    IndirizzoTipo, StatoOrdine, EsitoPagamento, PagamentoTipo, StatoSpedizione, StatoReso
 )
 
 
@@ -21,6 +30,16 @@ def now_dt() -> datetime:
 def to_decimal(x) -> Decimal:
     return Decimal(str(x))
 
+def touch_carrello(cart: Carrello) -> None:
+    # forza l'UPDATE (e quindi il controllo di versione) anche a parità di timestamp
+    cart.dataUltimaModifica = now_dt()
+    flag_modified(cart, "dataUltimaModifica")
+
+def touch_ordine(ordine: Ordine, stato: StatoOrdine | None = None) -> None:
+    if stato is not None:
+        ordine.statoOrdine = stato
+    flag_modified(ordine, "statoOrdine")
+
 @dataclass
 class CheckoutResult:
     ordine_id: int
@@ -40,6 +59,7 @@ def create_cliente(session: Session, email: str, nome: str, cognome: str, data_r
     # crea carrello 1:1
     cart = Carrello(idCliente=c.idCliente, dataCreazione=now_dt(), dataUltimaModifica=now_dt())
     session.add(cart)
+    bump(session, Cliente, Carrello)
     session.commit()
     return c
 
@@ -60,6 +80,7 @@ def add_indirizzo(
         provincia=provincia, paese=paese, tipo=tipo, isDefault=is_default
     )
     session.add(a)
+    bump(session, Indirizzo)
     session.commit()
     return a
 
@@ -71,15 +92,120 @@ def delete_cliente(session: Session, id_cliente: int) -> None:
     if not c:
         return
     session.delete(c)
+    bump(session, Cliente, Indirizzo, Carrello, VoceCarrello, Recensione)
     session.commit()
 
 
+# ----------------------------
+# CLIENTI (import bulk: clienti + carrello + indirizzo di default)
+# ----------------------------
+@dataclass(frozen=True)
+class NuovoCliente:
+    email: str
+    nome: str
+    cognome: str
+    dataRegistrazione: date | None = None
+    # indirizzo di spedizione di default, creato se via/citta/paese sono presenti
+    via: str | None = None
+    civico: str | None = None
+    citta: str | None = None
+    cap: str | None = None
+    provincia: str | None = None
+    paese: str | None = None
+
+
+@dataclass
+class ImportClientiReport:
+    inseriti: int = 0
+    indirizzi: int = 0
+    chunk: int = 0
+    duplicati: list[str] = field(default_factory=list)
+
+
+def _insert_clienti_chunk(session: Session, nuovi: list[NuovoCliente]) -> list[str]:
+    """Inserisce un chunk; restituisce le email scartate perché già presenti."""
+    # le email del chunk sono già in minuscolo, quelle in tabella non per forza (create_cliente)
+    emails = [n.email for n in nuovi]
+    esistenti = set(session.scalars(select(func.lower(Cliente.email)).where(func.lower(Cliente.email).in_(emails))))
+    da_inserire = [n for n in nuovi if n.email not in esistenti]
+    scartati = [n.email for n in nuovi if n.email in esistenti]
+    if not da_inserire:
+        return scartati
+
+    oggi, adesso = date.today(), now_dt()
+    righe = [
+        {"email": n.email, "nome": n.nome, "cognome": n.cognome, "dataRegistrazione": n.dataRegistrazione or oggi}
+        for n in da_inserire
+    ]
+    if session.get_bind().dialect.insert_executemany_returning:
+        ids = {email: id_ for id_, email in session.execute(insert(Cliente).returning(Cliente.idCliente, Cliente.email), righe)}
+    else:
+        # MySQL: niente RETURNING, una SELECT per chunk sulle email appena inserite
+        session.execute(insert(Cliente), righe)
+        ids = dict(session.execute(
+            select(Cliente.email, Cliente.idCliente).where(Cliente.email.in_([n.email for n in da_inserire]))
+        ).all())
+
+    session.execute(insert(Carrello), [
+        {"idCliente": ids[n.email], "dataCreazione": adesso, "dataUltimaModifica": adesso} for n in da_inserire
+    ])
+    indirizzi = [
+        {"idCliente": ids[n.email], "via": n.via, "civico": n.civico, "citta": n.citta, "CAP": n.cap,
+         "provincia": n.provincia, "paese": n.paese, "tipo": IndirizzoTipo.SPEDIZIONE, "isDefault": True}
+        for n in da_inserire if n.via and n.citta and n.paese
+    ]
+    if indirizzi:
+        session.execute(insert(Indirizzo), indirizzi)
+    return scartati
+
+def create_clienti_bulk(session: Session, clienti: Iterable[NuovoCliente], chunk_size: int = 1000) -> ImportClientiReport:
+    """Import massivo: INSERT multiriga per clienti, carrelli e indirizzi, un commit per chunk.
+
+    Le email sono salvate in minuscolo; quelle già presenti (in tabella o prima
+    nell'input, senza distinzione fra maiuscole e minuscole) vanno in
+    `duplicati` senza interrompere l'import.
+    """
+    rep = ImportClientiReport()
+    visti: set[str] = set()
+    chunk: list[NuovoCliente] = []
+
+    def flush_chunk() -> None:
+        try:
+            scartati = _insert_clienti_chunk(session, chunk)
+        except IntegrityError:
+            # email inserita da un'altra transazione dopo il controllo: si ripete il chunk
+            session.rollback()
+            scartati = _insert_clienti_chunk(session, chunk)
+        bump(session, Cliente, Carrello, Indirizzo)
+        session.commit()
+        rep.duplicati.extend(scartati)
+        rep.inseriti += len(chunk) - len(scartati)
+        saltati = set(scartati)
+        rep.indirizzi += sum(1 for n in chunk if n.via and n.citta and n.paese and n.email not in saltati)
+        rep.chunk += 1
+        chunk.clear()
+
+    for n in clienti:
+        n = replace(n, email=n.email.strip().lower())
+        if n.email in visti:
+            rep.duplicati.append(n.email)
+            continue
+        visti.add(n.email)
+        chunk.append(n)
+        if len(chunk) >= chunk_size:
+            flush_chunk()
+    if chunk:
+        flush_chunk()
+    return rep
+
+
 # ----------------------------
 # CATEGORIA / PRODOTTO (CRUD)
 # ----------------------------
 def create_categoria(session: Session, nome: str, descrizione: str | None = None, id_padre: int | None = None) -> Categoria:
     cat = Categoria(nome=nome, descrizione=descrizione, idCategoriaPadre=id_padre)
     session.add(cat)
+    bump(session, Categoria)
     session.commit()
     return cat
 
@@ -98,6 +224,7 @@ def create_prodotto(
         prezzoListino=to_decimal(prezzo_listino), aliquotaIVA=to_decimal(aliquota_iva)
     )
     session.add(p)
+    bump(session, Prodotto)
     session.commit()
     return p
 
@@ -105,7 +232,11 @@ def update_prezzo_prodotto(session: Session, sku: str, nuovo_prezzo: float) -> N
     p = session.get(Prodotto, sku)
     if not p:
         raise ValueError(f"Prodotto {sku} non trovato")
-    p.prezzoListino = to_decimal(nuovo_prezzo)
+    nuovo = to_decimal(nuovo_prezzo)
+    if to_decimal(p.prezzoListino) != nuovo:
+        session.add(StoricoPrezzo(sku=sku, prezzoPrecedente=p.prezzoListino, prezzoNuovo=nuovo, dataModifica=now_dt()))
+    p.prezzoListino = nuovo
+    bump(session, Prodotto, StoricoPrezzo)
     session.commit()
 
 def delete_prodotto(session: Session, sku: str) -> None:
@@ -113,6 +244,7 @@ def delete_prodotto(session: Session, sku: str) -> None:
     if not p:
         return
     session.delete(p)
+    bump(session, Prodotto)
     session.commit()
 
 
@@ -127,6 +259,7 @@ def get_carrello_cliente(session: Session, id_cliente: int) -> Carrello:
         session.commit()
     return cart
 
+@retrying
 def add_to_cart(session: Session, id_cliente: int, sku: str, quantita: int) -> VoceCarrello:
     if quantita <= 0:
         raise ValueError("quantita deve essere > 0")
@@ -141,7 +274,7 @@ def add_to_cart(session: Session, id_cliente: int, sku: str, quantita: int) -> V
     )
     if voce:
         voce.quantita += quantita
-        cart.dataUltimaModifica = now_dt()
+        touch_carrello(cart)
         session.commit()
         return voce
 
@@ -153,10 +286,11 @@ def add_to_cart(session: Session, id_cliente: int, sku: str, quantita: int) -> V
         dataAggiunta=now_dt()
     )
     session.add(voce)
-    cart.dataUltimaModifica = now_dt()
+    touch_carrello(cart)
     session.commit()
     return voce
 
+@retrying
 def remove_from_cart(session: Session, id_cliente: int, sku: str) -> None:
     cart = get_carrello_cliente(session, id_cliente)
     voce = session.scalar(
@@ -164,13 +298,14 @@ def remove_from_cart(session: Session, id_cliente: int, sku: str) -> None:
     )
     if voce:
         session.delete(voce)
-        cart.dataUltimaModifica = now_dt()
+        touch_carrello(cart)
         session.commit()
 
 
 # ----------------------------
 # CHECKOUT (Create Ordine + righe) + svuota carrello
 # ----------------------------
+@retrying
 def checkout(
     session: Session,
     id_cliente: int,
@@ -182,27 +317,15 @@ def checkout(
     if not voci:
         raise ValueError("Carrello vuoto")
 
-    totale_lordo = sum(to_decimal(v.prezzoVisto) * to_decimal(v.quantita) for v in voci)
-    totale_sconti = Decimal("0.00")
-
-    coupon = None
-    if codice_coupon:
-        coupon = session.get(Coupon, codice_coupon)
-        if not coupon:
-            raise ValueError("Coupon non valido")
+    coupon_per_carrello = {cart.idCarrello: codice_coupon} if codice_coupon else None
+    prezzo = price_carrelli(session, [cart.idCarrello], coupon_per_carrello)[0]
+    if prezzo.erroreCoupon:
+        raise ValueError(prezzo.erroreCoupon)
 
-        oggi = date.today()
-        if not (coupon.dataInizio <= oggi <= coupon.dataFine):
-            raise ValueError("Coupon non attivo")
-        if totale_lordo < to_decimal(coupon.minimoOrdine):
-            raise ValueError("Totale ordine sotto minimo coupon")
-
-        if coupon.tipo == CouponTipo.PERCENTUALE:
-            totale_sconti = (totale_lordo * to_decimal(coupon.valore) / Decimal("100.00")).quantize(Decimal("0.01"))
-        else:
-            totale_sconti = min(to_decimal(coupon.valore), totale_lordo)
-
-    totale_netto = (totale_lordo - totale_sconti).quantize(Decimal("0.01"))
+    totale_lordo = prezzo.totaleLordo
+    totale_sconti = prezzo.totaleSconti
+    totale_netto = prezzo.totaleNetto
+    sconti_riga = {r.sku: r.scontoRiga for r in prezzo.righe}
 
     ordine = Ordine(
         idCliente=id_cliente,
@@ -215,6 +338,7 @@ def checkout(
     )
     session.add(ordine)
     session.flush()
+    emit_ordine(session, ordine, "ORDINE_CREATO")
 
     for v in voci:
         session.add(RigaOrdine(
@@ -222,22 +346,23 @@ def checkout(
             sku=v.sku,
             quantita=v.quantita,
             prezzoUnitarioApplicato=v.prezzoVisto,
-            scontoRiga=Decimal("0.00")
+            scontoRiga=sconti_riga.get(v.sku, Decimal("0.00"))
         ))
 
-    if coupon:
+    if prezzo.codiceCoupon:
         session.add(OrdineCoupon(
             idOrdine=ordine.idOrdine,
-            codiceCoupon=coupon.codiceCoupon,
+            codiceCoupon=prezzo.codiceCoupon,
             dataApplicazione=now_dt(),
-            importoScontoCalcolato=totale_sconti
+            importoScontoCalcolato=prezzo.scontoCoupon
         ))
 
     # svuota carrello
     for v in voci:
         session.delete(v)
 
-    cart.dataUltimaModifica = now_dt()
+    touch_carrello(cart)
+    bump(session, Ordine, RigaOrdine, OrdineCoupon, Carrello, VoceCarrello)
     session.commit()
 
     return CheckoutResult(ordine_id=ordine.idOrdine, totale_lordo=totale_lordo, totale_sconti=totale_sconti, totale_netto=totale_netto)
@@ -247,14 +372,11 @@ def checkout(
 # PAGAMENTO (Create) + Update stato ordine
 # ----------------------------
 def ensure_metodo_pagamento(session: Session, nome: str, provider: str | None = None) -> MetodoPagamento:
-    mp = session.scalar(select(MetodoPagamento).where(MetodoPagamento.nomeMetodo == nome))
-    if mp:
-        return mp
-    mp = MetodoPagamento(nomeMetodo=nome, provider=provider)
-    session.add(mp)
+    ref = get_refdata(session).metodo(session, nome, provider)
     session.commit()
-    return mp
+    return session.get(MetodoPagamento, ref.idMetodo)
 
+@retrying
 def pay_order(
     session: Session,
     id_ordine: int,
@@ -267,7 +389,7 @@ def pay_order(
     if not ordine:
         raise ValueError("Ordine non trovato")
 
-    metodo = ensure_metodo_pagamento(session, metodo_nome)
+    metodo = get_refdata(session).metodo(session, metodo_nome)
 
     p = Pagamento(
         idOrdine=id_ordine,
@@ -275,13 +397,21 @@ def pay_order(
         importo=to_decimal(importo),
         dataOra=now_dt(),
         esito=esito,
+        tipo=PagamentoTipo.INCASSO,
         transactionId=transaction_id
     )
     session.add(p)
+    session.flush()
+    emit_pagamento(session, p, "PAGAMENTO_REGISTRATO" if esito == EsitoPagamento.OK else "PAGAMENTO_RIFIUTATO")
 
     if esito == EsitoPagamento.OK:
-        ordine.statoOrdine = StatoOrdine.PAGATO
+        touch_ordine(ordine, StatoOrdine.PAGATO)
+        emit_ordine(session, ordine, "ORDINE_PAGATO")
+    else:
+        # pagamento rifiutato: l'ordine non cambia stato, nessun evento ORDINE
+        touch_ordine(ordine)
 
+    bump(session, Pagamento, Ordine)
     session.commit()
     return p
 
@@ -290,37 +420,80 @@ def pay_order(
 # SPEDIZIONE (Create) + Update stato ordine
 # ----------------------------
 def ensure_corriere(session: Session, nome: str, customer_care: str | None = None) -> Corriere:
-    c = session.scalar(select(Corriere).where(Corriere.nome == nome))
-    if c:
-        return c
-    c = Corriere(nome=nome, customerCare=customer_care)
-    session.add(c)
+    ref = get_refdata(session).corriere(session, nome, customer_care)
     session.commit()
-    return c
+    return session.get(Corriere, ref.idCorriere)
 
-def create_shipment(
+def registra_spedizione(
     session: Session,
     id_ordine: int,
     nome_corriere: str,
     tracking: str,
     stato: StatoSpedizione = StatoSpedizione.PREPARAZIONE
 ) -> Spedizione:
+    """Spedizione + stato ordine SPEDITO, senza commit (lo fa il chiamante)."""
     ordine = session.get(Ordine, id_ordine)
     if not ordine:
         raise ValueError("Ordine non trovato")
 
-    corriere = ensure_corriere(session, nome_corriere)
+    corriere = get_refdata(session).corriere(session, nome_corriere)
+    indirizzo = session.get(Indirizzo, ordine.idIndirizzoSpedizione)
+    adesso = now_dt()
     s = Spedizione(
         idOrdine=id_ordine,
         idCorriere=corriere.idCorriere,
         tracking=tracking,
         statoSpedizione=stato,
-        dataSpedizione=now_dt(),
+        dataSpedizione=adesso,
+        # lookup in memoria su TEMPO_CONSEGNA (job train-delivery)
+        dataStimataConsegna=stima_consegna(session, corriere.idCorriere, indirizzo.provincia if indirizzo else None, adesso),
     )
     session.add(s)
+    emit_spedizione(session, s, "SPEDIZIONE_CREATA")
 
     if ordine.statoOrdine in {StatoOrdine.PAGATO, StatoOrdine.IN_PREPARAZIONE, StatoOrdine.CREATO}:
-        ordine.statoOrdine = StatoOrdine.SPEDITO
+        touch_ordine(ordine, StatoOrdine.SPEDITO)
+        emit_ordine(session, ordine, "ORDINE_SPEDITO")
+    else:
+        touch_ordine(ordine)
+
+    bump(session, Spedizione, Ordine)
+    return s
 
+@retrying
+def create_shipment(
+    session: Session,
+    id_ordine: int,
+    nome_corriere: str,
+    tracking: str,
+    stato: StatoSpedizione = StatoSpedizione.PREPARAZIONE
+) -> Spedizione:
+    s = registra_spedizione(session, id_ordine, nome_corriere, tracking, stato)
     session.commit()
     return s
+
+
+# ----------------------------
+# SCORTA (Update giacenza)
+# ----------------------------
+@retrying
+def update_giacenza(session: Session, id_magazzino: int, sku: str, delta: int) -> Scorta:
+    scorta = session.get(Scorta, (id_magazzino, sku))
+    if not scorta:
+        raise ValueError("Scorta non trovata")
+
+    # UPDATE relativo: nessun aggiornamento perso fra processi concorrenti
+    n = session.execute(
+        update(Scorta)
+        .where(Scorta.idMagazzino == id_magazzino, Scorta.sku == sku, Scorta.giacenza + delta >= 0)
+        .values(giacenza=Scorta.giacenza + delta, dataAggiornamento=now_dt())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if n == 0:
+        raise ValueError("Giacenza insufficiente")
+
+    session.refresh(scorta)
+    emit_many(session, [evento_scorta(id_magazzino, sku, scorta.giacenza, scorta.sogliaRiordino)])
+    bump(session, Scorta)
+    session.commit()
+    return scorta
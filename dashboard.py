@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Any, Sequence
+
+from sqlalchemy.engine import Connection, Engine
+
+from .reportcache import REPORTS
+
+
+@dataclass
+class RisultatoReport:
+    nome: str
+    params: list[Any]
+    colonne: list[str]
+    righe: list[list[Any]]
+    ms: float
+    errore: str | None = None
+
+
+def default_reports() -> list[tuple[str, tuple]]:
+    """I sei report di queries.py con i parametri del seed (come export_queries_sql)."""
+    al = datetime.now().replace(microsecond=0)
+    dal = al - timedelta(days=30)
+    return [
+        ("ordini_cliente_email", ("gabriel.rossi@example.com",)),
+        ("dettaglio_ordine", (1,)),
+        ("spedizioni_corriere_periodo", ("PosteDelivery", dal, al)),
+        ("prodotti_sotto_soglia", ()),
+        ("clienti_che_hanno_usato_coupon", ("WELCOME10",)),
+        ("recensioni_per_categoria", ("Detersione",)),
+    ]
+
+
+# ----------------------------
+# Snapshot di lettura per connessione
+# ----------------------------
+def _inizia_snapshot(conn: Connection) -> None:
+    dialetto = conn.dialect.name
+    if dialetto == "mysql":
+        conn.exec_driver_sql("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        conn.exec_driver_sql("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+    elif dialetto == "sqlite":
+        # la transazione di lettura SQLite fissa lo snapshot alla prima lettura
+        conn.exec_driver_sql("BEGIN")
+        conn.exec_driver_sql("SELECT 1 FROM sqlite_master LIMIT 1").all()
+
+def _esegui(engine: Engine, nome: str, params: tuple, stmt, barriera: threading.Barrier | None) -> RisultatoReport:
+    t0 = time.perf_counter()
+    try:
+        with engine.connect() as conn:
+            _inizia_snapshot(conn)
+            if barriera is not None:
+                # nessun report parte finché tutte le connessioni non hanno il proprio snapshot
+                barriera.wait()
+            t0 = time.perf_counter()
+            res = conn.execute(stmt)
+            colonne = list(res.keys())
+            righe = [list(r) for r in res]
+            conn.rollback()
+        return RisultatoReport(nome, list(params), colonne, righe, (time.perf_counter() - t0) * 1000)
+    except Exception as exc:
+        if barriera is not None:
+            barriera.abort()
+        return RisultatoReport(nome, list(params), [], [], (time.perf_counter() - t0) * 1000, f"{type(exc).__name__}: {exc}")
+
+
+def capacita_pool(engine: Engine) -> int | None:
+    """Connessioni che il pool può dare insieme (pool_size + max_overflow); None se illimitate."""
+    pool = engine.pool
+    if not hasattr(pool, "size") or getattr(pool, "_max_overflow", -1) < 0:
+        return None
+    return pool.size() + pool._max_overflow
+
+
+# ----------------------------
+# Esecuzione concorrente e documento combinato
+# ----------------------------
+def run_dashboard(
+    engine: Engine,
+    reports: Sequence[tuple[str, tuple]] | None = None,
+    max_workers: int = 8,
+) -> dict[str, Any]:
+    """Esegue i report in parallelo, una connessione del pool ciascuno.
+
+    Se i report non superano `max_workers` (limitato alla capacità del pool) gli
+    snapshot vengono aperti tutti prima di eseguire qualunque report (MySQL/SQLite
+    non permettono di condividere lo stesso snapshot fra connessioni: sono istanti
+    ravvicinati, non identici).
+    """
+    reports = list(reports) if reports is not None else default_reports()
+    for nome, _params in reports:
+        if nome not in REPORTS:
+            raise ValueError(f"Report {nome} non trovato")
+
+    # statement costruiti prima: un errore di parametri non blocca gli altri report
+    da_eseguire, falliti = [], []
+    for nome, params in reports:
+        try:
+            da_eseguire.append((nome, params, REPORTS[nome](*params)))
+        except TypeError as exc:
+            falliti.append(RisultatoReport(nome, list(params), [], [], 0.0, f"TypeError: {exc}"))
+
+    n = len(da_eseguire)
+    # ogni worker tiene una connessione mentre aspetta alla barriera: oltre la capacità
+    # del pool gli ultimi resterebbero in attesa fino al timeout del pool
+    capacita = capacita_pool(engine)
+    if capacita is not None:
+        max_workers = min(max_workers, capacita)
+    workers = max(1, min(n, max_workers))
+    barriera = threading.Barrier(n) if 1 < n <= max_workers else None
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dashboard") as pool:
+        risultati = list(pool.map(lambda r: _esegui(engine, *r, barriera), da_eseguire))
+    wall = (time.perf_counter() - t0) * 1000
+    risultati += falliti
+
+    return {
+        "generato": datetime.now().replace(microsecond=0),
+        "snapshot": "allineato" if barriera is not None else "per-report",
+        "wall_ms": round(wall, 2),
+        "somma_ms": round(sum(r.ms for r in risultati), 2),
+        "report": [asdict(r) | {"ms": round(r.ms, 2)} for r in risultati],
+    }
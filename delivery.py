@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from types import MappingProxyType
+from typing import Mapping
+
+import numpy as np
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from .jobs import now_dt
+from .models import Indirizzo, Ordine, Spedizione, StatoSpedizione, TempoConsegna
+
+TUTTE = "*"
+# quantile usato per la data promessa al cliente: l'80% delle consegne arriva entro
+QUANTILE_STIMA = "giorniP80"
+
+
+@dataclass
+class EsitoTempi:
+    spedizioni: int
+    gruppi: int
+    corrieri: int
+
+
+def _provincia(p: str | None) -> str:
+    return (p or "").strip().upper() or TUTTE
+
+
+# ----------------------------
+# Job periodico: distribuzione dei giorni di transito dalle consegne concluse
+# ----------------------------
+def quantili_gruppi(gruppi: np.ndarray, giorni: np.ndarray, min_campioni: int) -> list[tuple[int, int, int, int, int]]:
+    """(gruppo, campioni, p50, p80, p95) per i gruppi con almeno `min_campioni` consegne."""
+    ordine = np.lexsort((giorni, gruppi))
+    gruppi, giorni = gruppi[ordine], giorni[ordine]
+    inizi = np.flatnonzero(np.r_[True, gruppi[1:] != gruppi[:-1]])
+    out = []
+    for start, fine in zip(inizi, np.r_[inizi[1:], len(gruppi)]):
+        if fine - start < min_campioni:
+            continue
+        p50, p80, p95 = np.ceil(np.quantile(giorni[start:fine], (0.5, 0.8, 0.95))).astype(np.int64)
+        out.append((int(gruppi[start]), int(fine - start), int(p50), int(p80), int(p95)))
+    return out
+
+def train_tempi(session: Session, finestra_giorni: int = 180, min_campioni: int = 20) -> EsitoTempi:
+    """Ricostruisce TEMPO_CONSEGNA dalle spedizioni CONSEGNATA degli ultimi `finestra_giorni`.
+
+    Le coppie corriere/provincia con meno di `min_campioni` consegne usano la riga
+    del corriere su tutte le province.
+    """
+    dal = now_dt() - timedelta(days=finestra_giorni)
+    righe = session.execute(
+        select(Spedizione.idCorriere, Indirizzo.provincia, Spedizione.dataSpedizione, Spedizione.dataUltimoAggiornamento)
+        .join(Ordine, Ordine.idOrdine == Spedizione.idOrdine)
+        .join(Indirizzo, Indirizzo.idIndirizzo == Ordine.idIndirizzoSpedizione)
+        .where(
+            Spedizione.statoSpedizione == StatoSpedizione.CONSEGNATA,
+            Spedizione.dataUltimoAggiornamento.is_not(None),
+            Spedizione.dataSpedizione >= dal,
+        )
+    ).all()
+
+    adesso = now_dt()
+    valori = []
+    if righe:
+        corrieri, province, spedite, consegnate = zip(*righe)
+        corrieri = np.asarray(corrieri, dtype=np.int64)
+        province = np.asarray([_provincia(p) for p in province], dtype=object)
+        # giorni di calendario fra le date, non fra gli orari
+        giorni = (
+            np.asarray([d.date() for d in consegnate], dtype="datetime64[D]")
+            - np.asarray([d.date() for d in spedite], dtype="datetime64[D]")
+        ).astype(np.int64)
+        validi = giorni >= 0
+        corrieri, province, giorni = corrieri[validi], province[validi], giorni[validi]
+
+        chiavi, gruppo = np.unique(np.stack([corrieri.astype(str), province.astype(str)], axis=1), axis=0, return_inverse=True)
+        for g, n, p50, p80, p95 in quantili_gruppi(gruppo.ravel(), giorni, min_campioni):
+            valori.append({"idCorriere": int(chiavi[g][0]), "provincia": str(chiavi[g][1]), "campioni": n,
+                           "giorniP50": p50, "giorniP80": p80, "giorniP95": p95, "dataCalcolo": adesso})
+        for c, n, p50, p80, p95 in quantili_gruppi(corrieri, giorni, 1):
+            valori.append({"idCorriere": c, "provincia": TUTTE, "campioni": n,
+                           "giorniP50": p50, "giorniP80": p80, "giorniP95": p95, "dataCalcolo": adesso})
+
+    session.execute(delete(TempoConsegna))
+    if valori:
+        # "*" calcolata su tutte le consegne: prevale su un'eventuale provincia vuota
+        session.execute(insert(TempoConsegna), list({(v["idCorriere"], v["provincia"]): v for v in valori}.values()))
+    session.commit()
+    get_stime(session).invalidate()
+    return EsitoTempi(len(righe), sum(1 for v in valori if v["provincia"] != TUTTE), len({v["idCorriere"] for v in valori}))
+
+
+# ----------------------------
+# Tabella di lookup in memoria (una per engine)
+# ----------------------------
+class StimeCache:
+    """Mappa (idCorriere, provincia) -> giorni, sostituita in blocco a ogni ricarica."""
+
+    def __init__(self, ttl_seconds: float = 900.0):
+        self.ttl_seconds = ttl_seconds
+        self._giorni: Mapping[tuple[int, str], int] = MappingProxyType({})
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self, session: Session) -> Mapping[tuple[int, str], int]:
+        colonna = getattr(TempoConsegna, QUANTILE_STIMA)
+        giorni = {(c, p): g for c, p, g in session.execute(
+            select(TempoConsegna.idCorriere, TempoConsegna.provincia, colonna)
+        )}
+        with self._lock:
+            self._giorni = MappingProxyType(giorni)
+            self._loaded_at = time.monotonic()
+            return self._giorni
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = 0.0
+
+    def giorni(self, session: Session, id_corriere: int, provincia: str | None) -> int | None:
+        tabella = self._giorni
+        if not self._loaded_at or time.monotonic() - self._loaded_at > self.ttl_seconds:
+            tabella = self.load(session)
+        g = tabella.get((id_corriere, _provincia(provincia)))
+        return g if g is not None else tabella.get((id_corriere, TUTTE))
+
+
+_caches: "weakref.WeakKeyDictionary[object, StimeCache]" = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def get_stime(session: Session) -> StimeCache:
+    engine = session.get_bind()
+    with _caches_lock:
+        cache = _caches.get(engine)
+        if cache is None:
+            cache = _caches[engine] = StimeCache()
+        return cache
+
+def stima_consegna(session: Session, id_corriere: int, provincia: str | None, data_spedizione: datetime) -> date | None:
+    """Data stimata di consegna; None se il corriere non ha ancora consegne concluse."""
+    g = get_stime(session).giorni(session, id_corriere, provincia)
+    return data_spedizione.date() + timedelta(days=g) if g is not None else None
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+
+from .jobs import get_stato_job, set_watermark
+from .outbox import emit_many, evento_scorta
+from .models import (
+    DomandaGiornaliera, FornituraProdotto, Ordine, RigaOrdine, Scorta, StatoOrdine
+)
+from .reportcache import bump
+
+JOB_DOMANDA = "domanda_giornaliera"
+
+
+@dataclass
+class EsitoSoglie:
+    giorni_aggiunti: int
+    righe_domanda: int
+    scorte_aggiornate: int
+
+
+def _as_date(x) -> date:
+    # func.date() restituisce una stringa su SQLite e un DATE su MySQL
+    return date.fromisoformat(x) if isinstance(x, str) else x
+
+
+# ----------------------------
+# Fase 1: aggregati giornalieri incrementali (solo giorni nuovi e completi)
+# ----------------------------
+def fold_new_days(session: Session, oggi: date | None = None, chunk_size: int = 10000) -> tuple[int, int]:
+    oggi = oggi or date.today()
+    stato = get_stato_job(session, JOB_DOMANDA)
+    dal = stato.ultimaData if stato and stato.ultimaData else None
+    al = datetime.combine(oggi, time.min)
+    if dal is not None and dal >= al:
+        return 0, 0
+
+    giorno = func.date(Ordine.dataCreazione)
+    stmt = (
+        select(RigaOrdine.sku, giorno, func.sum(RigaOrdine.quantita))
+        .join(Ordine, Ordine.idOrdine == RigaOrdine.idOrdine)
+        .where(Ordine.dataCreazione < al, Ordine.statoOrdine != StatoOrdine.ANNULLATO)
+        .group_by(RigaOrdine.sku, giorno)
+    )
+    if dal is not None:
+        stmt = stmt.where(Ordine.dataCreazione >= dal)
+
+    n = 0
+    giorni: set[date] = set()
+    buf: list[dict] = []
+    for sku, g, q in session.execute(stmt.execution_options(yield_per=chunk_size)):
+        g = _as_date(g)
+        giorni.add(g)
+        buf.append({"sku": sku, "giorno": g, "quantita": int(q)})
+        if len(buf) >= chunk_size:
+            session.execute(insert(DomandaGiornaliera), buf)
+            n += len(buf)
+            buf = []
+    if buf:
+        session.execute(insert(DomandaGiornaliera), buf)
+        n += len(buf)
+
+    set_watermark(session, JOB_DOMANDA, ultima_data=al)
+    session.commit()
+    return len(giorni), n
+
+
+# ----------------------------
+# Fase 2: media mobile e varianza su finestra, soglie per (magazzino, sku)
+# ----------------------------
+def compute_soglie(
+    sku_domanda: np.ndarray,
+    offset_giorno: np.ndarray,
+    quantita: np.ndarray,
+    sku_scorta: np.ndarray,
+    n_magazzini: np.ndarray,
+    lead_time: np.ndarray,
+    finestra: int,
+    z: float,
+) -> np.ndarray:
+    """Soglia = domanda media * lead time + z * deviazione standard * sqrt(lead time).
+
+    `offset_giorno` è la posizione del giorno nella finestra (0..finestra-1);
+    la domanda dello sku è ripartita in parti uguali fra i magazzini che lo tengono.
+    """
+    codes, inv = np.unique(np.concatenate([sku_scorta, sku_domanda]), return_inverse=True)
+    cod_scorta, cod_dom = inv[: len(sku_scorta)], inv[len(sku_scorta):]
+
+    serie = np.zeros((len(codes), finestra), dtype=np.float64)
+    np.add.at(serie, (cod_dom, offset_giorno), quantita)
+    media = serie.mean(axis=1)[cod_scorta] / n_magazzini
+    varianza = serie.var(axis=1)[cod_scorta] / (n_magazzini ** 2)
+
+    soglia = media * lead_time + z * np.sqrt(varianza * lead_time)
+    return np.ceil(soglia).astype(np.int64)
+
+def update_soglie(
+    session: Session,
+    finestra: int = 28,
+    z: float = 1.65,
+    lead_time_default: int = 7,
+    oggi: date | None = None,
+    chunk_size: int = 10000,
+) -> EsitoSoglie:
+    oggi = oggi or date.today()
+    giorni, righe = fold_new_days(session, oggi, chunk_size)
+
+    inizio = oggi - timedelta(days=finestra)
+    dom = session.execute(
+        select(DomandaGiornaliera.sku, DomandaGiornaliera.giorno, DomandaGiornaliera.quantita)
+        .where(DomandaGiornaliera.giorno >= inizio, DomandaGiornaliera.giorno < oggi)
+    ).all()
+    scorte = session.execute(select(Scorta.idMagazzino, Scorta.sku, Scorta.giacenza, Scorta.sogliaRiordino)).all()
+    if not scorte:
+        return EsitoSoglie(giorni, righe, 0)
+
+    lead = dict(session.execute(
+        select(FornituraProdotto.sku, func.min(FornituraProdotto.leadTimeGiorni)).group_by(FornituraProdotto.sku)
+    ).all())
+
+    mag_s, sku_s, giac_s, soglia_prec = (np.asarray(c) for c in zip(*scorte))
+    sku_s = sku_s.astype(str)
+    _, inv_s, cnt = np.unique(sku_s, return_inverse=True, return_counts=True)
+    n_magazzini = cnt[inv_s].astype(np.float64)
+    lead_time = np.asarray([lead.get(s, lead_time_default) for s in sku_s], dtype=np.float64)
+
+    if dom:
+        sku_d, giorno_d, q_d = zip(*dom)
+        sku_d = np.asarray(sku_d, dtype=str)
+        offset = np.asarray([(g - inizio).days for g in giorno_d], dtype=np.int64)
+        q_d = np.asarray(q_d, dtype=np.float64)
+    else:
+        sku_d, offset, q_d = np.zeros(0, dtype=str), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    soglie = compute_soglie(sku_d, offset, q_d, sku_s, n_magazzini, lead_time, finestra, z)
+    # sku senza domanda nella finestra (nuovi, primo avvio, lenti): la soglia impostata resta
+    da_scrivere = np.flatnonzero(np.isin(sku_s, sku_d) & (soglie != soglia_prec.astype(np.int64)))
+
+    for start in range(0, len(da_scrivere), chunk_size):
+        sl = da_scrivere[start:start + chunk_size]
+        session.execute(update(Scorta), [
+            {"idMagazzino": int(m), "sku": str(s), "sogliaRiordino": int(v)}
+            for m, s, v in zip(mag_s[sl], sku_s[sl], soglie[sl])
+        ])
+        emit_many(session, [
+            evento_scorta(int(m), str(s), int(g), int(v))
+            for m, s, g, v in zip(mag_s[sl], sku_s[sl], giac_s[sl], soglie[sl])
+        ])
+    bump(session, Scorta)
+    session.commit()
+    return EsitoSoglie(giorni, righe, len(da_scrivere))
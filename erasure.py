@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, fields
+from typing import Iterable, Iterator
+
+from sqlalchemy import String, cast, delete, literal, select, update
+from sqlalchemy.orm import Session
+
+from .crud import now_dt
+from .models import (
+    AuditCancellazione, Carrello, Cliente, Indirizzo, Ordine, Recensione,
+    SegmentoCliente, VoceCarrello, VoceCarrelloArchivio
+)
+from .reportcache import bump
+
+ANONIMO = "ANONIMIZZATO"
+
+
+@dataclass
+class ErasureReport:
+    richiesti: int = 0
+    clientiCancellati: int = 0
+    clientiAnonimizzati: int = 0
+    indirizziCancellati: int = 0
+    indirizziAnonimizzati: int = 0
+    carrelli: int = 0
+    vociCarrello: int = 0
+    recensioni: int = 0
+
+    def add(self, other: "ErasureReport") -> None:
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+def _exec(session: Session, stmt) -> int:
+    return session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+
+
+# ----------------------------
+# Un chunk di clienti = una transazione
+# ----------------------------
+def _erase_chunk(session: Session, ids: list[int]) -> ErasureReport:
+    rep = ErasureReport(richiesti=len(ids))
+
+    con_ordini = set(session.scalars(select(Ordine.idCliente).where(Ordine.idCliente.in_(ids)).distinct()))
+    senza_ordini = [i for i in ids if i not in con_ordini]
+
+    carrelli = select(Carrello.idCarrello).where(Carrello.idCliente.in_(ids))
+    rep.vociCarrello = _exec(session, delete(VoceCarrello).where(VoceCarrello.idCarrello.in_(carrelli)))
+    rep.vociCarrello += _exec(session, delete(VoceCarrelloArchivio).where(VoceCarrelloArchivio.idCarrello.in_(carrelli)))
+    rep.carrelli = _exec(session, delete(Carrello).where(Carrello.idCliente.in_(ids)))
+    rep.recensioni = _exec(session, delete(Recensione).where(Recensione.idCliente.in_(ids)))
+    # profilazione di marketing: non sopravvive all'anonimizzazione
+    _exec(session, delete(SegmentoCliente).where(SegmentoCliente.idCliente.in_(ids)))
+
+    # gli indirizzi usati da ordini restano (FK RESTRICT) ma perdono i dati personali;
+    # provincia e paese sono mantenuti per le statistiche di consegna
+    usati = select(Ordine.idIndirizzoSpedizione).where(Ordine.idCliente.in_(ids))
+    rep.indirizziAnonimizzati = _exec(session, (
+        update(Indirizzo)
+        .where(Indirizzo.idCliente.in_(ids), Indirizzo.idIndirizzo.in_(usati))
+        .values(via=ANONIMO, civico=None, citta=ANONIMO, CAP=None)
+    ))
+    rep.indirizziCancellati = _exec(session, (
+        delete(Indirizzo).where(Indirizzo.idCliente.in_(ids), Indirizzo.idIndirizzo.not_in(usati))
+    ))
+
+    if senza_ordini:
+        rep.clientiCancellati = _exec(session, delete(Cliente).where(Cliente.idCliente.in_(senza_ordini)))
+    if con_ordini:
+        email_anonima = literal("anonimo-") + cast(Cliente.idCliente, String) + literal("@anonimo.invalid")
+        rep.clientiAnonimizzati = _exec(session, (
+            update(Cliente)
+            .where(Cliente.idCliente.in_(con_ordini))
+            .values(email=email_anonima, nome=ANONIMO, cognome=ANONIMO)
+        ))
+
+    session.add(AuditCancellazione(dataEsecuzione=now_dt(), **{f.name: getattr(rep, f.name) for f in fields(rep)}))
+    bump(session, Cliente, Indirizzo, Carrello, VoceCarrello, Recensione)
+    session.commit()
+    return rep
+
+def _chunks(ids: Iterable[int], size: int) -> Iterator[list[int]]:
+    buf: list[int] = []
+    for i in ids:
+        buf.append(int(i))
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+def erase_clienti(session: Session, ids: Iterable[int], chunk_size: int = 500) -> Iterator[ErasureReport]:
+    """Cancella (o anonimizza, se hanno ordini) i clienti indicati, un chunk per transazione."""
+    for chunk in _chunks(dict.fromkeys(ids), chunk_size):
+        yield _erase_chunk(session, chunk)
+
+def resolve_ids(session: Session, riferimenti: Iterable[str], chunk_size: int = 1000) -> list[int]:
+    """Converte una lista di idCliente o email in idCliente (una query per chunk di email)."""
+    ids: list[int] = []
+    email: list[str] = []
+    for r in riferimenti:
+        r = r.strip()
+        if not r:
+            continue
+        if r.isdigit():
+            ids.append(int(r))
+        else:
+            email.append(r)
+    for start in range(0, len(email), chunk_size):
+        ids.extend(session.scalars(select(Cliente.idCliente).where(Cliente.email.in_(email[start:start + chunk_size]))))
+    return ids
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, exists, insert, select, update
+from sqlalchemy.orm import Session
+
+from .concurrency import ConcurrencyError, retrying
+from . import crud
+from .crud import now_dt
+from .models import LeasePreparazione, Ordine, Spedizione, StatoOrdine
+from .outbox import emit_many, evento_ordine
+from .reportcache import bump
+
+
+@dataclass
+class Lotto:
+    worker: str
+    ordini: list[int]
+    scadenza: datetime
+    rimessiInCoda: int = 0
+
+
+def _eventi(session: Session, ids: list[int], stato: StatoOrdine, tipo: str) -> None:
+    righe = session.execute(
+        select(Ordine.idOrdine, Ordine.idCliente, Ordine.statoOrdine, Ordine.totaleNetto)
+        .where(Ordine.idOrdine.in_(ids), Ordine.statoOrdine == stato)
+    ).all()
+    emit_many(session, [evento_ordine(*r, tipo) for r in righe])
+
+def _rimetti_in_coda(session: Session, ids: list[int]) -> int:
+    """IN_PREPARAZIONE -> PAGATO per gli ordini indicati rimasti senza lease."""
+    if not ids:
+        return 0
+    n = session.execute(
+        update(Ordine)
+        .where(
+            Ordine.idOrdine.in_(ids),
+            Ordine.statoOrdine == StatoOrdine.IN_PREPARAZIONE,
+            # un lease rinnovato nel frattempo vince sulla scadenza letta prima
+            ~exists().where(LeasePreparazione.idOrdine == Ordine.idOrdine),
+        )
+        .values(statoOrdine=StatoOrdine.PAGATO, versione=Ordine.versione + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if n:
+        _eventi(session, ids, StatoOrdine.PAGATO, "ORDINE_RIMESSO_IN_CODA")
+    return n
+
+def _scaduti(session: Session, adesso: datetime) -> int:
+    """Rimette in coda gli ordini con lease scaduto e quelli IN_PREPARAZIONE rimasti senza lease."""
+    scaduti = select(LeasePreparazione.idOrdine).where(LeasePreparazione.scadenza < adesso)
+    orfani = select(Ordine.idOrdine).where(
+        Ordine.statoOrdine == StatoOrdine.IN_PREPARAZIONE,
+        ~exists().where(LeasePreparazione.idOrdine == Ordine.idOrdine),
+    )
+    if session.get_bind().dialect.name == "mysql":
+        scaduti = scaduti.with_for_update(skip_locked=True)
+        orfani = orfani.with_for_update(skip_locked=True)
+    ids = list(session.scalars(scaduti))
+    if ids:
+        session.execute(
+            delete(LeasePreparazione)
+            .where(LeasePreparazione.idOrdine.in_(ids), LeasePreparazione.scadenza < adesso)
+            .execution_options(synchronize_session=False)
+        )
+    ids += session.scalars(orfani)
+    return _rimetti_in_coda(session, ids)
+
+
+# ----------------------------
+# Presa in carico: PAGATO -> IN_PREPARAZIONE con lease
+# ----------------------------
+def _prendi(session: Session, limite: int) -> list[int]:
+    candidati = (
+        select(Ordine.idOrdine)
+        .where(Ordine.statoOrdine == StatoOrdine.PAGATO)
+        .order_by(Ordine.dataCreazione, Ordine.idOrdine)
+        .limit(limite)
+    )
+    valori = {"statoOrdine": StatoOrdine.IN_PREPARAZIONE, "versione": Ordine.versione + 1}
+    dialetto = session.get_bind().dialect
+
+    if dialetto.name != "mysql" and dialetto.update_returning:
+        # SQLite: un solo UPDATE sotto il lock di scrittura, nessuna finestra fra lettura e presa
+        return list(session.scalars(
+            update(Ordine)
+            .where(Ordine.idOrdine.in_(candidati.scalar_subquery()), Ordine.statoOrdine == StatoOrdine.PAGATO)
+            .values(**valori)
+            .returning(Ordine.idOrdine)
+            .execution_options(synchronize_session=False)
+        ))
+
+    if dialetto.name == "mysql":
+        # i worker concorrenti saltano le righe già bloccate invece di attenderle
+        candidati = candidati.with_for_update(skip_locked=True)
+    ids = list(session.scalars(candidati))
+    if not ids:
+        return []
+    presi = session.execute(
+        update(Ordine)
+        .where(Ordine.idOrdine.in_(ids), Ordine.statoOrdine == StatoOrdine.PAGATO)
+        .values(**valori)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if presi != len(ids):
+        session.rollback()
+        raise ConcurrencyError("Ordini presi in carico da un altro worker: ripetere")
+    return ids
+
+@retrying
+def claim(session: Session, worker: str, limite: int = 10, lease_secondi: int = 300) -> Lotto:
+    """Prende in carico fino a `limite` ordini PAGATO (i più vecchi) per `worker`.
+
+    I lease scaduti vengono prima rimessi in coda: un worker fermo non trattiene ordini.
+    """
+    adesso = now_dt()
+    scadenza = adesso + timedelta(seconds=lease_secondi)
+    rimessi = _scaduti(session, adesso)
+    ids = _prendi(session, limite)
+    if ids:
+        session.execute(insert(LeasePreparazione), [
+            {"idOrdine": i, "worker": worker, "dataPresaInCarico": adesso, "scadenza": scadenza} for i in ids
+        ])
+        _eventi(session, ids, StatoOrdine.IN_PREPARAZIONE, "ORDINE_IN_PREPARAZIONE")
+    if ids or rimessi:
+        bump(session, Ordine)
+    session.commit()
+    return Lotto(worker, sorted(ids), scadenza, rimessi)
+
+@retrying
+def rinnova(session: Session, worker: str, ids: list[int], lease_secondi: int = 300) -> list[int]:
+    """Estende i lease ancora validi del worker; restituisce gli ordini ancora in carico."""
+    adesso = now_dt()
+    session.execute(
+        update(LeasePreparazione)
+        .where(
+            LeasePreparazione.idOrdine.in_(ids),
+            LeasePreparazione.worker == worker,
+            LeasePreparazione.scadenza >= adesso,
+        )
+        .values(scadenza=adesso + timedelta(seconds=lease_secondi))
+        .execution_options(synchronize_session=False)
+    )
+    tenuti = sorted(session.scalars(
+        select(LeasePreparazione.idOrdine).where(
+            LeasePreparazione.idOrdine.in_(ids), LeasePreparazione.worker == worker, LeasePreparazione.scadenza >= adesso
+        )
+    ))
+    session.commit()
+    return tenuti
+
+@retrying
+def rilascia(session: Session, worker: str, ids: list[int]) -> int:
+    """Restituisce alla coda ordini presi in carico e non evasi."""
+    session.execute(
+        delete(LeasePreparazione)
+        .where(LeasePreparazione.idOrdine.in_(ids), LeasePreparazione.worker == worker)
+        .execution_options(synchronize_session=False)
+    )
+    n = _rimetti_in_coda(session, ids)
+    if n:
+        bump(session, Ordine)
+    session.commit()
+    return n
+
+@retrying
+def rilascia_scaduti(session: Session) -> int:
+    n = _scaduti(session, now_dt())
+    if n:
+        bump(session, Ordine)
+    session.commit()
+    return n
+
+
+# ----------------------------
+# Evasione: spedizione e chiusura del lease nella stessa transazione
+# ----------------------------
+@retrying
+def completa(session: Session, worker: str, id_ordine: int, nome_corriere: str, tracking: str) -> Spedizione:
+    """Il lease si chiude solo dopo che la spedizione è stata scritta: se l'INSERT
+    fallisce (es. tracking duplicato) l'ordine resta in carico al worker."""
+    tenuto = session.scalar(
+        select(LeasePreparazione.idOrdine)
+        .where(
+            LeasePreparazione.idOrdine == id_ordine,
+            LeasePreparazione.worker == worker,
+            LeasePreparazione.scadenza >= now_dt(),
+        )
+        .with_for_update()
+    )
+    if tenuto is None:
+        session.rollback()
+        raise ValueError(f"Ordine {id_ordine} non in carico a {worker} (lease scaduto o assente)")
+    # attraverso il modulo: metrics.instrument() sostituisce crud.registra_spedizione
+    s = crud.registra_spedizione(session, id_ordine, nome_corriere, tracking)
+    session.flush()
+    chiuso = session.execute(
+        delete(LeasePreparazione)
+        .where(LeasePreparazione.idOrdine == id_ordine, LeasePreparazione.worker == worker)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not chiuso:
+        # SQLite: il lease è stato recuperato da rilascia_scaduti fra la lettura e la scrittura
+        session.rollback()
+        raise ValueError(f"Ordine {id_ordine} non in carico a {worker} (lease scaduto o assente)")
+    session.commit()
+    return s
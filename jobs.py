@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from .models import StatoJob
+
+
+def now_dt() -> datetime:
+    # definita qui (non importata da crud) perché crud usa l'outbox, che usa i watermark
+    return datetime.now().replace(microsecond=0)
+
+
+# ----------------------------
+# Watermark dei job incrementali (STATO_JOB)
+# ----------------------------
+def get_stato_job(session: Session, nome_job: str) -> StatoJob | None:
+    return session.get(StatoJob, nome_job)
+
+def set_watermark(
+    session: Session,
+    nome_job: str,
+    ultima_data: datetime | None = None,
+    ultimo_id: int | None = None,
+) -> StatoJob:
+    stato = session.get(StatoJob, nome_job)
+    if not stato:
+        stato = StatoJob(nomeJob=nome_job, dataEsecuzione=now_dt())
+        session.add(stato)
+    stato.ultimaData = ultima_data
+    stato.ultimoId = ultimo_id
+    stato.dataEsecuzione = now_dt()
+    return stato
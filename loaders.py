@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+from .models import (
+    Carrello, Cliente, Ordine, Pagamento, RigaOrdine, Spedizione, VoceCarrello,
+    EsitoPagamento, IndirizzoTipo, PagamentoTipo, StatoOrdine, StatoReso, StatoSpedizione
+)
+
+
+# ----------------------------
+# DTO di sola lettura
+# ----------------------------
+@dataclass(frozen=True)
+class ResoDTO:
+    idReso: int
+    motivo: str
+    statoReso: StatoReso
+    dataApertura: date
+
+
+@dataclass(frozen=True)
+class RigaOrdineDTO:
+    idRigaOrdine: int
+    sku: str
+    nomeProdotto: str
+    quantita: int
+    prezzoUnitarioApplicato: Decimal
+    scontoRiga: Decimal
+    reso: ResoDTO | None
+
+
+@dataclass(frozen=True)
+class PagamentoDTO:
+    idPagamento: int
+    metodo: str
+    importo: Decimal
+    dataOra: datetime
+    esito: EsitoPagamento
+    transactionId: str | None
+    tipo: PagamentoTipo
+
+
+@dataclass(frozen=True)
+class SpedizioneDTO:
+    idSpedizione: int
+    corriere: str
+    tracking: str
+    statoSpedizione: StatoSpedizione
+    dataSpedizione: datetime
+    dataStimataConsegna: date | None
+
+
+@dataclass(frozen=True)
+class OrdineCompletoDTO:
+    idOrdine: int
+    idCliente: int
+    idIndirizzoSpedizione: int
+    dataCreazione: datetime
+    statoOrdine: StatoOrdine
+    totaleLordo: Decimal
+    totaleSconti: Decimal
+    totaleNetto: Decimal
+    codiceCoupon: str | None
+    scontoCoupon: Decimal | None
+    righe: tuple[RigaOrdineDTO, ...]
+    pagamenti: tuple[PagamentoDTO, ...]
+    spedizioni: tuple[SpedizioneDTO, ...]
+
+
+@dataclass(frozen=True)
+class IndirizzoDTO:
+    idIndirizzo: int
+    via: str
+    civico: str | None
+    citta: str
+    CAP: str | None
+    provincia: str | None
+    paese: str
+    tipo: IndirizzoTipo
+    isDefault: bool
+
+
+@dataclass(frozen=True)
+class VoceCarrelloDTO:
+    sku: str
+    nomeProdotto: str
+    quantita: int
+    prezzoVisto: Decimal
+    dataAggiunta: datetime
+
+
+@dataclass(frozen=True)
+class CarrelloDTO:
+    idCarrello: int
+    dataUltimaModifica: datetime
+    voci: tuple[VoceCarrelloDTO, ...]
+
+
+@dataclass(frozen=True)
+class RecensioneDTO:
+    idRecensione: int
+    sku: str
+    voto: int
+    titolo: str | None
+    dataRecensione: date
+
+
+@dataclass(frozen=True)
+class ClienteCompletoDTO:
+    idCliente: int
+    email: str
+    nome: str
+    cognome: str
+    dataRegistrazione: date
+    indirizzi: tuple[IndirizzoDTO, ...]
+    carrello: CarrelloDTO | None
+    ordini: tuple[OrdineCompletoDTO, ...]
+    recensioni: tuple[RecensioneDTO, ...]
+
+
+# ----------------------------
+# Conversione ORM -> DTO
+# ----------------------------
+def _ordine_dto(o: Ordine) -> OrdineCompletoDTO:
+    oc = o.ordine_coupon
+    return OrdineCompletoDTO(
+        idOrdine=o.idOrdine,
+        idCliente=o.idCliente,
+        idIndirizzoSpedizione=o.idIndirizzoSpedizione,
+        dataCreazione=o.dataCreazione,
+        statoOrdine=o.statoOrdine,
+        totaleLordo=o.totaleLordo,
+        totaleSconti=o.totaleSconti,
+        totaleNetto=o.totaleNetto,
+        codiceCoupon=oc.codiceCoupon if oc else None,
+        scontoCoupon=oc.importoScontoCalcolato if oc else None,
+        righe=tuple(
+            RigaOrdineDTO(
+                r.idRigaOrdine, r.sku, r.prodotto.nome, r.quantita, r.prezzoUnitarioApplicato, r.scontoRiga,
+                ResoDTO(r.reso.idReso, r.reso.motivo, r.reso.statoReso, r.reso.dataApertura) if r.reso else None,
+            )
+            for r in sorted(o.righe, key=lambda r: r.sku)
+        ),
+        pagamenti=tuple(
+            PagamentoDTO(p.idPagamento, p.metodo.nomeMetodo, p.importo, p.dataOra, p.esito, p.transactionId, p.tipo)
+            for p in sorted(o.pagamenti, key=lambda p: p.dataOra)
+        ),
+        spedizioni=tuple(
+            SpedizioneDTO(s.idSpedizione, s.corriere.nome, s.tracking, s.statoSpedizione, s.dataSpedizione, s.dataStimataConsegna)
+            for s in sorted(o.spedizioni, key=lambda s: s.dataSpedizione)
+        ),
+    )
+
+def _cliente_dto(c: Cliente) -> ClienteCompletoDTO:
+    cart = c.carrello
+    return ClienteCompletoDTO(
+        idCliente=c.idCliente,
+        email=c.email,
+        nome=c.nome,
+        cognome=c.cognome,
+        dataRegistrazione=c.dataRegistrazione,
+        indirizzi=tuple(
+            IndirizzoDTO(a.idIndirizzo, a.via, a.civico, a.citta, a.CAP, a.provincia, a.paese, a.tipo, a.isDefault)
+            for a in c.indirizzi
+        ),
+        carrello=CarrelloDTO(
+            cart.idCarrello,
+            cart.dataUltimaModifica,
+            tuple(
+                VoceCarrelloDTO(v.sku, v.prodotto.nome, v.quantita, v.prezzoVisto, v.dataAggiunta)
+                for v in cart.voci
+            ),
+        ) if cart else None,
+        ordini=tuple(_ordine_dto(o) for o in sorted(c.ordini, key=lambda o: o.dataCreazione, reverse=True)),
+        recensioni=tuple(
+            RecensioneDTO(r.idRecensione, r.sku, r.voto, r.titolo, r.dataRecensione) for r in c.recensioni
+        ),
+    )
+
+
+# ----------------------------
+# Loader: numero di query fisso, indipendente da righe e ordini
+# ----------------------------
+def _opzioni_ordine(path=None):
+    """selectin per le collezioni, join per i many-to-one: una query per livello."""
+    base = path.selectinload if path is not None else selectinload
+    return (
+        base(Ordine.righe).options(joinedload(RigaOrdine.prodotto), joinedload(RigaOrdine.reso)),
+        base(Ordine.pagamenti).joinedload(Pagamento.metodo),
+        base(Ordine.spedizioni).joinedload(Spedizione.corriere),
+        base(Ordine.ordine_coupon),
+    )
+
+def load_ordine_completo(session: Session, ids: Iterable[int]) -> list[OrdineCompletoDTO]:
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    ordini = session.scalars(
+        select(Ordine).where(Ordine.idOrdine.in_(ids)).options(*_opzioni_ordine())
+        .execution_options(populate_existing=True)
+    ).all()
+    per_id = {o.idOrdine: o for o in ordini}
+    return [_ordine_dto(per_id[i]) for i in ids if i in per_id]
+
+def load_cliente_completo(session: Session, ids: Iterable[int]) -> list[ClienteCompletoDTO]:
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    ordini = selectinload(Cliente.ordini)
+    clienti = session.scalars(
+        select(Cliente).where(Cliente.idCliente.in_(ids)).options(
+            selectinload(Cliente.indirizzi),
+            selectinload(Cliente.carrello).selectinload(Carrello.voci).joinedload(VoceCarrello.prodotto),
+            selectinload(Cliente.recensioni),
+            ordini,
+            *_opzioni_ordine(ordini),
+        )
+        .execution_options(populate_existing=True)
+    ).all()
+    per_id = {c.idCliente: c for c in clienti}
+    return [_cliente_dto(per_id[i]) for i in ids if i in per_id]
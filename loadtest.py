@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import multiprocessing as mp
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from sqlalchemy import func, select
+
+from . import crud, fulfillment, metrics
+from .concurrency import STATS, ConcurrencyError
+from .db import get_session, make_engine
+from .models import EsitoPagamento, Indirizzo, IndirizzoTipo, Ordine, Prodotto, ProdottoStato, Spedizione, StatoOrdine
+
+
+@dataclass
+class LoadReport:
+    processi: int
+    secondi: float
+    workflow: int
+    ordini: int
+    carrelli_vuoti: int
+    errori: int
+    chiamate: int
+    tentativi: int
+    retry_lock: int
+    conflitti: int
+    falliti: int
+
+    @property
+    def throughput(self) -> float:
+        return self.ordini / self.secondi if self.secondi else 0.0
+
+    @property
+    def tasso_conflitti(self) -> float:
+        return (self.conflitti + self.retry_lock) / self.tentativi if self.tentativi else 0.0
+
+
+@dataclass
+class PickingReport:
+    processi: int
+    secondi: float
+    lotti: int
+    evasi: int
+    persi: int
+    doppi: int
+    rimasti: int
+    tentativi: int
+    retry_lock: int
+
+    @property
+    def throughput(self) -> float:
+        return self.evasi / self.secondi if self.secondi else 0.0
+
+
+# ----------------------------
+# Preparazione: clienti "shopper" con indirizzo di spedizione
+# ----------------------------
+def prepara_clienti(session, n: int) -> list[tuple[int, int]]:
+    out = []
+    for i in range(n):
+        email = f"shopper{i}@load.test"
+        c = crud.get_cliente_by_email(session, email) or crud.create_cliente(session, email, "Shopper", str(i))
+        id_ind = session.scalar(
+            select(Indirizzo.idIndirizzo).where(Indirizzo.idCliente == c.idCliente, Indirizzo.tipo == IndirizzoTipo.SPEDIZIONE)
+        )
+        if id_ind is None:
+            id_ind = crud.add_indirizzo(session, c.idCliente, "Via Test", "Roma", "Italia", IndirizzoTipo.SPEDIZIONE,
+                                        provincia="RM", is_default=True).idIndirizzo
+        out.append((c.idCliente, id_ind))
+    return out
+
+
+# ----------------------------
+# Worker: add -> checkout -> pay, ripetuto fino a scadenza
+# ----------------------------
+def _worker(args) -> dict[str, int]:
+    clienti, skus, durata, seed, misura = args
+    if misura:
+        metrics.instrument()
+    rnd = random.Random(seed)
+    engine = make_engine()
+    STATS.reset()
+    res = {"workflow": 0, "ordini": 0, "carrelli_vuoti": 0, "errori": 0}
+    fine = time.monotonic() + durata
+    while time.monotonic() < fine:
+        id_cliente, id_ind = rnd.choice(clienti)
+        res["workflow"] += 1
+        # una Session per workflow, come una richiesta web
+        with get_session(engine) as session:
+            try:
+                for sku in rnd.sample(skus, k=min(len(skus), rnd.randint(1, 3))):
+                    crud.add_to_cart(session, id_cliente, sku, rnd.randint(1, 2))
+                r = crud.checkout(session, id_cliente, id_ind)
+                crud.pay_order(session, r.ordine_id, "Carta", float(r.totale_netto), EsitoPagamento.OK, f"LT-{uuid.uuid4()}")
+                res["ordini"] += 1
+            except ValueError:
+                # un altro shopper sullo stesso cliente ha già convertito il carrello
+                session.rollback()
+                res["carrelli_vuoti"] += 1
+            except ConcurrencyError:
+                session.rollback()
+                res["errori"] += 1
+    engine.dispose()
+    res.update(STATS.snapshot())
+    if misura:
+        res["metriche"] = metrics.REGISTRY.to_dict()
+    return res
+
+def run_load(processi: int = 4, clienti: int = 20, durata: float = 10.0, misura: bool = False) -> LoadReport:
+    """Avvia `processi` shopper concorrenti su `clienti` clienti condivisi.
+
+    Meno clienti che processi aumenta la contesa sugli stessi carrelli/ordini.
+    Con `misura` gli istogrammi dei worker vengono riuniti in metrics.REGISTRY.
+    """
+    engine = make_engine()
+    with get_session(engine) as session:
+        pool_clienti = prepara_clienti(session, clienti)
+        skus = list(session.scalars(select(Prodotto.sku).where(Prodotto.stato == ProdottoStato.ATTIVO)))
+    engine.dispose()
+    if not skus:
+        raise ValueError("Nessun prodotto attivo: eseguire prima il seed")
+
+    ctx = mp.get_context("spawn")
+    t0 = time.perf_counter()
+    with ctx.Pool(processi) as pool:
+        risultati = pool.map(_worker, [(pool_clienti, skus, durata, i, misura) for i in range(processi)])
+    secondi = time.perf_counter() - t0
+
+    for r in risultati:
+        metrics.REGISTRY.unisci(r.pop("metriche", {}))
+    tot = {k: sum(r[k] for r in risultati) for k in risultati[0]}
+    return LoadReport(processi=processi, secondi=secondi, **tot)
+
+
+# ----------------------------
+# Picking: worker di magazzino concorrenti sulla coda PAGATO
+# ----------------------------
+def _picker(args) -> dict[str, int]:
+    n, durata, lotto, prefisso, misura = args
+    if misura:
+        metrics.instrument()
+    engine = make_engine()
+    STATS.reset()
+    worker = f"{prefisso}-{n}"
+    res = {"lotti": 0, "evasi": 0, "persi": 0}
+    fine = time.monotonic() + durata
+    with get_session(engine) as session:
+        while time.monotonic() < fine:
+            presi = fulfillment.claim(session, worker, lotto)
+            if not presi.ordini:
+                break
+            res["lotti"] += 1
+            for id_ordine in presi.ordini:
+                try:
+                    fulfillment.completa(session, worker, id_ordine, "Picking", f"{prefisso}-{id_ordine}-{n}")
+                    res["evasi"] += 1
+                except ValueError:
+                    # lease scaduto e ordine ripreso da un altro worker
+                    res["persi"] += 1
+    engine.dispose()
+    s = STATS.snapshot()
+    res.update(tentativi=s["tentativi"], retry_lock=s["retry_lock"])
+    if misura:
+        res["metriche"] = metrics.REGISTRY.to_dict()
+    return res
+
+def run_picking(processi: int = 4, durata: float = 10.0, lotto: int = 10, misura: bool = False) -> PickingReport:
+    """Svuota la coda degli ordini PAGATO con `processi` picker concorrenti.
+
+    `doppi` conta gli ordini con più di una spedizione creata dal test (deve restare 0).
+    """
+    prefisso = f"PK{uuid.uuid4().hex[:8]}"
+    ctx = mp.get_context("spawn")
+    t0 = time.perf_counter()
+    with ctx.Pool(processi) as pool:
+        risultati = pool.map(_picker, [(i, durata, lotto, prefisso, misura) for i in range(processi)])
+    secondi = time.perf_counter() - t0
+
+    for r in risultati:
+        metrics.REGISTRY.unisci(r.pop("metriche", {}))
+    tot = {k: sum(r[k] for r in risultati) for k in risultati[0]}
+    engine = make_engine()
+    with get_session(engine) as session:
+        per_ordine = (
+            select(Spedizione.idOrdine)
+            .where(Spedizione.tracking.like(f"{prefisso}-%"))
+            .group_by(Spedizione.idOrdine)
+            .having(func.count() > 1)
+            .subquery()
+        )
+        doppi = session.scalar(select(func.count()).select_from(per_ordine))
+        rimasti = session.scalar(select(func.count()).select_from(Ordine).where(Ordine.statoOrdine == StatoOrdine.PAGATO))
+    engine.dispose()
+    return PickingReport(processi=processi, secondi=secondi, doppi=doppi, rimasti=rimasti, **tot)
@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# precisione: 64 sotto-bucket per potenza di 2 (errore relativo < 1.6%)
+SUB_BITS = 7
+_META = 1 << (SUB_BITS - 1)
+MAX_US = 3_600_000_000            # valori oltre un'ora finiscono nell'ultimo bucket
+# limiti dei bucket Prometheus (secondi): ricavati dall'istogramma HDR al momento del dump
+LE_SECONDI = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILI = {"p50": 0.5, "p90": 0.9, "p99": 0.99, "p999": 0.999}
+
+
+# ----------------------------
+# Istogramma log-lineare stile HDR (microsecondi)
+# ----------------------------
+def _indice(us: int) -> int:
+    esp = max(0, us.bit_length() - SUB_BITS)
+    return esp * _META + (us >> esp)
+
+def _limite_superiore(idx: int) -> int:
+    if idx < 2 * _META:
+        return idx
+    esp = idx // _META - 1
+    return ((idx - esp * _META + 1) << esp) - 1
+
+
+class Istogramma:
+    __slots__ = ("conteggi", "n", "somma", "minimo", "massimo")
+
+    def __init__(self):
+        self.conteggi = [0] * (_indice(MAX_US) + 1)
+        self.n = 0
+        self.somma = 0
+        self.minimo = 0
+        self.massimo = 0
+
+    def registra(self, us: int) -> None:
+        us = min(max(us, 0), MAX_US)
+        self.conteggi[_indice(us)] += 1
+        if not self.n or us < self.minimo:
+            self.minimo = us
+        if us > self.massimo:
+            self.massimo = us
+        self.n += 1
+        self.somma += us
+
+    def percentile(self, p: float) -> int:
+        """Limite superiore del bucket che contiene il p-esimo quantile (p in [0, 1])."""
+        if not self.n:
+            return 0
+        soglia = max(1, int(p * self.n + 0.999999))
+        visti = 0
+        for idx, c in enumerate(self.conteggi):
+            visti += c
+            if visti >= soglia:
+                return min(_limite_superiore(idx), self.massimo)
+        return self.massimo
+
+    def cumulativo_fino_a(self, us: int) -> int:
+        return sum(c for idx, c in enumerate(self.conteggi) if c and _limite_superiore(idx) <= us)
+
+    def unisci(self, altro: "Istogramma") -> None:
+        if not altro.n:
+            return
+        for idx, c in enumerate(altro.conteggi):
+            if c:
+                self.conteggi[idx] += c
+        self.minimo = min(self.minimo, altro.minimo) if self.n else altro.minimo
+        self.massimo = max(self.massimo, altro.massimo)
+        self.n += altro.n
+        self.somma += altro.somma
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "n": self.n, "somma_us": self.somma, "min_us": self.minimo, "max_us": self.massimo,
+            # bucket sparsi: il dump resta piccolo e si può riunire con altri processi
+            "bucket": {str(i): c for i, c in enumerate(self.conteggi) if c},
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> "Istogramma":
+        h = cls()
+        for idx, c in d.get("bucket", {}).items():
+            h.conteggi[int(idx)] = c
+        h.n, h.somma, h.minimo, h.massimo = d["n"], d["somma_us"], d["min_us"], d["max_us"]
+        return h
+
+
+# ----------------------------
+# Registro delle operazioni
+# ----------------------------
+class MetricaOperazione:
+    __slots__ = ("latenza", "errori", "statement", "_lock")
+
+    def __init__(self):
+        self.latenza = Istogramma()
+        self.errori = 0
+        self.statement = 0
+        self._lock = threading.Lock()
+
+    def registra(self, us: int, statement: int, errore: bool) -> None:
+        with self._lock:
+            self.latenza.registra(us)
+            self.statement += statement
+            if errore:
+                self.errori += 1
+
+
+class Registro:
+    def __init__(self):
+        self._operazioni: dict[str, MetricaOperazione] = {}
+        self._lock = threading.Lock()
+
+    def operazione(self, nome: str) -> MetricaOperazione:
+        m = self._operazioni.get(nome)
+        if m is None:
+            with self._lock:
+                m = self._operazioni.setdefault(nome, MetricaOperazione())
+        return m
+
+    def to_dict(self) -> dict[str, Any]:
+        out = {}
+        for nome in sorted(self._operazioni):
+            m = self._operazioni[nome]
+            with m._lock:
+                if not m.latenza.n:
+                    continue
+                out[nome] = {"errori": m.errori, "statement": m.statement, "latenza": m.latenza.to_dict()}
+        return out
+
+    def unisci(self, dati: dict[str, Any]) -> None:
+        """Aggiunge un dump di to_dict() (es. di un processo worker)."""
+        for nome, d in dati.items():
+            m = self.operazione(nome)
+            with m._lock:
+                m.latenza.unisci(Istogramma.from_dict(d["latenza"]))
+                m.errori += d["errori"]
+                m.statement += d["statement"]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._operazioni.clear()
+
+
+REGISTRY = Registro()
+
+
+# ----------------------------
+# Esportazione: JSON riassuntivo e testo Prometheus
+# ----------------------------
+def riepilogo(dati: dict[str, Any]) -> dict[str, Any]:
+    out = {}
+    for nome, d in dati.items():
+        h = Istogramma.from_dict(d["latenza"])
+        out[nome] = {
+            "chiamate": h.n, "errori": d["errori"], "statement": d["statement"],
+            "media_ms": round(h.somma / h.n / 1000, 3) if h.n else 0.0,
+            "min_ms": round(h.minimo / 1000, 3), "max_ms": round(h.massimo / 1000, 3),
+            **{f"{etichetta}_ms": round(h.percentile(q) / 1000, 3) for etichetta, q in QUANTILI.items()},
+        }
+    return out
+
+def prometheus(dati: dict[str, Any]) -> str:
+    righe = [
+        "# HELP glowhub_op_latency_seconds Latenza delle operazioni CRUD e dei report.",
+        "# TYPE glowhub_op_latency_seconds histogram",
+    ]
+    quantili, errori, statement = [], [], []
+    for nome, d in dati.items():
+        h = Istogramma.from_dict(d["latenza"])
+        for le in LE_SECONDI:
+            righe.append(f'glowhub_op_latency_seconds_bucket{{op="{nome}",le="{le}"}} {h.cumulativo_fino_a(int(le * 1_000_000))}')
+        righe.append(f'glowhub_op_latency_seconds_bucket{{op="{nome}",le="+Inf"}} {h.n}')
+        righe.append(f'glowhub_op_latency_seconds_sum{{op="{nome}"}} {h.somma / 1_000_000:.6f}')
+        righe.append(f'glowhub_op_latency_seconds_count{{op="{nome}"}} {h.n}')
+        quantili += [f'glowhub_op_latency_quantile_seconds{{op="{nome}",quantile="{q}"}} {h.percentile(q) / 1_000_000:.6f}' for q in QUANTILI.values()]
+        errori.append(f'glowhub_op_errors_total{{op="{nome}"}} {d["errori"]}')
+        statement.append(f'glowhub_op_statements_total{{op="{nome}"}} {d["statement"]}')
+    righe += ["# HELP glowhub_op_latency_quantile_seconds Quantili dall'istogramma HDR.",
+              "# TYPE glowhub_op_latency_quantile_seconds gauge", *quantili]
+    righe += ["# HELP glowhub_op_errors_total Operazioni terminate con eccezione.",
+              "# TYPE glowhub_op_errors_total counter", *errori]
+    righe += ["# HELP glowhub_op_statements_total Statement SQL eseguiti dalle operazioni.",
+              "# TYPE glowhub_op_statements_total counter", *statement]
+    return "\n".join(righe) + "\n"
+
+def dump(path: str | Path, registro: Registro | None = None) -> None:
+    """Scrive il dump grezzo (bucket inclusi) in modo atomico; `metrics` lo converte."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps((registro or REGISTRY).to_dict()), encoding="utf-8")
+    os.replace(tmp, path)
+
+def leggi_dump(path: str | Path) -> dict[str, Any]:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+# ----------------------------
+# Strumentazione: wrapper su crud, statement marcati per i report
+# ----------------------------
+_corrente: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar("glowhub_op", default=None)
+OPZIONE_REPORT = "glowhub_op"
+_installato = False
+_install_lock = threading.Lock()
+
+def misura(nome: str, fn: Callable) -> Callable:
+    m = REGISTRY.operazione(nome)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        padre = _corrente.get()
+        contatore = [0]
+        token = _corrente.set(contatore)
+        errore = False
+        t0 = time.perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            errore = True
+            raise
+        finally:
+            m.registra((time.perf_counter_ns() - t0) // 1000, contatore[0], errore)
+            _corrente.reset(token)
+            if padre is not None:
+                padre[0] += contatore[0]
+    wrapper.__glowhub_misura__ = True
+    return wrapper
+
+def marca_report(nome: str, fn: Callable) -> Callable:
+    """Il q_* costruisce solo lo statement: la latenza si misura sull'esecuzione."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return fn(*args, **kwargs).execution_options(**{OPZIONE_REPORT: nome})
+    wrapper.__glowhub_misura__ = True
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    contatore = _corrente.get()
+    if contatore is not None:
+        contatore[0] += 1
+    if context is not None and OPZIONE_REPORT in context.execution_options:
+        context._glowhub_t0 = time.perf_counter_ns()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    t0 = getattr(context, "_glowhub_t0", None)
+    if t0 is not None:
+        REGISTRY.operazione(context.execution_options[OPZIONE_REPORT]).registra((time.perf_counter_ns() - t0) // 1000, 1, False)
+
+def _handle_error(ctx):
+    contesto = ctx.execution_context
+    t0 = getattr(contesto, "_glowhub_t0", None)
+    if t0 is not None:
+        REGISTRY.operazione(contesto.execution_options[OPZIONE_REPORT]).registra((time.perf_counter_ns() - t0) // 1000, 1, True)
+
+
+def instrument() -> None:
+    """Avvolge le funzioni pubbliche di crud (firma fn(session, ...)) e i q_* di
+    queries, e registra i listener sugli Engine. Idempotente.
+
+    Sostituisce gli attributi dei moduli: gli altri moduli chiamano queste
+    funzioni come crud.nome(...), non importandole per nome.
+    """
+    global _installato
+    from . import crud, queries, reportcache
+
+    with _install_lock:
+        if _installato:
+            return
+        for nome, fn in list(vars(crud).items()):
+            if (not nome.startswith("_") and inspect.isfunction(fn) and fn.__module__ == crud.__name__
+                    and next(iter(inspect.signature(fn).parameters), None) == "session"):
+                setattr(crud, nome, misura(f"crud.{nome}", fn))
+        for nome, fn in list(vars(queries).items()):
+            if nome.startswith("q_") and inspect.isfunction(fn):
+                setattr(queries, nome, marca_report(f"queries.{nome}", fn))
+        # il registro dei report tiene riferimenti alle funzioni originali
+        for nome, fn in list(reportcache.REPORTS.items()):
+            reportcache.REPORTS[nome] = getattr(queries, fn.__name__, fn)
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+        _installato = True
+
+
+# ----------------------------
+# Dump periodico su file (processi di lunga durata)
+# ----------------------------
+def avvia_dump_periodico(path: str | Path, intervallo: float = 15.0) -> threading.Event:
+    """Scrive il dump ogni `intervallo` secondi e all'uscita; set() sull'evento lo ferma."""
+    stop = threading.Event()
+
+    def ciclo():
+        while not stop.wait(intervallo):
+            dump(path)
+
+    threading.Thread(target=ciclo, name="metrics-dump", daemon=True).start()
+    atexit.register(dump, path)
+    return stop
@@ -52,6 +52,26 @@ class CouponTipo(str, enum.Enum):
     FISSO = "FISSO"
 
 
+class PagamentoTipo(str, enum.Enum):
+    INCASSO = "INCASSO"
+    RIMBORSO = "RIMBORSO"
+
+
+class TipoAnomalia(str, enum.Enum):
+    MANCANTE_IN_DB = "MANCANTE_IN_DB"
+    MANCANTE_NEL_FILE = "MANCANTE_NEL_FILE"
+    DUPLICATO = "DUPLICATO"
+    IMPORTO_DIVERSO = "IMPORTO_DIVERSO"
+    ESITO_DIVERSO = "ESITO_DIVERSO"
+    NON_VALIDA = "NON_VALIDA"
+
+
+class StatoPropostaRiordino(str, enum.Enum):
+    BOZZA = "BOZZA"
+    CONFERMATA = "CONFERMATA"
+    ANNULLATA = "ANNULLATA"
+
+
 class StatoReso(str, enum.Enum):
     APERTO = "APERTO"
     APPROVATO = "APPROVATO"
@@ -93,6 +113,22 @@ class Cliente(Base):
         return f"Cliente(id={self.idCliente}, email={self.email!r})"
 
 
+class AuditCancellazione(Base):
+    __tablename__ = "AUDIT_CANCELLAZIONE"
+
+    # una riga per chunk della pipeline di cancellazione/anonimizzazione (GDPR)
+    idAudit: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    dataEsecuzione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    richiesti: Mapped[int] = mapped_column(Integer, nullable=False)
+    clientiCancellati: Mapped[int] = mapped_column(Integer, nullable=False)
+    clientiAnonimizzati: Mapped[int] = mapped_column(Integer, nullable=False)
+    indirizziCancellati: Mapped[int] = mapped_column(Integer, nullable=False)
+    indirizziAnonimizzati: Mapped[int] = mapped_column(Integer, nullable=False)
+    carrelli: Mapped[int] = mapped_column(Integer, nullable=False)
+    vociCarrello: Mapped[int] = mapped_column(Integer, nullable=False)
+    recensioni: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
 class Indirizzo(Base):
     __tablename__ = "INDIRIZZO"
 
@@ -170,6 +206,21 @@ class Prodotto(Base):
         return f"Prodotto(sku={self.sku!r}, nome={self.nome!r})"
 
 
+class StoricoPrezzo(Base):
+    __tablename__ = "STORICO_PREZZO"
+
+    idStorico: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    sku: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
+
+    prezzoPrecedente: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    prezzoNuovo: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    dataModifica: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("idx_storicoprezzo_sku_data", "sku", "dataModifica"),
+    )
+
+
 class Carrello(Base):
     __tablename__ = "CARRELLO"
 
@@ -178,6 +229,8 @@ class Carrello(Base):
 
     dataCreazione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     dataUltimaModifica: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    # versione per il controllo ottimistico (UPDATE ... WHERE versione = :letta)
+    versione: Mapped[int] = mapped_column(Integer, nullable=False, server_default="1")
 
     cliente: Mapped["Cliente"] = relationship(back_populates="carrello")
     voci: Mapped[list["VoceCarrello"]] = relationship(
@@ -186,6 +239,8 @@ class Carrello(Base):
         passive_deletes=True
     )
 
+    __mapper_args__ = {"version_id_col": versione}
+
     def __repr__(self) -> str:
         return f"Carrello(id={self.idCarrello}, idCliente={self.idCliente})"
 
@@ -210,6 +265,26 @@ class VoceCarrello(Base):
         Index("idx_vocecarrello_sku", "sku"),
         CheckConstraint("quantita > 0", name="ck_vocecarrello_quantita_pos"),
         CheckConstraint("prezzoVisto >= 0", name="ck_vocecarrello_prezzo_pos"),
+        # id mai riutilizzati su SQLite: l'archivio è indicizzato su idVoceCarrello
+        {"sqlite_autoincrement": True},
+    )
+
+
+class VoceCarrelloArchivio(Base):
+    __tablename__ = "VOCE_CARRELLO_ARCHIVIO"
+
+    # righe dei carrelli abbandonati rimosse dallo sweeper (nessuna FK: il carrello può sparire)
+    idVoceCarrello: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    idCarrello: Mapped[int] = mapped_column(Integer, nullable=False)
+    sku: Mapped[str] = mapped_column(String(32), nullable=False)
+
+    quantita: Mapped[int] = mapped_column(Integer, nullable=False)
+    prezzoVisto: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    dataAggiunta: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    dataArchiviazione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("idx_vocecarrelloarchivio_carrello", "idCarrello"),
     )
 
 
@@ -225,6 +300,7 @@ class Ordine(Base):
     totaleLordo: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
     totaleSconti: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
     totaleNetto: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    versione: Mapped[int] = mapped_column(Integer, nullable=False, server_default="1")
 
     cliente: Mapped["Cliente"] = relationship(back_populates="ordini")
     indirizzo_spedizione: Mapped["Indirizzo"] = relationship(back_populates="ordini_spediti")
@@ -252,9 +328,12 @@ class Ordine(Base):
 
     __table_args__ = (
         Index("idx_ordine_cliente_data", "idCliente", "dataCreazione"),
+        # coda di evasione: ordini PAGATO dal più vecchio
+        Index("idx_ordine_stato_data", "statoOrdine", "dataCreazione"),
         CheckConstraint("totaleLordo >= 0 AND totaleSconti >= 0 AND totaleNetto >= 0", name="ck_totali_nonneg"),
         CheckConstraint("ABS(totaleNetto - (totaleLordo - totaleSconti)) < 0.01", name="ck_totaleNetto_coerente"),
     )
+    __mapper_args__ = {"version_id_col": versione}
 
 
 class RigaOrdine(Base):
@@ -291,6 +370,10 @@ class MetodoPagamento(Base):
 
     pagamenti: Mapped[list["Pagamento"]] = relationship(back_populates="metodo")
 
+    __table_args__ = (
+        UniqueConstraint("nomeMetodo", name="uq_metodopagamento_nome"),
+    )
+
 
 class Pagamento(Base):
     __tablename__ = "PAGAMENTO"
@@ -303,12 +386,18 @@ class Pagamento(Base):
     dataOra: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     esito: Mapped[EsitoPagamento] = mapped_column(Enum(EsitoPagamento), nullable=False)
     transactionId: Mapped[str | None] = mapped_column(String(80), unique=True)
+    # i rimborsi sono righe positive con tipo RIMBORSO (importo >= 0 resta valido)
+    tipo: Mapped[PagamentoTipo] = mapped_column(
+        Enum(PagamentoTipo), nullable=False, default=PagamentoTipo.INCASSO, server_default=PagamentoTipo.INCASSO.value
+    )
 
     ordine: Mapped["Ordine"] = relationship(back_populates="pagamenti")
     metodo: Mapped["MetodoPagamento"] = relationship(back_populates="pagamenti")
 
     __table_args__ = (
         Index("idx_pagamento_ordine_data", "idOrdine", "dataOra"),
+        # riconciliazione: pagamenti del periodo assenti dal file di settlement
+        Index("idx_pagamento_data", "dataOra"),
         CheckConstraint("importo >= 0", name="ck_pagamento_importo_pos"),
     )
 
@@ -322,6 +411,10 @@ class Corriere(Base):
 
     spedizioni: Mapped[list["Spedizione"]] = relationship(back_populates="corriere")
 
+    __table_args__ = (
+        UniqueConstraint("nome", name="uq_corriere_nome"),
+    )
+
 
 class Spedizione(Base):
     __tablename__ = "SPEDIZIONE"
@@ -334,6 +427,8 @@ class Spedizione(Base):
     statoSpedizione: Mapped[StatoSpedizione] = mapped_column(Enum(StatoSpedizione), nullable=False)
     dataSpedizione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     dataStimataConsegna: Mapped[date | None] = mapped_column(Date)
+    # timestamp dell'ultimo evento corriere applicato (scarta eventi fuori ordine)
+    dataUltimoAggiornamento: Mapped[datetime | None] = mapped_column(DateTime)
 
     ordine: Mapped["Ordine"] = relationship(back_populates="spedizioni")
     corriere: Mapped["Corriere"] = relationship(back_populates="spedizioni")
@@ -344,6 +439,73 @@ class Spedizione(Base):
     )
 
 
+class TempoConsegna(Base):
+    __tablename__ = "TEMPO_CONSEGNA"
+
+    # giorni di transito per corriere e provincia di destinazione; provincia "*" = tutte
+    idCorriere: Mapped[int] = mapped_column(ForeignKey("CORRIERE.idCorriere", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    provincia: Mapped[str] = mapped_column(String(40), primary_key=True)
+    campioni: Mapped[int] = mapped_column(Integer, nullable=False)
+    giorniP50: Mapped[int] = mapped_column(Integer, nullable=False)
+    giorniP80: Mapped[int] = mapped_column(Integer, nullable=False)
+    giorniP95: Mapped[int] = mapped_column(Integer, nullable=False)
+    dataCalcolo: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class StagingTracking(Base):
+    __tablename__ = "STAGING_TRACKING"
+
+    # area di appoggio per l'import dei feed corriere: un lotto per chunk
+    idLotto: Mapped[str] = mapped_column(String(36), primary_key=True)
+    tracking: Mapped[str] = mapped_column(String(80), primary_key=True)
+
+    statoSpedizione: Mapped[StatoSpedizione] = mapped_column(Enum(StatoSpedizione), nullable=False)
+    dataEvento: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class Riconciliazione(Base):
+    __tablename__ = "RICONCILIAZIONE"
+
+    # una riga per file di settlement riconciliato
+    idRiconciliazione: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    nomeFile: Mapped[str] = mapped_column(String(255), nullable=False)
+    dataEsecuzione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    righe: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    confermati: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    ordiniAggiornati: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    mancantiInDb: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    mancantiNelFile: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    duplicati: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    importoDiverso: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    esitoDiverso: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    nonValide: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class AnomaliaRiconciliazione(Base):
+    __tablename__ = "ANOMALIA_RICONCILIAZIONE"
+
+    idAnomalia: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    idRiconciliazione: Mapped[int] = mapped_column(ForeignKey("RICONCILIAZIONE.idRiconciliazione", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
+    tipo: Mapped[TipoAnomalia] = mapped_column(Enum(TipoAnomalia), nullable=False)
+    transactionId: Mapped[str | None] = mapped_column(String(80))
+    # numero di riga nel file (NULL per i pagamenti assenti dal file)
+    riga: Mapped[int | None] = mapped_column(Integer)
+    importoFile: Mapped[float | None] = mapped_column(Numeric(10, 2))
+    importoDb: Mapped[float | None] = mapped_column(Numeric(10, 2))
+
+    __table_args__ = (
+        Index("idx_anomalia_riconciliazione_tipo", "idRiconciliazione", "tipo"),
+    )
+
+
+class StagingRiconciliazione(Base):
+    __tablename__ = "STAGING_RICONCILIAZIONE"
+
+    # transactionId già letti dal file in corso: duplicati fra chunk e anti-join finale
+    idRiconciliazione: Mapped[int] = mapped_column(Integer, primary_key=True)
+    transactionId: Mapped[str] = mapped_column(String(80), primary_key=True)
+
+
 class Magazzino(Base):
     __tablename__ = "MAGAZZINO"
 
@@ -404,6 +566,131 @@ class FornituraProdotto(Base):
     )
 
 
+class PropostaRiordino(Base):
+    __tablename__ = "PROPOSTA_RIORDINO"
+
+    idProposta: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    idMagazzino: Mapped[int] = mapped_column(ForeignKey("MAGAZZINO.idMagazzino", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
+    sku: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="RESTRICT", onupdate="CASCADE"), nullable=False)
+    idFornitore: Mapped[int] = mapped_column(ForeignKey("FORNITORE.idFornitore", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
+
+    quantita: Mapped[int] = mapped_column(Integer, nullable=False)
+    prezzoAcquisto: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    costoTotale: Mapped[float] = mapped_column(Numeric(12, 2), nullable=False)
+    leadTimeGiorni: Mapped[int] = mapped_column(Integer, nullable=False)
+    dataCreazione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    stato: Mapped[StatoPropostaRiordino] = mapped_column(Enum(StatoPropostaRiordino), nullable=False, default=StatoPropostaRiordino.BOZZA)
+
+    __table_args__ = (
+        Index("idx_propostariordino_stato", "stato"),
+        Index("idx_propostariordino_magazzino_sku", "idMagazzino", "sku"),
+        CheckConstraint("quantita > 0", name="ck_propostariordino_quantita_pos"),
+    )
+
+
+class DomandaGiornaliera(Base):
+    __tablename__ = "DOMANDA_GIORNALIERA"
+
+    # aggregato giornaliero delle quantità vendute per sku (alimentato in modo incrementale)
+    sku: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    giorno: Mapped[date] = mapped_column(Date, primary_key=True)
+
+    quantita: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("idx_domandagiornaliera_giorno", "giorno"),
+    )
+
+
+class StatoJob(Base):
+    __tablename__ = "STATO_JOB"
+
+    # watermark dei job batch incrementali
+    nomeJob: Mapped[str] = mapped_column(String(60), primary_key=True)
+    ultimaData: Mapped[datetime | None] = mapped_column(DateTime)
+    ultimoId: Mapped[int | None] = mapped_column(Integer)
+    dataEsecuzione: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class VersioneTabella(Base):
+    __tablename__ = "VERSIONE_TABELLA"
+
+    # contatore incrementato dalle scritture: invalida la cache dei report
+    nomeTabella: Mapped[str] = mapped_column(String(64), primary_key=True)
+    versione: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class EventoOutbox(Base):
+    __tablename__ = "EVENTO_OUTBOX"
+
+    # id monotono (mai riutilizzato): i consumer leggono per idEvento crescente
+    idEvento: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    aggregato: Mapped[str] = mapped_column(String(20), nullable=False)
+    chiave: Mapped[str] = mapped_column(String(80), nullable=False)
+    tipoEvento: Mapped[str] = mapped_column(String(40), nullable=False)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    dataEvento: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("idx_outbox_aggregato_chiave", "aggregato", "chiave", "idEvento"),
+        {"sqlite_autoincrement": True},
+    )
+
+
+class SegmentoCliente(Base):
+    __tablename__ = "SEGMENTO_CLIENTE"
+
+    # aggregati RFM per cliente (ordini non annullati) e punteggi per quintile 1..5
+    idCliente: Mapped[int] = mapped_column(ForeignKey("CLIENTE.idCliente", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    ultimoOrdine: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    ordini: Mapped[int] = mapped_column(Integer, nullable=False)
+    spesaTotale: Mapped[float] = mapped_column(Numeric(12, 2), nullable=False)
+    punteggioR: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    punteggioF: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    punteggioM: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    segmento: Mapped[str | None] = mapped_column(String(20))
+    dataCalcolo: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("idx_segmentocliente_segmento", "segmento"),
+    )
+
+
+class CooccorrenzaProdotto(Base):
+    __tablename__ = "COOCCORRENZA_PRODOTTO"
+
+    # ordini che contengono entrambi gli sku (simmetrica); sku == skuAssociato: ordini con lo sku
+    sku: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    skuAssociato: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    ordini: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class ConsiglioProdotto(Base):
+    __tablename__ = "CONSIGLIO_PRODOTTO"
+
+    # top-K "spesso comprati insieme" per sku, letti con la sola PK
+    sku: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    posizione: Mapped[int] = mapped_column(Integer, primary_key=True)
+    skuConsigliato: Mapped[str] = mapped_column(ForeignKey("PRODOTTO.sku", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
+    ordiniInsieme: Mapped[int] = mapped_column(Integer, nullable=False)
+    confidenza: Mapped[float] = mapped_column(Numeric(5, 4), nullable=False)
+
+
+class LeasePreparazione(Base):
+    __tablename__ = "LEASE_PREPARAZIONE"
+
+    # ordine IN_PREPARAZIONE preso in carico da un worker fino a `scadenza`
+    idOrdine: Mapped[int] = mapped_column(ForeignKey("ORDINE.idOrdine", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    worker: Mapped[str] = mapped_column(String(60), nullable=False)
+    dataPresaInCarico: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    scadenza: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("idx_lease_scadenza", "scadenza"),
+        Index("idx_lease_worker", "worker"),
+    )
+
+
 class Coupon(Base):
     __tablename__ = "COUPON"
 
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Iterator, Sequence
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session, aliased
+
+from .jobs import get_stato_job, now_dt, set_watermark
+from .models import EsitoPagamento, EventoOutbox, Ordine, Pagamento, PagamentoTipo, Spedizione, StatoJob, StatoOrdine, StatoSpedizione
+
+PREFISSO_CONSUMER = "outbox:"
+
+
+@dataclass(frozen=True)
+class Evento:
+    idEvento: int
+    aggregato: str
+    chiave: str
+    tipoEvento: str
+    dati: dict[str, Any]
+    dataEvento: datetime
+
+
+@dataclass
+class EsitoCompattazione:
+    consegnati: int
+    superati: int
+
+
+def _json(dati: dict[str, Any]) -> str:
+    return json.dumps(dati, separators=(",", ":"), default=str)
+
+
+# ----------------------------
+# Scrittura: nella stessa transazione della modifica (nessun commit qui)
+# ----------------------------
+def emit(session: Session, aggregato: str, chiave: str, tipo: str, dati: dict[str, Any]) -> None:
+    session.add(EventoOutbox(
+        aggregato=aggregato, chiave=chiave, tipoEvento=tipo, payload=_json(dati), dataEvento=now_dt()
+    ))
+
+def emit_many(session: Session, eventi: Sequence[tuple[str, str, str, dict[str, Any]]]) -> None:
+    """Inserimento bulk di (aggregato, chiave, tipo, dati) per le operazioni set-based."""
+    if not eventi:
+        return
+    adesso = now_dt()
+    session.execute(insert(EventoOutbox), [
+        {"aggregato": a, "chiave": k, "tipoEvento": t, "payload": _json(d), "dataEvento": adesso}
+        for a, k, t, d in eventi
+    ])
+
+def emit_ordine(session: Session, ordine: Ordine, tipo: str) -> None:
+    # ogni evento porta lo stato completo dell'aggregato: la compattazione può tenere solo l'ultimo
+    emit(session, "ORDINE", str(ordine.idOrdine), tipo, {
+        "idOrdine": ordine.idOrdine,
+        "idCliente": ordine.idCliente,
+        "statoOrdine": ordine.statoOrdine.value,
+        "totaleNetto": ordine.totaleNetto,
+    })
+
+def evento_ordine(id_ordine: int, id_cliente: int, stato: StatoOrdine, totale_netto, tipo: str) -> tuple[str, str, str, dict[str, Any]]:
+    return ("ORDINE", str(id_ordine), tipo, {
+        "idOrdine": id_ordine, "idCliente": id_cliente, "statoOrdine": stato.value, "totaleNetto": totale_netto,
+    })
+
+def emit_spedizione(session: Session, s: Spedizione, tipo: str) -> None:
+    emit(session, *evento_spedizione(s.tracking, s.idOrdine, s.idCorriere, s.statoSpedizione, tipo))
+
+def evento_spedizione(tracking: str, id_ordine: int, id_corriere: int, stato: StatoSpedizione, tipo: str) -> tuple[str, str, str, dict[str, Any]]:
+    return ("SPEDIZIONE", tracking, tipo, {
+        "idOrdine": id_ordine, "idCorriere": id_corriere, "tracking": tracking, "statoSpedizione": stato.value,
+    })
+
+def evento_pagamento(
+    id_pagamento: int, id_ordine: int, importo, esito: EsitoPagamento, tipo_pagamento: PagamentoTipo, tipo: str
+) -> tuple[str, str, str, dict[str, Any]]:
+    return ("PAGAMENTO", str(id_pagamento), tipo, {
+        "idPagamento": id_pagamento, "idOrdine": id_ordine, "importo": importo,
+        "esito": esito.value, "tipo": tipo_pagamento.value,
+    })
+
+def emit_pagamento(session: Session, p: Pagamento, tipo: str) -> None:
+    """Richiede idPagamento: il chiamante fa flush prima."""
+    emit_many(session, [evento_pagamento(p.idPagamento, p.idOrdine, p.importo, p.esito, p.tipo, tipo)])
+
+def chiave_scorta(id_magazzino: int, sku: str) -> str:
+    return f"{id_magazzino}:{sku}"
+
+def evento_scorta(id_magazzino: int, sku: str, giacenza: int, soglia: int) -> tuple[str, str, str, dict[str, Any]]:
+    return ("SCORTA", chiave_scorta(id_magazzino, sku), "SCORTA_AGGIORNATA", {
+        "idMagazzino": id_magazzino, "sku": sku, "giacenza": giacenza, "sogliaRiordino": soglia,
+    })
+
+
+# ----------------------------
+# Lettura a lotti per id crescente, ack e compattazione
+# ----------------------------
+def _job(consumatore: str) -> str:
+    return PREFISSO_CONSUMER + consumatore
+
+def leggi(session: Session, consumatore: str, limite: int = 500, ritardo: float = 0.0) -> list[Evento]:
+    """Eventi successivi all'ultimo ack del consumer.
+
+    Su MySQL gli id possono diventare visibili fuori ordine fra transazioni
+    concorrenti: con `ritardo` (secondi) si leggono solo eventi più vecchi.
+    """
+    stato = get_stato_job(session, _job(consumatore))
+    dopo = stato.ultimoId if stato and stato.ultimoId else 0
+    q = select(EventoOutbox).where(EventoOutbox.idEvento > dopo)
+    if ritardo:
+        q = q.where(EventoOutbox.dataEvento <= now_dt() - timedelta(seconds=ritardo))
+    rows = session.scalars(q.order_by(EventoOutbox.idEvento).limit(limite))
+    return [
+        Evento(e.idEvento, e.aggregato, e.chiave, e.tipoEvento, json.loads(e.payload), e.dataEvento)
+        for e in rows
+    ]
+
+def ack(session: Session, consumatore: str, id_evento: int) -> None:
+    stato = get_stato_job(session, _job(consumatore))
+    if stato and stato.ultimoId and stato.ultimoId >= id_evento:
+        return
+    set_watermark(session, _job(consumatore), ultimo_id=id_evento)
+    session.commit()
+
+def consuma(
+    session: Session,
+    consumatore: str,
+    gestore: Callable[[list[Evento]], None],
+    limite: int = 500,
+    ritardo: float = 0.0,
+) -> Iterator[int]:
+    """Passa i lotti a `gestore` e fa ack dopo ciascuno (at-least-once)."""
+    while True:
+        eventi = leggi(session, consumatore, limite, ritardo)
+        if not eventi:
+            return
+        gestore(eventi)
+        ack(session, consumatore, eventi[-1].idEvento)
+        yield len(eventi)
+
+def compatta(session: Session, per_chiave: bool = True, chunk_size: int = 5000) -> EsitoCompattazione:
+    """Elimina gli eventi già confermati da tutti i consumer e, con `per_chiave`,
+    quelli superati da un evento più recente dello stesso aggregato."""
+    minimo = session.scalar(
+        select(func.min(func.coalesce(StatoJob.ultimoId, 0))).where(StatoJob.nomeJob.like(PREFISSO_CONSUMER + "%"))
+    )
+    consegnati = 0
+    if minimo:
+        consegnati = session.execute(delete(EventoOutbox).where(EventoOutbox.idEvento <= minimo)).rowcount
+
+    superati = 0
+    if per_chiave:
+        # id letti prima della DELETE: MySQL non ammette la stessa tabella nella subquery
+        recente = aliased(EventoOutbox)
+        ids = list(session.scalars(
+            select(EventoOutbox.idEvento).distinct()
+            .join(recente, (recente.aggregato == EventoOutbox.aggregato)
+                  & (recente.chiave == EventoOutbox.chiave)
+                  & (recente.idEvento > EventoOutbox.idEvento))
+        ))
+        for start in range(0, len(ids), chunk_size):
+            superati += session.execute(
+                delete(EventoOutbox).where(EventoOutbox.idEvento.in_(ids[start:start + chunk_size]))
+            ).rowcount
+    session.commit()
+    return EsitoCompattazione(consegnati, superati)
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date
+from decimal import Decimal
+from typing import Iterable, Iterator, Mapping, Sequence
+
+import numpy as np
+from sqlalchemy import exists, select
+from sqlalchemy.orm import Session
+
+from .models import Carrello, CouponTipo, Prodotto, VoceCarrello
+from .refdata import CouponRef, get_refdata
+
+
+# ----------------------------
+# Input / output del motore prezzi
+# ----------------------------
+@dataclass(frozen=True)
+class RigaInput:
+    sku: str
+    quantita: int
+    prezzoUnitario: Decimal
+    aliquotaIVA: Decimal
+
+
+@dataclass(frozen=True)
+class RigaPrezzata:
+    sku: str
+    quantita: int
+    prezzoUnitario: Decimal
+    aliquotaIVA: Decimal
+    lordo: Decimal
+    scontoPromo: Decimal
+    scontoCoupon: Decimal
+    scontoRiga: Decimal
+    netto: Decimal
+    imponibile: Decimal
+    iva: Decimal
+
+
+@dataclass(frozen=True)
+class PrezzoCarrello:
+    idCarrello: int | None
+    righe: tuple[RigaPrezzata, ...]
+    totaleLordo: Decimal
+    scontoPromo: Decimal
+    scontoCoupon: Decimal
+    totaleSconti: Decimal
+    totaleNetto: Decimal
+    imponibile: Decimal
+    iva: Decimal
+    codiceCoupon: str | None
+    erroreCoupon: str | None
+
+
+def _cents(x) -> int:
+    return int((Decimal(str(x)) * 100).to_integral_value())
+
+def _bp(x) -> int:
+    # percentuali in centesimi di punto (22.00% -> 2200)
+    return int((Decimal(str(x)) * 100).to_integral_value())
+
+def _dec(cents) -> Decimal:
+    return Decimal(int(cents)).scaleb(-2)
+
+def _div_half_up(num: np.ndarray, den: np.ndarray | int) -> np.ndarray:
+    # divisione intera con arrotondamento commerciale (valori non negativi)
+    return (2 * num + den) // (2 * den)
+
+
+def valida_coupon(coupon: CouponRef | None, codice: str | None, lordo_cents: int, oggi: date) -> str | None:
+    """Motivo per cui il coupon non si applica, oppure None."""
+    if not codice:
+        return None
+    if coupon is None:
+        return "Coupon non valido"
+    if not (coupon.dataInizio <= oggi <= coupon.dataFine):
+        return "Coupon non attivo"
+    if lordo_cents < _cents(coupon.minimoOrdine):
+        return "Totale ordine sotto minimo coupon"
+    return None
+
+
+# ----------------------------
+# Calcolo vettoriale su tutte le righe di tutti i carrelli
+# ----------------------------
+def calcola(
+    carrelli: Sequence[tuple[int | None, Sequence[RigaInput], str | None]],
+    coupon: Mapping[str, CouponRef],
+    promozioni: Mapping[str, Decimal] | None = None,
+    oggi: date | None = None,
+) -> list[PrezzoCarrello]:
+    """Prezza un lotto di carrelli (id, righe, codice coupon).
+
+    Tutti gli importi sono gestiti in centesimi interi. I prezzi si intendono
+    IVA inclusa: lo sconto coupon è ripartito sulle righe in proporzione al
+    loro importo (metodo dei resti maggiori, la somma torna al centesimo) e
+    l'IVA è scorporata dal netto di riga.
+    """
+    oggi = oggi or date.today()
+    promozioni = promozioni or {}
+    n_carrelli = len(carrelli)
+
+    idx, qta, prezzo, iva_bp, promo_bp = [], [], [], [], []
+    for i, (_id, righe, _codice) in enumerate(carrelli):
+        for r in righe:
+            idx.append(i)
+            qta.append(r.quantita)
+            prezzo.append(_cents(r.prezzoUnitario))
+            iva_bp.append(_bp(r.aliquotaIVA))
+            promo_bp.append(_bp(promozioni.get(r.sku, 0)))
+    idx = np.asarray(idx, dtype=np.int64)
+    qta = np.asarray(qta, dtype=np.int64)
+    iva_bp = np.asarray(iva_bp, dtype=np.int64)
+
+    lordo = qta * np.asarray(prezzo, dtype=np.int64)
+    promo = _div_half_up(lordo * np.asarray(promo_bp, dtype=np.int64), 10000)
+    base = lordo - promo
+
+    lordo_c = np.bincount(idx, weights=lordo, minlength=n_carrelli).astype(np.int64)
+    base_c = np.bincount(idx, weights=base, minlength=n_carrelli).astype(np.int64)
+
+    # sconto coupon per carrello
+    coupon_c = np.zeros(n_carrelli, dtype=np.int64)
+    errori: list[str | None] = []
+    for i, (_id, _righe, codice) in enumerate(carrelli):
+        c = coupon.get(codice) if codice else None
+        errore = valida_coupon(c, codice, int(lordo_c[i]), oggi)
+        errori.append(errore)
+        if c is None or errore:
+            continue
+        if c.tipo == CouponTipo.PERCENTUALE:
+            coupon_c[i] = _div_half_up(np.int64(base_c[i]) * _bp(c.valore), 10000)
+        else:
+            coupon_c[i] = min(_cents(c.valore), int(base_c[i]))
+
+    # ripartizione sulle righe: quota intera + resti maggiori
+    den = np.maximum(base_c[idx], 1)
+    quota = coupon_c[idx] * base
+    alloc = quota // den
+    resto = quota % den
+    mancanti = coupon_c - np.bincount(idx, weights=alloc, minlength=n_carrelli).astype(np.int64)
+    ordine = np.lexsort((-resto, idx))
+    inizio = np.searchsorted(idx[ordine], np.arange(n_carrelli))
+    pos = np.empty_like(ordine)
+    pos[ordine] = np.arange(len(ordine)) - inizio[idx[ordine]]
+    alloc = alloc + (pos < mancanti[idx])
+
+    netto = base - alloc
+    iva = _div_half_up(netto * iva_bp, 10000 + iva_bp)
+
+    # assemblaggio del risultato
+    out: list[PrezzoCarrello] = []
+    righe_per_carrello: list[list[RigaPrezzata]] = [[] for _ in range(n_carrelli)]
+    k = 0
+    for i, (_id, righe, _codice) in enumerate(carrelli):
+        for r in righe:
+            righe_per_carrello[i].append(RigaPrezzata(
+                sku=r.sku, quantita=r.quantita, prezzoUnitario=_dec(_cents(r.prezzoUnitario)),
+                aliquotaIVA=Decimal(str(r.aliquotaIVA)),
+                lordo=_dec(lordo[k]), scontoPromo=_dec(promo[k]), scontoCoupon=_dec(alloc[k]),
+                scontoRiga=_dec(promo[k] + alloc[k]), netto=_dec(netto[k]),
+                imponibile=_dec(netto[k] - iva[k]), iva=_dec(iva[k]),
+            ))
+            k += 1
+
+    promo_c = np.bincount(idx, weights=promo, minlength=n_carrelli).astype(np.int64)
+    netto_c = np.bincount(idx, weights=netto, minlength=n_carrelli).astype(np.int64)
+    iva_c = np.bincount(idx, weights=iva, minlength=n_carrelli).astype(np.int64)
+    for i, (id_carrello, _righe, codice) in enumerate(carrelli):
+        out.append(PrezzoCarrello(
+            idCarrello=id_carrello,
+            righe=tuple(righe_per_carrello[i]),
+            totaleLordo=_dec(lordo_c[i]),
+            scontoPromo=_dec(promo_c[i]),
+            scontoCoupon=_dec(coupon_c[i]),
+            totaleSconti=_dec(promo_c[i] + coupon_c[i]),
+            totaleNetto=_dec(netto_c[i]),
+            imponibile=_dec(netto_c[i] - iva_c[i]),
+            iva=_dec(iva_c[i]),
+            codiceCoupon=codice if codice and errori[i] is None else None,
+            erroreCoupon=errori[i],
+        ))
+    return out
+
+
+# ----------------------------
+# Caricamento bulk e API per carrelli e preventivi
+# ----------------------------
+def _coupon_map(session: Session, codici: Iterable[str | None]) -> dict[str, CouponRef]:
+    refdata = get_refdata(session)
+    out: dict[str, CouponRef] = {}
+    for codice in set(c for c in codici if c):
+        ref = refdata.coupon(session, codice)
+        if ref:
+            out[codice] = ref
+    return out
+
+def price_carrelli(
+    session: Session,
+    ids: Sequence[int],
+    coupon: Mapping[int, str] | None = None,
+    promozioni: Mapping[str, Decimal] | None = None,
+    oggi: date | None = None,
+) -> list[PrezzoCarrello]:
+    """Prezza i carrelli indicati con una sola query su VOCE_CARRELLO x PRODOTTO."""
+    coupon = coupon or {}
+    righe: dict[int, list[RigaInput]] = {i: [] for i in ids}
+    rows = session.execute(
+        select(VoceCarrello.idCarrello, VoceCarrello.sku, VoceCarrello.quantita, VoceCarrello.prezzoVisto, Prodotto.aliquotaIVA)
+        .join(Prodotto, Prodotto.sku == VoceCarrello.sku)
+        .where(VoceCarrello.idCarrello.in_(list(ids)))
+        .order_by(VoceCarrello.idCarrello, VoceCarrello.sku)
+    )
+    for id_carrello, sku, q, p, iva in rows:
+        righe[id_carrello].append(RigaInput(sku, q, p, iva))
+    carrelli = [(i, righe[i], coupon.get(i)) for i in ids]
+    return calcola(carrelli, _coupon_map(session, coupon.values()), promozioni, oggi)
+
+def price_open_carts(
+    session: Session,
+    promozioni: Mapping[str, Decimal] | None = None,
+    chunk_size: int = 2000,
+    oggi: date | None = None,
+) -> Iterator[PrezzoCarrello]:
+    """Ricalcola tutti i carrelli con almeno una voce, a chunk di id."""
+    ultimo = 0
+    while True:
+        ids = list(session.scalars(
+            select(Carrello.idCarrello)
+            .where(Carrello.idCarrello > ultimo, exists().where(VoceCarrello.idCarrello == Carrello.idCarrello))
+            .order_by(Carrello.idCarrello)
+            .limit(chunk_size)
+        ))
+        if not ids:
+            return
+        ultimo = ids[-1]
+        yield from price_carrelli(session, ids, promozioni=promozioni, oggi=oggi)
+
+def quote(
+    session: Session,
+    articoli: Sequence[tuple[str, int]],
+    codice_coupon: str | None = None,
+    promozioni: Mapping[str, Decimal] | None = None,
+    oggi: date | None = None,
+) -> PrezzoCarrello:
+    """Preventivo per una lista (sku, quantita) ai prezzi di listino correnti."""
+    skus = [s for s, _q in articoli]
+    prodotti = {
+        sku: (prezzo, iva)
+        for sku, prezzo, iva in session.execute(
+            select(Prodotto.sku, Prodotto.prezzoListino, Prodotto.aliquotaIVA).where(Prodotto.sku.in_(skus))
+        )
+    }
+    righe = []
+    for sku, q in articoli:
+        if sku not in prodotti:
+            raise ValueError(f"Prodotto {sku} non trovato")
+        if q <= 0:
+            raise ValueError("quantita deve essere > 0")
+        righe.append(RigaInput(sku, q, *prodotti[sku]))
+    return calcola([(None, righe, codice_coupon)], _coupon_map(session, [codice_coupon]), promozioni, oggi)[0]
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from itertools import combinations
+from typing import Iterable
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from .jobs import get_stato_job, now_dt, set_watermark
+from .models import (
+    ConsiglioProdotto, CooccorrenzaProdotto, Ordine, Prodotto, ProdottoStato, RigaOrdine, StatoOrdine
+)
+
+JOB_COOCCORRENZE = "cooccorrenze_prodotti"
+C = CooccorrenzaProdotto
+
+
+@dataclass
+class EsitoConsigli:
+    ordini: int = 0
+    coppie: int = 0
+    skuAggiornati: int = 0
+    ordiniSaltati: int = 0
+
+
+@dataclass(frozen=True)
+class Consiglio:
+    sku: str
+    nome: str
+    prezzo: Decimal
+    ordiniInsieme: int
+    confidenza: Decimal
+
+
+# ----------------------------
+# Conteggi: upsert incrementale delle coppie
+# ----------------------------
+def _upsert(session: Session, righe: list[dict]) -> None:
+    dialetto = session.get_bind().dialect.name
+    if dialetto == "mysql":
+        stmt = mysql.insert(C)
+        stmt = stmt.on_duplicate_key_update(ordini=C.ordini + stmt.inserted.ordini)
+    elif dialetto == "sqlite":
+        stmt = sqlite.insert(C)
+        stmt = stmt.on_conflict_do_update(index_elements=[C.sku, C.skuAssociato], set_={"ordini": C.ordini + stmt.excluded.ordini})
+    else:
+        raise ValueError(f"Dialetto {dialetto} non supportato")
+    session.execute(stmt, righe)
+
+def conta_coppie(ordini: Iterable[list[str]], max_sku_ordine: int) -> tuple[Counter, int]:
+    """Coppie (a, b) in entrambe le direzioni più la diagonale (a, a) per ogni ordine."""
+    coppie: Counter = Counter()
+    saltati = 0
+    for skus in ordini:
+        skus = sorted(set(skus))
+        if len(skus) > max_sku_ordine:
+            # ordini all'ingrosso: k^2 coppie che direbbero poco sulle associazioni
+            saltati += 1
+            continue
+        for s in skus:
+            coppie[(s, s)] += 1
+        for a, b in combinations(skus, 2):
+            coppie[(a, b)] += 1
+            coppie[(b, a)] += 1
+    return coppie, saltati
+
+
+# ----------------------------
+# Top-K per gli sku toccati (ROW_NUMBER sulla PK)
+# ----------------------------
+def _aggiorna_top_k(session: Session, skus: list[str], top_k: int, chunk_size: int = 500) -> None:
+    for i in range(0, len(skus), chunk_size):
+        lotto = skus[i:i + chunk_size]
+        totali = dict(session.execute(
+            select(C.sku, C.ordini).where(C.sku.in_(lotto), C.skuAssociato == C.sku)
+        ).all())
+        rn = func.row_number().over(partition_by=C.sku, order_by=(C.ordini.desc(), C.skuAssociato)).label("rn")
+        classifica = (
+            select(C.sku, C.skuAssociato, C.ordini, rn)
+            .where(C.sku.in_(lotto), C.skuAssociato != C.sku)
+            .subquery()
+        )
+        righe = session.execute(
+            select(classifica.c.sku, classifica.c.skuAssociato, classifica.c.ordini, classifica.c.rn)
+            .where(classifica.c.rn <= top_k)
+        ).all()
+
+        session.execute(delete(ConsiglioProdotto).where(ConsiglioProdotto.sku.in_(lotto)))
+        if righe:
+            session.execute(insert(ConsiglioProdotto), [
+                {
+                    "sku": sku, "posizione": int(pos), "skuConsigliato": altro, "ordiniInsieme": n,
+                    "confidenza": (Decimal(n) / totali[sku]).quantize(Decimal("0.0001"), ROUND_HALF_UP),
+                }
+                for sku, altro, n, pos in righe
+            ])
+
+
+# ----------------------------
+# Job: un passaggio sugli ordini nuovi, una transazione per chunk
+# ----------------------------
+def build_index(
+    session: Session,
+    top_k: int = 10,
+    completo: bool = False,
+    ritardo: float = 60.0,
+    chunk_ordini: int = 5000,
+    max_sku_ordine: int = 50,
+) -> EsitoConsigli:
+    """Aggiorna le co-occorrenze con gli ordini successivi al watermark.
+
+    Si fermano agli ordini creati almeno `ritardo` secondi fa: su MySQL gli id
+    possono diventare visibili fuori ordine fra transazioni concorrenti.
+    """
+    rep = EsitoConsigli()
+    if completo:
+        session.execute(delete(ConsiglioProdotto))
+        session.execute(delete(C))
+        set_watermark(session, JOB_COOCCORRENZE, ultimo_id=0)
+        session.commit()
+
+    stato = get_stato_job(session, JOB_COOCCORRENZE)
+    ultimo = stato.ultimoId if stato and stato.ultimoId else 0
+    tetto = session.scalar(
+        select(func.max(Ordine.idOrdine)).where(Ordine.dataCreazione < now_dt() - timedelta(seconds=ritardo))
+    )
+    if tetto is None or tetto <= ultimo:
+        return rep
+
+    while True:
+        ids = list(session.scalars(
+            select(Ordine.idOrdine)
+            .where(Ordine.idOrdine > ultimo, Ordine.idOrdine <= tetto, Ordine.statoOrdine != StatoOrdine.ANNULLATO)
+            .order_by(Ordine.idOrdine)
+            .limit(chunk_ordini)
+        ))
+        if not ids:
+            break
+        per_ordine: dict[int, list[str]] = defaultdict(list)
+        for id_ordine, sku in session.execute(
+            select(RigaOrdine.idOrdine, RigaOrdine.sku).where(RigaOrdine.idOrdine.in_(ids))
+        ):
+            per_ordine[id_ordine].append(sku)
+
+        coppie, saltati = conta_coppie(per_ordine.values(), max_sku_ordine)
+        if coppie:
+            righe = [{"sku": a, "skuAssociato": b, "ordini": n} for (a, b), n in coppie.items()]
+            for i in range(0, len(righe), 5000):
+                _upsert(session, righe[i:i + 5000])
+            toccati = sorted({a for a, _b in coppie})
+            _aggiorna_top_k(session, toccati, top_k)
+            rep.skuAggiornati += len(toccati)
+
+        ultimo = ids[-1]
+        set_watermark(session, JOB_COOCCORRENZE, ultimo_id=ultimo)
+        session.commit()
+        rep.ordini += len(ids)
+        rep.coppie += len(coppie)
+        rep.ordiniSaltati += saltati
+
+    # ordini annullati in coda al range: il watermark arriva comunque al tetto
+    set_watermark(session, JOB_COOCCORRENZE, ultimo_id=tetto)
+    session.commit()
+    return rep
+
+
+# ----------------------------
+# Lettura: pagina prodotto e carrello
+# ----------------------------
+def _consigli_query(skus: list[str]):
+    return (
+        select(
+            ConsiglioProdotto.sku, Prodotto.sku, Prodotto.nome, Prodotto.prezzoListino,
+            ConsiglioProdotto.ordiniInsieme, ConsiglioProdotto.confidenza,
+        )
+        .join(Prodotto, Prodotto.sku == ConsiglioProdotto.skuConsigliato)
+        .where(ConsiglioProdotto.sku.in_(skus), Prodotto.stato == ProdottoStato.ATTIVO)
+        .order_by(ConsiglioProdotto.sku, ConsiglioProdotto.posizione)
+    )
+
+def consigli(session: Session, sku: str, limite: int = 5) -> list[Consiglio]:
+    return [Consiglio(*r[1:]) for r in session.execute(_consigli_query([sku])).all()][:limite]
+
+def consigli_carrello(session: Session, skus: list[str], limite: int = 5) -> list[Consiglio]:
+    """Unisce i top-K degli sku nel carrello (escludendo quelli già presenti)."""
+    nel_carrello = set(skus)
+    punteggio: dict[str, list] = {}
+    for _origine, sku, nome, prezzo, n, conf in session.execute(_consigli_query(sorted(nel_carrello))).all():
+        if sku in nel_carrello:
+            continue
+        if sku not in punteggio:
+            punteggio[sku] = [nome, prezzo, 0, Decimal("0")]
+        punteggio[sku][2] += n
+        punteggio[sku][3] = max(punteggio[sku][3], conf)
+    migliori = sorted(punteggio.items(), key=lambda kv: (-kv[1][2], -kv[1][3], kv[0]))[:limite]
+    return [Consiglio(sku, nome, prezzo, n, conf) for sku, (nome, prezzo, n, conf) in migliori]
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import csv
+from dataclasses import dataclass, fields
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from sqlalchemy import and_, delete, exists, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from .jobs import now_dt
+from .models import (
+    AnomaliaRiconciliazione, EsitoPagamento, Ordine, Pagamento, PagamentoTipo,
+    Riconciliazione, StagingRiconciliazione, StatoOrdine, TipoAnomalia
+)
+from .outbox import emit_many, evento_ordine
+from .reportcache import bump
+
+CENT = Decimal("0.01")
+
+
+@dataclass
+class EsitoRiconciliazione:
+    righe: int = 0
+    confermati: int = 0
+    ordiniAggiornati: int = 0
+    mancantiInDb: int = 0
+    mancantiNelFile: int = 0
+    duplicati: int = 0
+    importoDiverso: int = 0
+    esitoDiverso: int = 0
+    nonValide: int = 0
+
+    def add(self, other: "EsitoRiconciliazione") -> None:
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+@dataclass(frozen=True)
+class RigaSettlement:
+    riga: int
+    transactionId: str | None
+    importo: Decimal | None
+    esito: EsitoPagamento | None
+
+
+def _importo(x: str | None) -> Decimal | None:
+    try:
+        return Decimal((x or "").strip().replace(",", ".")).quantize(CENT)
+    except InvalidOperation:
+        return None
+
+def leggi_csv(path: str | Path) -> Iterator[RigaSettlement]:
+    """Righe del file di settlement: transactionId, importo[, esito OK/KO]."""
+    with open(path, newline="", encoding="utf-8") as f:
+        for n, r in enumerate(csv.DictReader(f), start=2):
+            esito = (r.get("esito") or "OK").strip().upper()
+            yield RigaSettlement(
+                n,
+                (r.get("transactionId") or "").strip() or None,
+                _importo(r.get("importo")),
+                EsitoPagamento[esito] if esito in EsitoPagamento.__members__ else None,
+            )
+
+
+def _chunks(righe: Iterable[RigaSettlement], size: int) -> Iterator[list[RigaSettlement]]:
+    buf: list[RigaSettlement] = []
+    for r in righe:
+        buf.append(r)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+# ----------------------------
+# Un chunk = una lookup bulk su transactionId + hash join in memoria
+# ----------------------------
+def _anomalia(id_run: int, tipo: TipoAnomalia, r: RigaSettlement, importo_db=None) -> dict:
+    return {"idRiconciliazione": id_run, "tipo": tipo, "transactionId": r.transactionId, "riga": r.riga,
+            "importoFile": r.importo, "importoDb": importo_db}
+
+def _process_chunk(session: Session, id_run: int, chunk: list[RigaSettlement]) -> tuple[EsitoRiconciliazione, list[datetime]]:
+    rep = EsitoRiconciliazione(righe=len(chunk))
+    anomalie: list[dict] = []
+
+    valide: dict[str, RigaSettlement] = {}
+    for r in chunk:
+        if r.transactionId is None or r.importo is None or r.esito is None:
+            rep.nonValide += 1
+            anomalie.append(_anomalia(id_run, TipoAnomalia.NON_VALIDA, r))
+        elif r.transactionId in valide:
+            rep.duplicati += 1
+            anomalie.append(_anomalia(id_run, TipoAnomalia.DUPLICATO, r))
+        else:
+            valide[r.transactionId] = r
+
+    # duplicati di chunk precedenti: la memoria resta limitata al chunk
+    gia_letti = set(session.scalars(
+        select(StagingRiconciliazione.transactionId)
+        .where(StagingRiconciliazione.idRiconciliazione == id_run, StagingRiconciliazione.transactionId.in_(list(valide)))
+    ))
+    for tx in gia_letti:
+        rep.duplicati += 1
+        anomalie.append(_anomalia(id_run, TipoAnomalia.DUPLICATO, valide.pop(tx)))
+    if valide:
+        session.execute(insert(StagingRiconciliazione), [{"idRiconciliazione": id_run, "transactionId": tx} for tx in valide])
+
+    # lato build dell'hash join: i pagamenti del chunk, una query sull'indice UNIQUE
+    pagamenti = {
+        p.transactionId: p for p in session.execute(
+            select(Pagamento.transactionId, Pagamento.idOrdine, Pagamento.importo, Pagamento.esito, Pagamento.tipo, Pagamento.dataOra)
+            .where(Pagamento.transactionId.in_(list(valide)))
+        )
+    }
+    date: list[datetime] = []
+    da_pagare: set[int] = set()
+    for tx, r in valide.items():
+        p = pagamenti.get(tx)
+        if p is None:
+            rep.mancantiInDb += 1
+            anomalie.append(_anomalia(id_run, TipoAnomalia.MANCANTE_IN_DB, r))
+            continue
+        date.append(p.dataOra)
+        importo_db = Decimal(str(p.importo)).quantize(CENT)
+        # i provider riportano i rimborsi con segno negativo, in PAGAMENTO sono positivi
+        if abs(r.importo) != importo_db:
+            rep.importoDiverso += 1
+            anomalie.append(_anomalia(id_run, TipoAnomalia.IMPORTO_DIVERSO, r, importo_db))
+        elif r.esito != p.esito:
+            rep.esitoDiverso += 1
+            anomalie.append(_anomalia(id_run, TipoAnomalia.ESITO_DIVERSO, r, importo_db))
+        else:
+            rep.confermati += 1
+            if p.esito == EsitoPagamento.OK and p.tipo == PagamentoTipo.INCASSO:
+                da_pagare.add(p.idOrdine)
+
+    if da_pagare:
+        # incasso confermato dal provider: l'ordine rimasto CREATO diventa PAGATO
+        da_aggiornare = session.execute(
+            select(Ordine.idOrdine, Ordine.idCliente, Ordine.totaleNetto)
+            .where(Ordine.idOrdine.in_(sorted(da_pagare)), Ordine.statoOrdine == StatoOrdine.CREATO)
+            .order_by(Ordine.idOrdine)
+            .with_for_update()
+        ).all()
+        if da_aggiornare:
+            session.execute(
+                update(Ordine)
+                .where(Ordine.idOrdine.in_([o.idOrdine for o in da_aggiornare]), Ordine.statoOrdine == StatoOrdine.CREATO)
+                .values(statoOrdine=StatoOrdine.PAGATO, versione=Ordine.versione + 1)
+                .execution_options(synchronize_session=False)
+            )
+            emit_many(session, [
+                evento_ordine(o.idOrdine, o.idCliente, StatoOrdine.PAGATO, o.totaleNetto, "ORDINE_PAGATO") for o in da_aggiornare
+            ])
+            bump(session, Ordine)
+            rep.ordiniAggiornati = len(da_aggiornare)
+    if anomalie:
+        session.execute(insert(AnomaliaRiconciliazione), anomalie)
+    return rep, date
+
+
+def _mancanti_nel_file(session: Session, id_run: int, dal: datetime, al: datetime) -> int:
+    """Incassi OK del periodo mai comparsi nel file: anti-join scritto con INSERT ... SELECT.
+
+    I rimborsi dei resi (transactionId interni RIMB-<idReso>) non passano dal provider.
+    """
+    sorgente = (
+        select(
+            literal(id_run), literal(TipoAnomalia.MANCANTE_NEL_FILE.value), Pagamento.transactionId, Pagamento.importo,
+        )
+        .where(
+            Pagamento.dataOra >= dal,
+            Pagamento.dataOra <= al,
+            Pagamento.esito == EsitoPagamento.OK,
+            Pagamento.tipo == PagamentoTipo.INCASSO,
+            Pagamento.transactionId.is_not(None),
+            ~exists().where(and_(
+                StagingRiconciliazione.idRiconciliazione == id_run,
+                StagingRiconciliazione.transactionId == Pagamento.transactionId,
+            )),
+        )
+    )
+    return session.execute(
+        insert(AnomaliaRiconciliazione).from_select(["idRiconciliazione", "tipo", "transactionId", "importoDb"], sorgente)
+    ).rowcount
+
+
+def reconcile(
+    session: Session,
+    righe: Iterable[RigaSettlement],
+    nome_file: str,
+    chunk_size: int = 5000,
+    dal: datetime | None = None,
+    al: datetime | None = None,
+) -> tuple[int, EsitoRiconciliazione]:
+    """Riconcilia il file un chunk per transazione; le anomalie vanno in ANOMALIA_RICONCILIAZIONE.
+
+    Il periodo per i pagamenti assenti dal file è [dal, al]; se omesso si usa
+    l'intervallo di dataOra dei pagamenti trovati nel file.
+    """
+    run = Riconciliazione(nomeFile=nome_file, dataEsecuzione=now_dt())
+    session.add(run)
+    session.commit()
+    id_run = run.idRiconciliazione
+
+    tot = EsitoRiconciliazione()
+    primo = ultimo = None
+    for chunk in _chunks(righe, chunk_size):
+        rep, date = _process_chunk(session, id_run, chunk)
+        if date:
+            primo = min(primo or min(date), min(date))
+            ultimo = max(ultimo or max(date), max(date))
+        session.commit()
+        tot.add(rep)
+
+    dal, al = dal or primo, al or ultimo
+    if dal is not None and al is not None:
+        tot.mancantiNelFile = _mancanti_nel_file(session, id_run, dal, al)
+    session.execute(delete(StagingRiconciliazione).where(StagingRiconciliazione.idRiconciliazione == id_run))
+    for f in fields(tot):
+        setattr(run, f.name, getattr(tot, f.name))
+    session.commit()
+    return id_run, tot
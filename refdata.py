@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field, replace
+from datetime import date
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Mapping
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .models import MetodoPagamento, Corriere, Magazzino, Categoria, Coupon, CouponTipo
+
+
+# ----------------------------
+# Riferimenti immutabili (non legati alla Session)
+# ----------------------------
+@dataclass(frozen=True)
+class MetodoRef:
+    idMetodo: int
+    nomeMetodo: str
+    provider: str | None
+
+
+@dataclass(frozen=True)
+class CorriereRef:
+    idCorriere: int
+    nome: str
+    customerCare: str | None
+
+
+@dataclass(frozen=True)
+class MagazzinoRef:
+    idMagazzino: int
+    nome: str
+    indirizzoTestuale: str | None
+
+
+@dataclass(frozen=True)
+class CategoriaRef:
+    idCategoria: int
+    idCategoriaPadre: int | None
+    nome: str
+
+
+@dataclass(frozen=True)
+class CouponRef:
+    codiceCoupon: str
+    tipo: CouponTipo
+    valore: Decimal
+    dataInizio: date
+    dataFine: date
+    minimoOrdine: Decimal
+    maxUtilizzi: int
+
+
+def _empty() -> Mapping:
+    return MappingProxyType({})
+
+
+@dataclass(frozen=True)
+class RefDataSnapshot:
+    version: int = 0
+    loaded_at: float = 0.0
+    metodi: Mapping[str, MetodoRef] = field(default_factory=_empty)
+    corrieri: Mapping[str, CorriereRef] = field(default_factory=_empty)
+    magazzini: Mapping[int, MagazzinoRef] = field(default_factory=_empty)
+    categorie: Mapping[int, CategoriaRef] = field(default_factory=_empty)
+    coupon: Mapping[str, CouponRef] = field(default_factory=_empty)
+
+
+def _metodo_ref(m: MetodoPagamento) -> MetodoRef:
+    return MetodoRef(m.idMetodo, m.nomeMetodo, m.provider)
+
+def _corriere_ref(c: Corriere) -> CorriereRef:
+    return CorriereRef(c.idCorriere, c.nome, c.customerCare)
+
+def _coupon_ref(c: Coupon) -> CouponRef:
+    return CouponRef(
+        c.codiceCoupon, c.tipo, Decimal(str(c.valore)), c.dataInizio, c.dataFine,
+        Decimal(str(c.minimoOrdine)), c.maxUtilizzi
+    )
+
+def _with(mapping: Mapping, key, value) -> Mapping:
+    d = dict(mapping)
+    d[key] = value
+    return MappingProxyType(d)
+
+
+# ----------------------------
+# Cache dati di riferimento (una per engine)
+# ----------------------------
+class RefDataCache:
+    """Mappe in memoria dei dati di riferimento, sostituite in blocco a ogni refresh.
+
+    I lettori vedono sempre uno snapshot coerente: le mappe non vengono mai
+    modificate, ogni refresh o inserimento pubblica un nuovo snapshot con
+    versione incrementata.
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0):
+        self.ttl_seconds = ttl_seconds
+        self._snapshot = RefDataSnapshot()
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> RefDataSnapshot:
+        return self._snapshot
+
+    def load(self, session: Session) -> RefDataSnapshot:
+        metodi = {m.nomeMetodo: _metodo_ref(m) for m in session.scalars(select(MetodoPagamento))}
+        corrieri = {c.nome: _corriere_ref(c) for c in session.scalars(select(Corriere))}
+        magazzini = {
+            m.idMagazzino: MagazzinoRef(m.idMagazzino, m.nome, m.indirizzoTestuale)
+            for m in session.scalars(select(Magazzino))
+        }
+        categorie = {
+            c.idCategoria: CategoriaRef(c.idCategoria, c.idCategoriaPadre, c.nome)
+            for c in session.scalars(select(Categoria))
+        }
+        coupon = {c.codiceCoupon: _coupon_ref(c) for c in session.scalars(select(Coupon))}
+
+        with self._lock:
+            self._snapshot = RefDataSnapshot(
+                version=self._snapshot.version + 1,
+                loaded_at=time.monotonic(),
+                metodi=MappingProxyType(metodi),
+                corrieri=MappingProxyType(corrieri),
+                magazzini=MappingProxyType(magazzini),
+                categorie=MappingProxyType(categorie),
+                coupon=MappingProxyType(coupon),
+            )
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = replace(self._snapshot, loaded_at=0.0)
+
+    def current(self, session: Session) -> RefDataSnapshot:
+        snap = self._snapshot
+        if snap.version == 0 or time.monotonic() - snap.loaded_at > self.ttl_seconds:
+            snap = self.load(session)
+        return snap
+
+    def _publish(self, **changes) -> None:
+        with self._lock:
+            snap = self._snapshot
+            updated = {name: _with(getattr(snap, name), key, value) for name, (key, value) in changes.items()}
+            self._snapshot = replace(snap, version=snap.version + 1, **updated)
+
+    def _pubblica_dopo_commit(self, session: Session, nome: str, key, ref) -> None:
+        """La riga appena inserita è visibile agli altri solo dopo il commit del chiamante."""
+        session.info.setdefault(_PENDENTI, []).append((self, nome, key, ref))
+
+    def _pendente(self, session: Session, nome: str, key):
+        for cache, n, k, ref in session.info.get(_PENDENTI, ()):
+            if cache is self and n == nome and k == key:
+                return ref
+        return None
+
+    # --- insert-or-get atomici (senza commit: lo fa il chiamante) ---
+    def metodo(self, session: Session, nome: str, provider: str | None = None) -> MetodoRef:
+        ref = self.current(session).metodi.get(nome) or self._pendente(session, "metodi", nome)
+        if ref:
+            return ref
+        m, nuovo = _insert_or_get(
+            session, MetodoPagamento(nomeMetodo=nome, provider=provider),
+            select(MetodoPagamento).where(MetodoPagamento.nomeMetodo == nome),
+        )
+        ref = _metodo_ref(m)
+        if nuovo:
+            self._pubblica_dopo_commit(session, "metodi", nome, ref)
+        else:
+            self._publish(metodi=(nome, ref))
+        return ref
+
+    def corriere(self, session: Session, nome: str, customer_care: str | None = None) -> CorriereRef:
+        ref = self.current(session).corrieri.get(nome) or self._pendente(session, "corrieri", nome)
+        if ref:
+            return ref
+        c, nuovo = _insert_or_get(
+            session, Corriere(nome=nome, customerCare=customer_care),
+            select(Corriere).where(Corriere.nome == nome),
+        )
+        ref = _corriere_ref(c)
+        if nuovo:
+            self._pubblica_dopo_commit(session, "corrieri", nome, ref)
+        else:
+            self._publish(corrieri=(nome, ref))
+        return ref
+
+    def coupon(self, session: Session, codice: str) -> CouponRef | None:
+        ref = self.current(session).coupon.get(codice)
+        if ref:
+            return ref
+        # coupon creati dopo l'ultimo refresh: lettura puntuale e pubblicazione
+        c = session.get(Coupon, codice)
+        if not c:
+            return None
+        ref = _coupon_ref(c)
+        self._publish(coupon=(codice, ref))
+        return ref
+
+
+def _insert_or_get(session: Session, obj, lookup) -> tuple[object, bool]:
+    """Inserisce `obj` in un SAVEPOINT (flush, nessun commit); se un altro processo
+    ha già creato la riga (violazione del vincolo UNIQUE sul nome) rilegge quella
+    esistente. Ritorna (riga, inserita_ora)."""
+    existing = session.scalar(lookup)
+    if existing:
+        return existing, False
+    try:
+        with session.begin_nested():
+            session.add(obj)
+            session.flush()
+        return obj, True
+    except IntegrityError:
+        # il SAVEPOINT è già stato annullato: la transazione esterna resta valida.
+        # Lettura con lock: in REPEATABLE READ una SELECT semplice userebbe lo
+        # snapshot della transazione, in cui la riga dell'altro processo non c'è
+        return session.scalars(lookup.with_for_update()).one(), False
+
+
+# riferimenti inseriti nella transazione in corso: pubblicati al commit, scartati al rollback
+_PENDENTI = "glowhub_refdata_pendenti"
+
+@event.listens_for(Session, "after_commit")
+def _pubblica_pendenti(session: Session) -> None:
+    for cache, nome, key, ref in session.info.pop(_PENDENTI, ()):
+        cache._publish(**{nome: (key, ref)})
+
+@event.listens_for(Session, "after_transaction_end")
+def _scarta_pendenti(session: Session, transaction) -> None:
+    # dopo after_commit la lista è già vuota; i rollback dei SAVEPOINT non la toccano
+    if transaction.parent is None:
+        session.info.pop(_PENDENTI, None)
+
+
+_caches: "weakref.WeakKeyDictionary[object, RefDataCache]" = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def get_refdata(session: Session) -> RefDataCache:
+    engine = session.get_bind()
+    with _caches_lock:
+        cache = _caches.get(engine)
+        if cache is None:
+            cache = _caches[engine] = RefDataCache()
+        return cache
+
+def preload(session: Session) -> RefDataSnapshot:
+    return get_refdata(session).load(session)
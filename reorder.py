@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from .crud import now_dt
+from .models import (
+    FornituraProdotto, Prodotto, ProdottoStato, PropostaRiordino, Scorta, StatoPropostaRiordino
+)
+
+
+@dataclass
+class PianoRiordino:
+    proposte: int
+    costo_totale: Decimal
+    sotto_soglia: int
+    senza_fornitore: int
+
+
+# ----------------------------
+# Caricamento bulk (una query per tabella)
+# ----------------------------
+def _load_scorte(session: Session):
+    rows = session.execute(
+        select(Scorta.idMagazzino, Scorta.sku, Scorta.giacenza, Scorta.sogliaRiordino)
+        .join(Prodotto, Prodotto.sku == Scorta.sku)
+        .where(Prodotto.stato == ProdottoStato.ATTIVO)
+    ).all()
+    if not rows:
+        return None
+    mag, sku, giac, soglia = zip(*rows)
+    return (
+        np.asarray(mag, dtype=np.int64),
+        np.asarray(sku, dtype=str),
+        np.asarray(giac, dtype=np.int64),
+        np.asarray(soglia, dtype=np.int64),
+    )
+
+def _load_offerte(session: Session):
+    rows = session.execute(
+        select(FornituraProdotto.idFornitore, FornituraProdotto.sku,
+               FornituraProdotto.prezzoAcquisto, FornituraProdotto.leadTimeGiorni)
+    ).all()
+    if not rows:
+        return None
+    forn, sku, prezzo, lead = zip(*rows)
+    # prezzi in centesimi: confronti e importi restano esatti
+    cents = np.rint(np.asarray([float(p) for p in prezzo]) * 100).astype(np.int64)
+    return (
+        np.asarray(forn, dtype=np.int64),
+        np.asarray(sku, dtype=str),
+        cents,
+        np.asarray(lead, dtype=np.int64),
+    )
+
+
+def _load_in_arrivo(session: Session, scorte, adesso: datetime) -> np.ndarray:
+    """Quantità già ordinate (proposte CONFERMATA) allineate alle righe di `scorte`.
+
+    Non c'è uno stato di ricevimento: una proposta confermata conta come in
+    arrivo fino a dataCreazione + leadTimeGiorni, poi si assume già in giacenza.
+    """
+    aperte: dict[tuple[int, str], int] = defaultdict(int)
+    for m, s, q, creata, lead in session.execute(
+        select(PropostaRiordino.idMagazzino, PropostaRiordino.sku, PropostaRiordino.quantita,
+               PropostaRiordino.dataCreazione, PropostaRiordino.leadTimeGiorni)
+        .where(PropostaRiordino.stato == StatoPropostaRiordino.CONFERMATA)
+    ):
+        if creata + timedelta(days=lead) > adesso:
+            aperte[(m, s)] += q
+    mag, sku = scorte[0], scorte[1]
+    return np.asarray([aperte.get((int(m), str(s)), 0) for m, s in zip(mag, sku)], dtype=np.int64)
+
+
+# ----------------------------
+# Calcolo vettoriale
+# ----------------------------
+def compute_proposte(scorte, offerte, fattore_copertura: float = 2.0, in_arrivo: np.ndarray | None = None) -> dict[str, np.ndarray]:
+    """Quantità da ordinare e miglior fornitore per ogni (magazzino, sku) sotto soglia.
+
+    Il livello obiettivo è `sogliaRiordino * fattore_copertura`; giacenza e
+    quantità `in_arrivo` (ordini confermati non ancora ricevuti) contano insieme.
+    Il fornitore scelto è quello col prezzo più basso, a parità di prezzo il lead time minore.
+    """
+    mag, sku_s, giac, soglia = scorte
+    if in_arrivo is not None:
+        giac = giac + in_arrivo
+    sotto = giac < soglia
+    mag, sku_s, giac, soglia = mag[sotto], sku_s[sotto], giac[sotto], soglia[sotto]
+
+    obiettivo = np.ceil(soglia * fattore_copertura).astype(np.int64)
+    quantita = np.maximum(obiettivo - giac, 0)
+
+    empty = np.zeros(0, dtype=np.int64)
+    if offerte is None or len(mag) == 0:
+        return {
+            "idMagazzino": empty, "sku": sku_s[:0], "idFornitore": empty, "quantita": empty,
+            "prezzo_cents": empty, "leadTimeGiorni": empty,
+            "sotto_soglia": int(sotto.sum()), "senza_fornitore": int(sotto.sum()),
+        }
+
+    forn, sku_o, cents, lead = offerte
+    # codifica sku -> interi condivisa fra scorte e offerte
+    codes, inv = np.unique(np.concatenate([sku_s, sku_o]), return_inverse=True)
+    cod_s, cod_o = inv[: len(sku_s)], inv[len(sku_s):]
+
+    # migliore offerta per sku: ordinamento (sku, prezzo, lead) e prima riga per gruppo
+    order = np.lexsort((lead, cents, cod_o))
+    first_sku, first_pos = np.unique(cod_o[order], return_index=True)
+    best = np.full(len(codes), -1, dtype=np.int64)
+    best[first_sku] = order[first_pos]
+
+    scelta = best[cod_s]
+    senza_fornitore = int((scelta < 0).sum())
+    ok = (scelta >= 0) & (quantita > 0)
+    scelta = scelta[ok]
+    return {
+        "idMagazzino": mag[ok],
+        "sku": sku_s[ok],
+        "idFornitore": forn[scelta],
+        "quantita": quantita[ok],
+        "prezzo_cents": cents[scelta],
+        "leadTimeGiorni": lead[scelta],
+        "sotto_soglia": int(sotto.sum()),
+        "senza_fornitore": senza_fornitore,
+    }
+
+
+# ----------------------------
+# Piano completo: calcolo + scrittura bulk delle proposte
+# ----------------------------
+def plan_reorders(session: Session, fattore_copertura: float = 2.0, chunk_size: int = 10000) -> PianoRiordino:
+    scorte = _load_scorte(session)
+    if scorte is None:
+        return PianoRiordino(0, Decimal("0.00"), 0, 0)
+    offerte = _load_offerte(session)
+    adesso = now_dt()
+    p = compute_proposte(scorte, offerte, fattore_copertura, _load_in_arrivo(session, scorte, adesso))
+
+    costo_cents = p["quantita"] * p["prezzo_cents"]
+
+    # un nuovo piano sostituisce le bozze non ancora confermate
+    session.execute(delete(PropostaRiordino).where(PropostaRiordino.stato == StatoPropostaRiordino.BOZZA))
+
+    n = len(p["quantita"])
+    for start in range(0, n, chunk_size):
+        sl = slice(start, start + chunk_size)
+        session.execute(insert(PropostaRiordino), [
+            {
+                "idMagazzino": int(m), "sku": s, "idFornitore": int(f), "quantita": int(q),
+                "prezzoAcquisto": Decimal(int(c)).scaleb(-2), "costoTotale": Decimal(int(t)).scaleb(-2),
+                "leadTimeGiorni": int(lt), "dataCreazione": adesso, "stato": StatoPropostaRiordino.BOZZA,
+            }
+            for m, s, f, q, c, t, lt in zip(
+                p["idMagazzino"][sl], p["sku"][sl], p["idFornitore"][sl], p["quantita"][sl],
+                p["prezzo_cents"][sl], costo_cents[sl], p["leadTimeGiorni"][sl],
+            )
+        ])
+    session.commit()
+
+    return PianoRiordino(
+        proposte=n,
+        costo_totale=Decimal(int(costo_cents.sum())).scaleb(-2),
+        sotto_soglia=p["sotto_soglia"],
+        senza_fornitore=p["senza_fornitore"],
+    )
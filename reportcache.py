@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import inspect
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+
+from . import queries
+from .models import VersioneTabella
+
+REPORTS: dict[str, Callable[..., Any]] = {
+    "ordini_cliente_email": queries.q_ordini_cliente_email,
+    "dettaglio_ordine": queries.q_dettaglio_ordine,
+    "spedizioni_corriere_periodo": queries.q_spedizioni_corriere_periodo,
+    "prodotti_sotto_soglia": queries.q_prodotti_sotto_soglia,
+    "clienti_che_hanno_usato_coupon": queries.q_clienti_che_hanno_usato_coupon,
+    "recensioni_per_categoria": queries.q_recensioni_per_categoria,
+}
+
+def _tabelle_lette(report: Callable[..., Any]) -> frozenset[str]:
+    # le tabelle di un report non dipendono dai parametri: bastano dei segnaposto
+    segnaposto = [bindparam(p) for p in inspect.signature(report).parameters]
+    return frozenset(t.name for t in find_tables(report(*segnaposto), include_joins=True))
+
+# solo le scritture su queste tabelle possono invalidare una voce della cache
+TABELLE_REPORT: frozenset[str] = frozenset().union(*(_tabelle_lette(r) for r in REPORTS.values()))
+
+
+# ----------------------------
+# Contatori di versione per tabella (nella transazione di chi scrive)
+# ----------------------------
+def bump(session: Session, *modelli) -> None:
+    """Incrementa la versione delle tabelle dei modelli indicati; il commit resta al chiamante.
+
+    Le tabelle che nessun report legge vengono ignorate: un contatore su
+    CARRELLO o VOCE_CARRELLO sarebbe solo una riga calda in più.
+    """
+    for nome in sorted({m.__tablename__ for m in modelli} & TABELLE_REPORT):
+        stmt = (
+            update(VersioneTabella)
+            .where(VersioneTabella.nomeTabella == nome)
+            .values(versione=VersioneTabella.versione + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if session.execute(stmt).rowcount:
+            continue
+        # prima riga per la tabella: flush fuori dal savepoint, che così contiene solo l'INSERT
+        session.flush()
+        try:
+            with session.begin_nested():
+                session.execute(insert(VersioneTabella).values(nomeTabella=nome, versione=1))
+        except IntegrityError:
+            # riga creata nel frattempo da un'altra transazione
+            session.execute(stmt)
+
+def versioni(session: Session, tabelle: frozenset[str]) -> tuple[tuple[str, int], ...]:
+    correnti = dict(session.execute(
+        select(VersioneTabella.nomeTabella, VersioneTabella.versione).where(VersioneTabella.nomeTabella.in_(tabelle))
+    ).all())
+    return tuple(sorted((t, correnti.get(t, 0)) for t in tabelle))
+
+
+# ----------------------------
+# Cache dei risultati: LRU limitata per numero di voci e TTL
+# ----------------------------
+@dataclass
+class _Voce:
+    righe: tuple
+    versioni: tuple[tuple[str, int], ...]
+    scadenza: float
+
+
+@dataclass
+class CacheStats:
+    hit: int = 0
+    miss: int = 0
+    invalidate: int = 0
+    scadute: int = 0
+    espulse: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        tot = self.hit + self.miss
+        return self.hit / tot if tot else 0.0
+
+
+class ReportCache:
+    def __init__(self, max_voci: int = 256, ttl_seconds: float = 300.0):
+        self.max_voci = max_voci
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._voci: OrderedDict[Hashable, _Voce] = OrderedDict()
+        self._tabelle: dict[str, frozenset[str]] = {}
+        self._lock = threading.Lock()
+
+    def _tabelle_report(self, nome: str, stmt) -> frozenset[str]:
+        if nome not in self._tabelle:
+            self._tabelle[nome] = frozenset(t.name for t in find_tables(stmt, include_joins=True))
+        return self._tabelle[nome]
+
+    def run(self, session: Session, nome: str, *params) -> tuple:
+        """Righe del report: dalla cache se nessuna tabella letta è cambiata."""
+        if nome not in REPORTS:
+            raise ValueError(f"Report {nome} non trovato")
+        stmt = REPORTS[nome](*params)
+        chiave = (nome, params)
+        # versioni lette prima del report: una scrittura concorrente rende la voce già vecchia
+        attuali = versioni(session, self._tabelle_report(nome, stmt))
+        adesso = time.monotonic()
+
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is not None:
+                if voce.scadenza <= adesso:
+                    self.stats.scadute += 1
+                elif voce.versioni != attuali:
+                    self.stats.invalidate += 1
+                else:
+                    self._voci.move_to_end(chiave)
+                    self.stats.hit += 1
+                    return voce.righe
+            self.stats.miss += 1
+
+        righe = tuple(session.execute(stmt).all())
+        with self._lock:
+            self._voci[chiave] = _Voce(righe, attuali, adesso + self.ttl_seconds)
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.max_voci:
+                self._voci.popitem(last=False)
+                self.stats.espulse += 1
+        return righe
+
+    def clear(self) -> None:
+        with self._lock:
+            self._voci.clear()
+
+
+_caches: "weakref.WeakKeyDictionary[object, ReportCache]" = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def get_report_cache(session: Session) -> ReportCache:
+    engine = session.get_bind()
+    with _caches_lock:
+        cache = _caches.get(engine)
+        if cache is None:
+            cache = _caches[engine] = ReportCache()
+        return cache
+
+def run_report(session: Session, nome: str, *params) -> tuple:
+    return get_report_cache(session).run(session, nome, *params)
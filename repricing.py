@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Iterable, Mapping
+
+from sqlalchemy import Numeric, case, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from .crud import now_dt, to_decimal
+from .models import Categoria, Prodotto, StoricoPrezzo, VoceCarrello
+from .reportcache import bump
+
+
+@dataclass
+class RepricingReport:
+    prodotti: int = 0
+    voci_carrello: int = 0
+    chunk: int = 0
+
+
+# ----------------------------
+# Selezione sku: brand, sottoalbero di categoria, lista
+# ----------------------------
+def _sottoalbero_categoria(id_categoria: int):
+    cte = select(Categoria.idCategoria).where(Categoria.idCategoria == id_categoria).cte("sottoalbero", recursive=True)
+    cte = cte.union_all(select(Categoria.idCategoria).where(Categoria.idCategoriaPadre == cte.c.idCategoria))
+    return select(cte.c.idCategoria)
+
+def select_skus(
+    session: Session,
+    brand: str | None = None,
+    id_categoria: int | None = None,
+    skus: Iterable[str] | None = None,
+) -> list[str]:
+    stmt = select(Prodotto.sku).order_by(Prodotto.sku)
+    if brand is not None:
+        stmt = stmt.where(Prodotto.brand == brand)
+    if id_categoria is not None:
+        stmt = stmt.where(Prodotto.idCategoria.in_(_sottoalbero_categoria(id_categoria)))
+    if skus is not None:
+        stmt = stmt.where(Prodotto.sku.in_(list(skus)))
+    return list(session.scalars(stmt))
+
+
+# ----------------------------
+# Applicazione set-based per chunk di sku
+# ----------------------------
+def _apply(session: Session, skus: list[str], nuovo_prezzo, aggiorna_carrelli: bool, adesso) -> tuple[int, int]:
+    cambia = (Prodotto.sku.in_(skus), Prodotto.prezzoListino != nuovo_prezzo)
+
+    # storico prima dell'UPDATE, così prezzoPrecedente è il valore corrente
+    session.execute(insert(StoricoPrezzo).from_select(
+        ["sku", "prezzoPrecedente", "prezzoNuovo", "dataModifica"],
+        select(Prodotto.sku, Prodotto.prezzoListino, nuovo_prezzo, literal(adesso, StoricoPrezzo.dataModifica.type))
+        .where(*cambia),
+    ))
+    n_prod = session.execute(
+        update(Prodotto).where(*cambia).values(prezzoListino=nuovo_prezzo)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    n_voci = 0
+    if aggiorna_carrelli:
+        n_voci = session.execute(
+            update(VoceCarrello)
+            .where(
+                VoceCarrello.sku == Prodotto.sku,
+                Prodotto.sku.in_(skus),
+                VoceCarrello.prezzoVisto != Prodotto.prezzoListino,
+            )
+            .values(prezzoVisto=Prodotto.prezzoListino)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    bump(session, Prodotto, StoricoPrezzo, VoceCarrello)
+    session.commit()
+    return n_prod, n_voci
+
+def reprice_assoluto(
+    session: Session,
+    prezzi: Mapping[str, float | Decimal],
+    aggiorna_carrelli: bool = False,
+    chunk_size: int = 1000,
+) -> RepricingReport:
+    """Imposta prezzi assoluti (sku -> prezzo) con un UPDATE ... CASE per chunk."""
+    rep = RepricingReport()
+    adesso = now_dt()
+    skus = sorted(prezzi)
+    for start in range(0, len(skus), chunk_size):
+        chunk = skus[start:start + chunk_size]
+        nuovo = case({sku: literal(to_decimal(prezzi[sku]), Prodotto.prezzoListino.type) for sku in chunk}, value=Prodotto.sku)
+        n_prod, n_voci = _apply(session, chunk, nuovo, aggiorna_carrelli, adesso)
+        rep.prodotti += n_prod
+        rep.voci_carrello += n_voci
+        rep.chunk += 1
+    return rep
+
+def reprice_percentuale(
+    session: Session,
+    percentuale: float | Decimal,
+    brand: str | None = None,
+    id_categoria: int | None = None,
+    skus: Iterable[str] | None = None,
+    aggiorna_carrelli: bool = False,
+    chunk_size: int = 1000,
+) -> RepricingReport:
+    """Applica una variazione percentuale (es. -20 = sconto del 20%) agli sku selezionati."""
+    if brand is None and id_categoria is None and skus is None:
+        raise ValueError("Specificare almeno uno fra brand, categoria o lista sku")
+    fattore = Decimal("1") + to_decimal(percentuale) / Decimal("100")
+    if fattore < 0:
+        raise ValueError("La variazione porterebbe a prezzi negativi")
+
+    rep = RepricingReport()
+    adesso = now_dt()
+    selezionati = select_skus(session, brand, id_categoria, skus)
+    nuovo = func.round(Prodotto.prezzoListino * literal(fattore, Numeric(12, 6)), 2)
+    for start in range(0, len(selezionati), chunk_size):
+        n_prod, n_voci = _apply(session, selezionati[start:start + chunk_size], nuovo, aggiorna_carrelli, adesso)
+        rep.prodotti += n_prod
+        rep.voci_carrello += n_voci
+        rep.chunk += 1
+    return rep
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass, fields
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Iterator
+
+from sqlalchemy import bindparam, exists, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from .concurrency import ConcurrencyError
+from .crud import now_dt
+from .models import (
+    EsitoPagamento, Pagamento, PagamentoTipo, Reso, RigaOrdine, Scorta, StatoReso
+)
+from .outbox import emit_many, evento_pagamento, evento_scorta
+from .reportcache import bump
+
+
+@dataclass
+class ReturnsReport:
+    resi: int = 0
+    importoRimborsato: Decimal = Decimal("0.00")
+    pezziRientrati: int = 0
+    senzaMagazzino: int = 0
+
+    def add(self, other: "ReturnsReport") -> None:
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+def _incasso_ok(id_ordine):
+    return (
+        select(Pagamento.idMetodo)
+        .where(Pagamento.idOrdine == id_ordine, Pagamento.esito == EsitoPagamento.OK, Pagamento.tipo == PagamentoTipo.INCASSO)
+        .order_by(Pagamento.dataOra, Pagamento.idPagamento)
+        .limit(1)
+    )
+
+
+# ----------------------------
+# Un chunk di resi APPROVATO = una transazione
+# ----------------------------
+def _claim(session: Session, chunk_size: int) -> list[tuple[int, int, str, int, Decimal, int]] | None:
+    """Seleziona e prende in carico un lotto: None se un altro processo ha preso
+    parte degli stessi resi (il chunk va ripetuto)."""
+    q = (
+        select(
+            Reso.idReso, RigaOrdine.idOrdine, RigaOrdine.sku, RigaOrdine.quantita,
+            RigaOrdine.quantita * RigaOrdine.prezzoUnitarioApplicato - RigaOrdine.scontoRiga,
+            _incasso_ok(RigaOrdine.idOrdine).scalar_subquery(),
+        )
+        .join(RigaOrdine, RigaOrdine.idRigaOrdine == Reso.idRigaOrdine)
+        # senza un incasso andato a buon fine non c'è nulla da rimborsare
+        .where(Reso.statoReso == StatoReso.APPROVATO, exists(_incasso_ok(RigaOrdine.idOrdine)))
+        .order_by(Reso.idReso)
+        .limit(chunk_size)
+    )
+    if session.get_bind().dialect.name == "mysql":
+        q = q.with_for_update(skip_locked=True, of=Reso)
+    righe = session.execute(q).all()
+    if not righe:
+        return []
+
+    ids = [r[0] for r in righe]
+    presi = session.execute(
+        update(Reso)
+        .where(Reso.idReso.in_(ids), Reso.statoReso == StatoReso.APPROVATO)
+        .values(statoReso=StatoReso.RIMBORSATO)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if presi != len(ids):
+        session.rollback()
+        return None
+    return [tuple(r) for r in righe]
+
+def _process_chunk(session: Session, righe: list[tuple[int, int, str, int, Decimal, int]]) -> ReturnsReport:
+    adesso = now_dt()
+    rep = ReturnsReport(resi=len(righe))
+
+    rimborsi = []
+    for id_reso, id_ordine, _sku, _q, importo, id_metodo in righe:
+        importo = max(Decimal(str(importo)), Decimal("0")).quantize(Decimal("0.01"), ROUND_HALF_UP)
+        rep.importoRimborsato += importo
+        rimborsi.append({
+            "idOrdine": id_ordine, "idMetodo": id_metodo, "importo": importo, "dataOra": adesso,
+            "esito": EsitoPagamento.OK, "tipo": PagamentoTipo.RIMBORSO,
+            # transactionId univoco: lo stesso reso non può essere rimborsato due volte
+            "transactionId": f"RIMB-{id_reso}",
+        })
+    session.execute(insert(Pagamento), rimborsi)
+    # id assegnati dal db: riletti sull'indice UNIQUE di transactionId
+    emit_many(session, [
+        evento_pagamento(*r, "RIMBORSO_REGISTRATO") for r in session.execute(
+            select(Pagamento.idPagamento, Pagamento.idOrdine, Pagamento.importo, Pagamento.esito, Pagamento.tipo)
+            .where(Pagamento.transactionId.in_([r["transactionId"] for r in rimborsi]))
+        )
+    ])
+
+    # rientro a magazzino: per sku, nel magazzino con id più basso che lo tiene
+    pezzi: dict[str, int] = defaultdict(int)
+    for _id, _ordine, sku, q, _importo, _metodo in righe:
+        pezzi[sku] += q
+    magazzino = dict(session.execute(
+        select(Scorta.sku, func.min(Scorta.idMagazzino)).where(Scorta.sku.in_(list(pezzi))).group_by(Scorta.sku)
+    ).all())
+    incrementi = [
+        {"b_mag": magazzino[sku], "b_sku": sku, "b_delta": q, "b_data": adesso}
+        for sku, q in pezzi.items() if sku in magazzino
+    ]
+    rep.senzaMagazzino = sum(q for sku, q in pezzi.items() if sku not in magazzino)
+    if incrementi:
+        session.connection().execute(
+            update(Scorta.__table__)
+            .where(Scorta.idMagazzino == bindparam("b_mag"), Scorta.sku == bindparam("b_sku"))
+            .values(giacenza=Scorta.giacenza + bindparam("b_delta"), dataAggiornamento=bindparam("b_data")),
+            incrementi,
+        )
+        rep.pezziRientrati = sum(i["b_delta"] for i in incrementi)
+        aggiornate = session.execute(
+            select(Scorta.idMagazzino, Scorta.sku, Scorta.giacenza, Scorta.sogliaRiordino)
+            .where(Scorta.sku.in_([i["b_sku"] for i in incrementi]), Scorta.idMagazzino.in_({i["b_mag"] for i in incrementi}))
+        ).all()
+        emit_many(session, [evento_scorta(m, s, g, t) for m, s, g, t in aggiornate if magazzino.get(s) == m])
+    return rep
+
+def process_returns(session: Session, chunk_size: int = 500, max_tentativi: int = 5) -> Iterator[ReturnsReport]:
+    """Rimborsa e rimette a magazzino i resi APPROVATO, un chunk per transazione."""
+    conflitti = 0
+    while True:
+        righe = _claim(session, chunk_size)
+        if righe is None:
+            conflitti += 1
+            if conflitti >= max_tentativi:
+                raise ConcurrencyError("Resi contesi da un altro processo: tentativi esauriti")
+            continue
+        if not righe:
+            return
+        conflitti = 0
+        rep = _process_chunk(session, righe)
+        bump(session, Reso, Pagamento, Scorta)
+        session.commit()
+        yield rep
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Callable
+
+from sqlalchemy import UniqueConstraint, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.engine.reflection import Inspector
+
+from .models import Base
+
+
+@dataclass
+class UpgradeReport:
+    tabelle_create: list[str] = field(default_factory=list)
+    passi: list[str] = field(default_factory=list)
+
+
+# ----------------------------
+# Passi idempotenti: ognuno controlla lo schema reale prima di modificarlo
+# ----------------------------
+def _colonne(conn: Connection, tabella: str) -> set[str]:
+    return {c["name"] for c in inspect(conn).get_columns(tabella)}
+
+def _aggiungi_colonna(conn: Connection, tabella: str, colonna: str, tipo: str, tipo_sqlite: str | None = None) -> bool:
+    """ALTER TABLE ... ADD COLUMN se la colonna manca; tipo_sqlite sostituisce i tipi solo-MySQL (ENUM)."""
+    if colonna in _colonne(conn, tabella):
+        return False
+    if conn.dialect.name == "sqlite" and tipo_sqlite:
+        tipo = tipo_sqlite
+    conn.execute(text(f"ALTER TABLE {tabella} ADD COLUMN {colonna} {tipo}"))
+    return True
+
+def _unici(ins: Inspector, tabella: str) -> list[list[str]]:
+    vincoli = [u["column_names"] for u in ins.get_unique_constraints(tabella)]
+    return vincoli + [i["column_names"] for i in ins.get_indexes(tabella) if i["unique"]]
+
+def _ha_unique(conn: Connection, tabella: str, colonne: list[str]) -> bool:
+    return colonne in _unici(inspect(conn), tabella)
+
+def _deduplica(conn: Connection, tabella: str, pk: str, nome: str, riferimenti: tuple[tuple[str, str], ...],
+               derivate: tuple[tuple[str, str], ...] = ()) -> int:
+    """Fonde le righe con lo stesso nome nella prima (id minimo) prima di un vincolo UNIQUE.
+
+    I doppioni si cercano con GROUP BY, quindi con la collation della colonna,
+    la stessa che userà l'indice. Le FK in `riferimenti` passano alla riga
+    tenuta; le righe di `derivate` (tabelle ricalcolabili) vengono cancellate.
+    """
+    doppi = conn.execute(text(
+        f"SELECT t.{pk}, k.tenuto FROM {tabella} t "
+        f"JOIN (SELECT {nome}, MIN({pk}) AS tenuto FROM {tabella} GROUP BY {nome}) k ON k.{nome} = t.{nome} "
+        f"WHERE t.{pk} <> k.tenuto"
+    )).all()
+    if not doppi:
+        return 0
+    for tab, fk in riferimenti:
+        conn.execute(text(f"UPDATE {tab} SET {fk} = :tenuto WHERE {fk} = :doppio"),
+                     [{"tenuto": t, "doppio": d} for d, t in doppi])
+    for tab, fk in derivate:
+        conn.execute(text(f"DELETE FROM {tab} WHERE {fk} = :doppio"), [{"doppio": d} for d, _ in doppi])
+    conn.execute(text(f"DELETE FROM {tabella} WHERE {pk} = :doppio"), [{"doppio": d} for d, _ in doppi])
+    return len(doppi)
+
+def _crea_unique(conn: Connection, nome: str, tabella: str, colonne: list[str]) -> bool:
+    if _ha_unique(conn, tabella, colonne):
+        return False
+    conn.execute(text(f"CREATE UNIQUE INDEX {nome} ON {tabella} ({', '.join(colonne)})"))
+    return True
+
+def _versione_ordine_carrello(conn: Connection) -> bool:
+    # le righe esistenti partono da 1, come quelle nuove (server_default del modello)
+    ordine = _aggiungi_colonna(conn, "ORDINE", "versione", "INT NOT NULL DEFAULT 1")
+    carrello = _aggiungi_colonna(conn, "CARRELLO", "versione", "INT NOT NULL DEFAULT 1")
+    return ordine or carrello
+
+def _aggiornamento_spedizione(conn: Connection) -> bool:
+    # NULL sulle spedizioni esistenti: il tracking ripiega su dataSpedizione
+    return _aggiungi_colonna(conn, "SPEDIZIONE", "dataUltimoAggiornamento", "DATETIME NULL")
+
+def _tipo_pagamento(conn: Connection) -> bool:
+    # il DEFAULT riempie le righe esistenti: prima dei resi PAGAMENTO conteneva solo incassi
+    return _aggiungi_colonna(
+        conn, "PAGAMENTO", "tipo",
+        "ENUM('INCASSO','RIMBORSO') NOT NULL DEFAULT 'INCASSO'", "VARCHAR(8) NOT NULL DEFAULT 'INCASSO'",
+    )
+
+def _nomi_unici_refdata(conn: Connection) -> bool:
+    # la cache dei dati di riferimento inserisce per nome e si affida al vincolo per le corse
+    fatto = False
+    if not _ha_unique(conn, "METODO_PAGAMENTO", ["nomeMetodo"]):
+        _deduplica(conn, "METODO_PAGAMENTO", "idMetodo", "nomeMetodo", (("PAGAMENTO", "idMetodo"),))
+        fatto |= _crea_unique(conn, "uq_metodopagamento_nome", "METODO_PAGAMENTO", ["nomeMetodo"])
+    if not _ha_unique(conn, "CORRIERE", ["nome"]):
+        _deduplica(conn, "CORRIERE", "idCorriere", "nome", (("SPEDIZIONE", "idCorriere"),),
+                   derivate=(("TEMPO_CONSEGNA", "idCorriere"),))
+        fatto |= _crea_unique(conn, "uq_corriere_nome", "CORRIERE", ["nome"])
+    return fatto
+
+def _indice_carrello_ultima_modifica(conn: Connection) -> bool:
+    # lo sweep dei carrelli parte da VOCE_CARRELLO: l'indice costava solo scritture
+    nome = "idx_carrello_ultima_modifica"
+    if nome not in {i["name"] for i in inspect(conn).get_indexes("CARRELLO")}:
+        return False
+    on = " ON CARRELLO" if conn.dialect.name == "mysql" else ""
+    conn.execute(text(f"DROP INDEX {nome}{on}"))
+    return True
+
+def _indici_mancanti(conn: Connection) -> bool:
+    # indici del modello aggiunti a tabelle già esistenti (create_all li crea solo con la tabella)
+    ins = inspect(conn)
+    fatto = False
+    for tabella in Base.metadata.sorted_tables:
+        presenti = [i["column_names"] for i in ins.get_indexes(tabella.name)]
+        for indice in sorted(tabella.indexes, key=lambda i: i.name):
+            if [c.name for c in indice.columns] not in presenti:
+                indice.create(conn)
+                fatto = True
+    return fatto
+
+
+PASSI: tuple[tuple[str, Callable[[Connection], bool]], ...] = (
+    ("ORDINE.versione, CARRELLO.versione (controllo ottimistico)", _versione_ordine_carrello),
+    ("SPEDIZIONE.dataUltimoAggiornamento (ordine degli eventi di tracking)", _aggiornamento_spedizione),
+    ("PAGAMENTO.tipo (incassi e rimborsi)", _tipo_pagamento),
+    ("UNIQUE su METODO_PAGAMENTO.nomeMetodo e CORRIERE.nome (doppioni fusi)", _nomi_unici_refdata),
+    ("DROP INDEX idx_carrello_ultima_modifica (non più usato dallo sweep)", _indice_carrello_ultima_modifica),
+    ("indici del modello mancanti (es. idx_ordine_stato_data, idx_pagamento_data)", _indici_mancanti),
+)
+
+
+def upgrade(engine: Engine) -> UpgradeReport:
+    """Porta al modello ORM un database creato da una versione precedente.
+
+    create_all crea solo le tabelle mancanti; colonne e vincoli aggiunti a
+    tabelle esistenti passano dai PASSI, eseguiti in ordine. Su MySQL ogni
+    ALTER fa un commit implicito: i passi sono idempotenti e si possono
+    rieseguire dopo un'interruzione.
+    """
+    rep = UpgradeReport()
+    esistenti = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    rep.tabelle_create = sorted(set(Base.metadata.tables) - esistenti)
+    with engine.begin() as conn:
+        for descrizione, passo in PASSI:
+            if passo(conn):
+                rep.passi.append(descrizione)
+    return rep
+
+
+# ----------------------------
+# Confronto fra schema reale e modello ORM
+# ----------------------------
+def differenze(engine: Engine) -> list[str]:
+    """Tabelle, colonne, vincoli UNIQUE e indici del modello assenti dal database.
+
+    UNIQUE e indici si confrontano per colonne, non per nome: lo script DDL
+    nomina vincoli che il modello dichiara con unique=True. Sono segnalate
+    anche le colonne NOT NULL senza default che il modello non conosce, su
+    cui ogni INSERT dell'ORM fallirebbe.
+    """
+    ins = inspect(engine)
+    esistenti = set(ins.get_table_names())
+    diff: list[str] = []
+    for tabella in Base.metadata.sorted_tables:
+        nome = tabella.name
+        if nome not in esistenti:
+            diff.append(f"tabella {nome} mancante")
+            continue
+        colonne = {c["name"]: c for c in ins.get_columns(nome)}
+        diff += [f"colonna {nome}.{c.name} mancante" for c in tabella.columns if c.name not in colonne]
+        diff += [
+            f"colonna {nome}.{c} NOT NULL senza default non presente nel modello"
+            for c, info in colonne.items()
+            if c not in tabella.columns and not info["nullable"] and info.get("default") is None
+        ]
+        unici = _unici(ins, nome)
+        for vincolo in tabella.constraints:
+            if isinstance(vincolo, UniqueConstraint) and [c.name for c in vincolo.columns] not in unici:
+                diff.append(f"vincolo UNIQUE {nome}({', '.join(c.name for c in vincolo.columns)}) mancante")
+        indici = [i["column_names"] for i in ins.get_indexes(nome)] + unici
+        diff += [f"indice {i.name} su {nome} mancante" for i in tabella.indexes if [c.name for c in i.columns] not in indici]
+    return diff
+
+def verifica(engine: Engine) -> None:
+    diff = differenze(engine)
+    if diff:
+        raise ValueError(
+            "Schema del database diverso dal modello ORM (eseguire upgrade-db):\n  - " + "\n  - ".join(diff)
+        )
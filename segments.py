@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from .erasure import ANONIMO
+from .jobs import get_stato_job, now_dt, set_watermark
+from .models import Cliente, Ordine, SegmentoCliente, StatoOrdine
+
+JOB_SEGMENTI = "segmenti_clienti"
+QUINTILI = (0.2, 0.4, 0.6, 0.8)
+# in ordine di priorità: vince la prima condizione vera
+SEGMENTI = ("CAMPIONI", "FEDELI", "NUOVI", "A_RISCHIO", "PERSI", "ALTRI")
+
+
+@dataclass
+class EsitoSegmenti:
+    clientiRicalcolati: int = 0
+    clientiTotali: int = 0
+    punteggiCambiati: int = 0
+    perSegmento: dict[str, int] = field(default_factory=dict)
+
+
+# ----------------------------
+# Fase 1: aggregati per cliente (una scansione raggruppata)
+# ----------------------------
+def _aggregati(ids: list[int] | None = None):
+    stmt = (
+        select(Ordine.idCliente, func.max(Ordine.dataCreazione), func.count(), func.sum(Ordine.totaleNetto))
+        .join(Cliente, Cliente.idCliente == Ordine.idCliente)
+        # i clienti anonimizzati restano negli ordini ma non vanno profilati
+        .where(Ordine.statoOrdine != StatoOrdine.ANNULLATO, Cliente.nome != ANONIMO)
+        .group_by(Ordine.idCliente)
+    )
+    if ids is not None:
+        stmt = stmt.where(Ordine.idCliente.in_(ids))
+    return stmt
+
+def _scrivi_aggregati(session: Session, righe, adesso: datetime) -> int:
+    session.execute(insert(SegmentoCliente), [
+        {"idCliente": c, "ultimoOrdine": u, "ordini": n, "spesaTotale": s, "dataCalcolo": adesso}
+        for c, u, n, s in righe
+    ])
+    return len(righe)
+
+def _ricalcola_completo(session: Session, chunk_size: int) -> int:
+    """Ricostruisce la tabella una pagina di idCliente alla volta.
+
+    Ogni pagina sostituisce le righe del proprio intervallo di id nella stessa
+    transazione: chi legge vede sempre ogni cliente, vecchio o ricalcolato.
+    Il watermark viene azzerato prima: se il job si interrompe, la prossima
+    esecuzione riparte da una ricostruzione completa.
+    """
+    set_watermark(session, JOB_SEGMENTI, ultimo_id=None)
+    session.commit()
+    adesso = now_dt()
+    n = 0
+    ultimo = 0
+    # pagine per idCliente (indice idx_ordine_cliente_data): nessun cursore aperto durante le scritture
+    while righe := session.execute(
+        _aggregati().where(Ordine.idCliente > ultimo).order_by(Ordine.idCliente).limit(chunk_size)
+    ).all():
+        fine = righe[-1][0]
+        # per intervallo: esce anche chi nel frattempo non ha più ordini validi
+        session.execute(delete(SegmentoCliente).where(SegmentoCliente.idCliente > ultimo, SegmentoCliente.idCliente <= fine))
+        n += _scrivi_aggregati(session, righe, adesso)
+        session.commit()
+        ultimo = fine
+    session.execute(delete(SegmentoCliente).where(SegmentoCliente.idCliente > ultimo))
+    session.commit()
+    return n
+
+def _ricalcola_clienti(session: Session, ids: list[int], chunk_size: int) -> int:
+    """Aggregati ricalcolati per intero (non sommati): gli annullamenti dei clienti toccati sono inclusi."""
+    adesso = now_dt()
+    n = 0
+    for i in range(0, len(ids), chunk_size):
+        lotto = ids[i:i + chunk_size]
+        righe = session.execute(_aggregati(lotto)).all()
+        session.execute(delete(SegmentoCliente).where(SegmentoCliente.idCliente.in_(lotto)))
+        if righe:
+            n += _scrivi_aggregati(session, righe, adesso)
+        session.commit()
+    return n
+
+
+# ----------------------------
+# Fase 2: punteggi per quintile e segmento, vettoriali
+# ----------------------------
+def calcola_rfm(recenza_giorni: np.ndarray, ordini: np.ndarray, spesa: np.ndarray) -> tuple[np.ndarray, ...]:
+    """Punteggi 1..5 per quintile (5 = migliore) e indice in SEGMENTI.
+
+    A parità di valore i clienti ricevono lo stesso punteggio: con molti clienti
+    a un solo ordine i quintili di F coincidono e valgono tutti 1.
+    """
+    r = 5 - np.searchsorted(np.quantile(recenza_giorni, QUINTILI), recenza_giorni, side="left")
+    f = 1 + np.searchsorted(np.quantile(ordini, QUINTILI), ordini, side="left")
+    m = 1 + np.searchsorted(np.quantile(spesa, QUINTILI), spesa, side="left")
+    condizioni = [
+        (r >= 4) & (f >= 4) & (m >= 4),
+        (r >= 3) & (f >= 4),
+        (r >= 4) & (f <= 2),
+        (r <= 2) & (f >= 3),
+        (r <= 1),
+    ]
+    seg = np.select(condizioni, np.arange(len(condizioni)), default=len(SEGMENTI) - 1)
+    return r.astype(np.int64), f.astype(np.int64), m.astype(np.int64), seg.astype(np.int64)
+
+def _assegna_punteggi(session: Session, oggi: datetime, chunk_size: int) -> tuple[int, int, Counter]:
+    cols = (
+        SegmentoCliente.idCliente, SegmentoCliente.ultimoOrdine, SegmentoCliente.ordini, SegmentoCliente.spesaTotale,
+        SegmentoCliente.punteggioR, SegmentoCliente.punteggioF, SegmentoCliente.punteggioM, SegmentoCliente.segmento,
+    )
+    parti = [list(zip(*p)) for p in session.execute(select(*cols).execution_options(yield_per=chunk_size)).partitions()]
+    if not parti:
+        return 0, 0, Counter()
+    ids, ultimo, ordini, spesa, r0, f0, m0, seg0 = (np.concatenate([np.asarray(p[i], dtype=object) for p in parti]) for i in range(8))
+
+    recenza = (np.datetime64(oggi, "s") - ultimo.astype("datetime64[s]")) / np.timedelta64(1, "D")
+    r, f, m, seg = calcola_rfm(recenza.astype(np.float64), ordini.astype(np.int64), spesa.astype(np.float64))
+    nomi = np.asarray(SEGMENTI, dtype=object)[seg]
+
+    cambiati = np.flatnonzero((r != r0.astype(np.int64)) | (f != f0.astype(np.int64)) | (m != m0.astype(np.int64)) | (nomi != seg0))
+    for start in range(0, len(cambiati), chunk_size):
+        sl = cambiati[start:start + chunk_size]
+        session.execute(update(SegmentoCliente), [
+            {"idCliente": int(ids[i]), "punteggioR": int(r[i]), "punteggioF": int(f[i]), "punteggioM": int(m[i]),
+             "segmento": nomi[i], "dataCalcolo": oggi}
+            for i in sl
+        ])
+        session.commit()
+    return len(ids), len(cambiati), Counter(nomi.tolist())
+
+
+def segment_clienti(
+    session: Session,
+    completo: bool = False,
+    ritardo: float = 60.0,
+    chunk_size: int = 10000,
+    oggi: datetime | None = None,
+) -> EsitoSegmenti:
+    """Aggiorna gli aggregati dei clienti con ordini nuovi dall'ultima esecuzione
+    (tutti con `completo`) e riassegna i punteggi a tutti, scrivendo solo quelli cambiati.
+
+    Gli annullamenti di ordini vecchi di clienti senza ordini nuovi si vedono solo con `completo`.
+    """
+    oggi = oggi or now_dt()
+    rep = EsitoSegmenti()
+    stato = get_stato_job(session, JOB_SEGMENTI)
+    ultimo = stato.ultimoId if stato and stato.ultimoId else None
+    tetto = session.scalar(
+        select(func.max(Ordine.idOrdine)).where(Ordine.dataCreazione < now_dt() - timedelta(seconds=ritardo))
+    ) or 0
+
+    if completo or ultimo is None:
+        rep.clientiRicalcolati = _ricalcola_completo(session, chunk_size)
+    elif tetto > ultimo:
+        ids = list(session.scalars(
+            select(Ordine.idCliente).where(Ordine.idOrdine > ultimo, Ordine.idOrdine <= tetto).distinct()
+        ))
+        rep.clientiRicalcolati = _ricalcola_clienti(session, ids, chunk_size)
+    set_watermark(session, JOB_SEGMENTI, ultimo_id=max(tetto, ultimo or 0))
+    session.commit()
+
+    rep.clientiTotali, rep.punteggiCambiati, per_segmento = _assegna_punteggi(session, oggi, chunk_size)
+    rep.perSegmento = dict(sorted(per_segmento.items()))
+    return rep
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import time as _time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from sqlalchemy import delete, insert, literal, select
+from sqlalchemy.orm import Session
+
+from .crud import now_dt
+from .models import Carrello, VoceCarrello, VoceCarrelloArchivio
+
+
+@dataclass
+class SweepBatch:
+    batch: int
+    carrelli: int
+    voci: int
+    secondi: float
+
+
+@dataclass
+class SweepReport:
+    batch: int = 0
+    carrelli: int = 0
+    voci: int = 0
+    secondi: float = 0.0
+
+    @property
+    def voci_al_secondo(self) -> float:
+        return self.voci / self.secondi if self.secondi else 0.0
+
+
+# ----------------------------
+# Sweep a lotti dei carrelli inattivi
+# ----------------------------
+def sweep_batches(
+    session: Session,
+    giorni_inattivita: int = 30,
+    batch_size: int = 500,
+    archivia: bool = False,
+    pausa: float = 0.0,
+    adesso: datetime | None = None,
+) -> Iterator[SweepBatch]:
+    """Svuota i carrelli non modificati da `giorni_inattivita` giorni.
+
+    Parte da VOCE_CARRELLO (idx_vocecarrello_carrello) in keyset pagination per
+    idCarrello: i carrelli già svuotati non hanno voci e non vengono più letti,
+    quindi il costo dipende dalle voci presenti e non dallo storico dei carrelli.
+    Ogni lotto è una transazione breve: le righe vengono rilette con la condizione
+    di inattività, così un carrello toccato nel frattempo non viene svuotato.
+    """
+    adesso = adesso or now_dt()
+    cutoff = adesso - timedelta(days=giorni_inattivita)
+    ultimo = 0
+    n = 0
+
+    while True:
+        t0 = _time.perf_counter()
+        carrelli = session.scalars(
+            select(VoceCarrello.idCarrello)
+            .join(Carrello, Carrello.idCarrello == VoceCarrello.idCarrello)
+            .where(VoceCarrello.idCarrello > ultimo, Carrello.dataUltimaModifica < cutoff)
+            .distinct()
+            .order_by(VoceCarrello.idCarrello)
+            .limit(batch_size)
+        ).all()
+        if not carrelli:
+            session.commit()
+            return
+        ultimo = carrelli[-1]
+
+        id_voci = session.scalars(
+            select(VoceCarrello.idVoceCarrello)
+            .join(Carrello, Carrello.idCarrello == VoceCarrello.idCarrello)
+            .where(
+                Carrello.idCarrello.in_(carrelli),
+                Carrello.dataUltimaModifica < cutoff,
+            )
+        ).all()
+
+        if id_voci:
+            if archivia:
+                session.execute(insert(VoceCarrelloArchivio).from_select(
+                    ["idVoceCarrello", "idCarrello", "sku", "quantita", "prezzoVisto", "dataAggiunta", "dataArchiviazione"],
+                    select(
+                        VoceCarrello.idVoceCarrello, VoceCarrello.idCarrello, VoceCarrello.sku,
+                        VoceCarrello.quantita, VoceCarrello.prezzoVisto, VoceCarrello.dataAggiunta,
+                        literal(adesso, VoceCarrelloArchivio.dataArchiviazione.type),
+                    ).where(VoceCarrello.idVoceCarrello.in_(id_voci)),
+                ))
+            session.execute(
+                delete(VoceCarrello)
+                .where(VoceCarrello.idVoceCarrello.in_(id_voci))
+                .execution_options(synchronize_session=False)
+            )
+        session.commit()
+
+        n += 1
+        yield SweepBatch(n, len(carrelli), len(id_voci), _time.perf_counter() - t0)
+        if pausa:
+            _time.sleep(pausa)
+
+def sweep_carts(session: Session, **kwargs) -> SweepReport:
+    rep = SweepReport()
+    for b in sweep_batches(session, **kwargs):
+        rep.batch = b.batch
+        rep.carrelli += b.carrelli
+        rep.voci += b.voci
+        rep.secondi += b.secondi
+    return rep
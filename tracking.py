@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import csv
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from sqlalchemy import delete, exists, func, insert, select, update
+from sqlalchemy.orm import Session, aliased
+
+from .models import Ordine, Spedizione, StagingTracking, StatoOrdine, StatoSpedizione
+from .outbox import emit_many, evento_ordine, evento_spedizione
+from .reportcache import bump
+
+
+@dataclass
+class ChunkReport:
+    chunk: int
+    righe_lette: int
+    righe_scartate: int
+    spedizioni_aggiornate: int
+    ordini_aggiornati: int
+
+
+@dataclass(frozen=True)
+class EventoTracking:
+    tracking: str
+    stato: StatoSpedizione
+    data_evento: datetime
+
+
+# ----------------------------
+# Lettura feed corriere (tracking, stato, timestamp)
+# ----------------------------
+def read_feed(path: str) -> Iterator[EventoTracking | None]:
+    """Legge il CSV del corriere; le righe non valide producono None."""
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().lower() == "tracking":
+                continue
+            try:
+                tracking, stato, ts = (x.strip() for x in row[:3])
+                yield EventoTracking(tracking, StatoSpedizione[stato], datetime.fromisoformat(ts))
+            except (ValueError, KeyError):
+                yield None
+
+def _chunks(eventi: Iterable[EventoTracking | None], size: int) -> Iterator[list[EventoTracking | None]]:
+    buf: list[EventoTracking | None] = []
+    for e in eventi:
+        buf.append(e)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+# ----------------------------
+# Applicazione set-based di un chunk
+# ----------------------------
+def _apply_chunk(session: Session, eventi: list[EventoTracking]) -> tuple[int, int]:
+    # nel chunk vale solo l'evento più recente per tracking
+    ultimi: dict[str, EventoTracking] = {}
+    for e in eventi:
+        prev = ultimi.get(e.tracking)
+        if prev is None or e.data_evento > prev.data_evento:
+            ultimi[e.tracking] = e
+
+    lotto = str(uuid.uuid4())
+    session.execute(insert(StagingTracking), [
+        {"idLotto": lotto, "tracking": e.tracking, "statoSpedizione": e.stato, "dataEvento": e.data_evento}
+        for e in ultimi.values()
+    ])
+
+    # eventi più vecchi dell'ultimo applicato (o della spedizione stessa) sono ignorati
+    da_applicare = (
+        Spedizione.tracking == StagingTracking.tracking,
+        StagingTracking.idLotto == lotto,
+        StagingTracking.dataEvento > func.coalesce(Spedizione.dataUltimoAggiornamento, Spedizione.dataSpedizione),
+    )
+    # righe per l'outbox lette dal join con lo staging prima di aggiornarle
+    spedizioni = session.execute(
+        select(Spedizione.tracking, Spedizione.idOrdine, Spedizione.idCorriere, StagingTracking.statoSpedizione)
+        .where(*da_applicare)
+    ).all()
+    ordini = sorted({s.idOrdine for s in spedizioni})
+    stato_prima = dict(session.execute(
+        select(Ordine.idOrdine, Ordine.statoOrdine).where(Ordine.idOrdine.in_(ordini))
+    ).all()) if ordini else {}
+
+    upd_spedizioni = (
+        update(Spedizione)
+        .where(*da_applicare)
+        .values(statoSpedizione=StagingTracking.statoSpedizione, dataUltimoAggiornamento=StagingTracking.dataEvento)
+        .execution_options(synchronize_session=False)
+    )
+    n_sped = session.execute(upd_spedizioni).rowcount
+
+    # spedizioni effettivamente aggiornate in questo passaggio
+    applicate = (
+        Spedizione.tracking == StagingTracking.tracking,
+        StagingTracking.idLotto == lotto,
+        Spedizione.dataUltimoAggiornamento == StagingTracking.dataEvento,
+        Spedizione.idOrdine == Ordine.idOrdine,
+    )
+
+    # CONSEGNATO solo quando tutte le spedizioni dell'ordine risultano consegnate
+    altra = aliased(Spedizione)
+    upd_consegnati = (
+        update(Ordine)
+        .where(
+            *applicate,
+            StagingTracking.statoSpedizione == StatoSpedizione.CONSEGNATA,
+            Ordine.statoOrdine.not_in([StatoOrdine.CONSEGNATO, StatoOrdine.ANNULLATO]),
+            ~exists().where(
+                altra.idOrdine == Ordine.idOrdine,
+                altra.statoSpedizione != StatoSpedizione.CONSEGNATA,
+            ),
+        )
+        .values(statoOrdine=StatoOrdine.CONSEGNATO, versione=Ordine.versione + 1)
+        .execution_options(synchronize_session=False)
+    )
+    n_ord = session.execute(upd_consegnati).rowcount
+
+    upd_spediti = (
+        update(Ordine)
+        .where(
+            *applicate,
+            StagingTracking.statoSpedizione == StatoSpedizione.IN_TRANSITO,
+            Ordine.statoOrdine.in_([StatoOrdine.CREATO, StatoOrdine.PAGATO, StatoOrdine.IN_PREPARAZIONE]),
+        )
+        .values(statoOrdine=StatoOrdine.SPEDITO, versione=Ordine.versione + 1)
+        .execution_options(synchronize_session=False)
+    )
+    n_ord += session.execute(upd_spediti).rowcount
+
+    eventi_outbox = [evento_spedizione(*s, "SPEDIZIONE_AGGIORNATA") for s in spedizioni]
+    if n_ord:
+        eventi_outbox += [
+            evento_ordine(o.idOrdine, o.idCliente, o.statoOrdine, o.totaleNetto,
+                          "ORDINE_CONSEGNATO" if o.statoOrdine == StatoOrdine.CONSEGNATO else "ORDINE_SPEDITO")
+            for o in session.execute(
+                select(Ordine.idOrdine, Ordine.idCliente, Ordine.statoOrdine, Ordine.totaleNetto).where(Ordine.idOrdine.in_(ordini))
+            )
+            if o.statoOrdine != stato_prima.get(o.idOrdine)
+        ]
+    emit_many(session, eventi_outbox)
+
+    session.execute(delete(StagingTracking).where(StagingTracking.idLotto == lotto))
+    return n_sped, n_ord
+
+def ingest_eventi(
+    session: Session,
+    eventi: Iterable[EventoTracking | None],
+    chunk_size: int = 5000,
+) -> Iterator[ChunkReport]:
+    """Applica gli eventi a chunk, una transazione per chunk."""
+    for i, chunk in enumerate(_chunks(eventi, chunk_size), start=1):
+        validi = [e for e in chunk if e is not None]
+        n_sped = n_ord = 0
+        if validi:
+            n_sped, n_ord = _apply_chunk(session, validi)
+            bump(session, Spedizione, Ordine)
+            session.commit()
+        yield ChunkReport(
+            chunk=i,
+            righe_lette=len(chunk),
+            righe_scartate=len(chunk) - len(validi),
+            spedizioni_aggiornate=n_sped,
+            ordini_aggiornati=n_ord,
+        )
+
+def ingest_file(session: Session, path: str, chunk_size: int = 5000) -> Iterator[ChunkReport]:
+    return ingest_eventi(session, read_feed(path), chunk_size)